@@ -0,0 +1,279 @@
+"""
+Persistent directory of Spotify artists, for resolving artist names and IDs.
+
+The directory is a small SQLite file next to the other data files. Lookups are indexed
+queries, so resolving a name or an ID doesn't require loading the listening history.
+
+Tables:
+- artists: artist_id -> current name, plus when the artist was first and last seen
+- artist_names: every (name, artist_id) pair ever seen, so old names still resolve and a
+  name shared by several artists comes back as ambiguous instead of picking one
+- watermarks: how far each source has been processed
+
+The directory grows incrementally:
+- from the listening history, processing only the tracks added since the last update
+- from any tracks that are fed in with add_tracks(), e.g. freshly fetched album tracks
+A lookup that misses triggers an update from the listening history before giving up, if the
+history changed since the last such update.
+"""
+
+import logging
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+import djlib_config
+from containers import *
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artists (
+    artist_id TEXT PRIMARY KEY,
+    artist_name TEXT,
+    first_seen REAL,
+    last_seen REAL
+);
+
+CREATE TABLE IF NOT EXISTS artist_names (
+    artist_name TEXT NOT NULL,
+    artist_id TEXT NOT NULL,
+    first_seen REAL,
+    last_seen REAL,
+    PRIMARY KEY (artist_name, artist_id)
+);
+
+CREATE INDEX IF NOT EXISTS artists_by_name ON artists (artist_name);
+CREATE INDEX IF NOT EXISTS artist_names_by_id ON artist_names (artist_id);
+
+CREATE TABLE IF NOT EXISTS watermarks (
+    source TEXT PRIMARY KEY,
+    value REAL
+);
+"""
+
+_singleton = None
+_singleton_lock = threading.Lock()
+
+
+def _track_credits(tracks: pd.DataFrame, seen_at) -> pd.DataFrame:
+    """Returns one (artist_id, artist_name, seen_at) row per artist credit on the tracks;
+       seen_at is a UNIX time, either a Series aligned with tracks or a scalar."""
+    credits = pd.DataFrame({
+        'artist_id': tracks['artist_ids'].str.split('|').to_numpy(),
+        'artist_name': tracks['artist_names'].str.split('|').to_numpy(),
+        'seen_at': seen_at if pd.api.types.is_scalar(seen_at) else seen_at.to_numpy(),
+    })
+
+    credits = credits.loc[credits.artist_id.notna() & credits.artist_name.notna()]
+
+    # mismatched lists can't be paired up
+    credits = credits.loc[credits.artist_id.str.len() == credits.artist_name.str.len()]
+
+    return credits.explode(['artist_id', 'artist_name'])
+
+
+class ArtistDirectory:
+    def __init__(self, path):
+        self._path = path
+        self.is_new = not os.path.exists(path)
+
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+        # whether a lookup miss updated from the listening history, and its mtime then
+        self._history_checked = False
+        self._history_mtime = None
+        return
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM artists').fetchone()[0]
+
+    # Updates
+
+    def add_tracks(self, tracks: pd.DataFrame, seen_at=None):
+        """Adds the artists credited on the tracks (a DF with artist_ids and artist_names).
+           seen_at: UNIX time(s) the tracks were seen at; defaults to now."""
+        if len(tracks) == 0:
+            return
+
+        if seen_at is None:
+            seen_at = time.time()
+
+        credits = _track_credits(tracks, seen_at)
+        if len(credits) == 0:
+            return
+
+        names = credits.groupby(['artist_name', 'artist_id'], sort=False).seen_at.agg(['min', 'max'])
+
+        # the current name is the one seen last
+        latest = credits.sort_values(by='seen_at', kind='stable').drop_duplicates(
+            subset='artist_id', keep='last').set_index('artist_id')
+        artists = credits.groupby('artist_id', sort=False).seen_at.agg(['min', 'max'])
+        artists['artist_name'] = latest.artist_name
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO artist_names (artist_name, artist_id, first_seen, last_seen) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT (artist_name, artist_id) DO UPDATE SET '
+                'first_seen = MIN(first_seen, excluded.first_seen), '
+                'last_seen = MAX(last_seen, excluded.last_seen)',
+                [(name, artist_id, float(first), float(last))
+                 for (name, artist_id), first, last in zip(names.index, names['min'], names['max'])])
+
+            self._conn.executemany(
+                'INSERT INTO artists (artist_id, artist_name, first_seen, last_seen) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT (artist_id) DO UPDATE SET '
+                'artist_name = CASE WHEN excluded.last_seen >= last_seen '
+                'THEN excluded.artist_name ELSE artist_name END, '
+                'first_seen = MIN(first_seen, excluded.first_seen), '
+                'last_seen = MAX(last_seen, excluded.last_seen)',
+                [(artist_id, name, float(first), float(last))
+                 for artist_id, name, first, last in zip(
+                    artists.index, artists.artist_name, artists['min'], artists['max'])])
+
+        logger.debug('Artist directory: %d credits, %d artists added or updated',
+                     len(credits), len(artists))
+        return
+
+    def _get_watermark(self, source):
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM watermarks WHERE source = ?',
+                                     (source,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_watermark(self, source, value):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO watermarks (source, value) VALUES (?, ?)',
+                               (source, value))
+        return
+
+    def add_tracks_once(self, source, get_tracks):
+        """Adds the tracks returned by get_tracks() unless tracks from source were added
+           before; for seeding the directory from a source that has its own update path."""
+        if self._get_watermark(source) is not None:
+            return
+
+        self.add_tracks(get_tracks())
+        self._set_watermark(source, time.time())
+        return
+
+    def update_from_listening_history(self):
+        """Adds the artists of the tracks added to the listening history since the last
+           update. Returns the number of tracks processed."""
+        tracks = ListeningHistory().get_df()
+
+        added_at = (tracks['added_at'] - pd.Timestamp(0, tz='UTC')).dt.total_seconds()
+
+        watermark = self._get_watermark('listening_history')
+        if watermark is not None:
+            new_tracks = (added_at > watermark).to_numpy()
+            tracks = tracks.loc[new_tracks]
+            added_at = added_at.loc[new_tracks]
+
+        if len(tracks) > 0:
+            # tracks from before added_at was recorded count as seen at the earliest time
+            self.add_tracks(tracks, seen_at=added_at.fillna(added_at.min()).fillna(0))
+            if added_at.notna().any():
+                self._set_watermark('listening_history', float(added_at.max()))
+
+        logger.debug('Artist directory: %d new listening history tracks', len(tracks))
+        return len(tracks)
+
+    def _update_on_miss(self):
+        """Updates from the listening history after a lookup miss, unless it hasn't changed
+           since the last time a miss did; returns whether any tracks were added."""
+        with self._lock:
+            mtime = ListeningHistory().getmtime()
+            if self._history_checked and mtime == self._history_mtime:
+                return False
+
+            self._history_checked = True
+            self._history_mtime = mtime
+            return self.update_from_listening_history() > 0
+
+    # Lookups
+
+    def get_artists(self) -> pd.DataFrame:
+        with self._lock:
+            df = pd.read_sql_query(
+                'SELECT artist_id, artist_name, first_seen, last_seen FROM artists', self._conn)
+        return df.set_index('artist_id', drop=False)
+
+    def _get_name(self, artist_id):
+        with self._lock:
+            row = self._conn.execute('SELECT artist_name FROM artists WHERE artist_id = ?',
+                                     (artist_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def _get_ids(self, artist_name):
+        """IDs whose current name is artist_name; failing that, IDs that ever had it."""
+        with self._lock:
+            rows = self._conn.execute('SELECT artist_id FROM artists WHERE artist_name = ?',
+                                      (artist_name,)).fetchall()
+            if len(rows) == 0:
+                rows = self._conn.execute('SELECT artist_id FROM artist_names WHERE artist_name = ?',
+                                          (artist_name,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_aliases(self, artist_id):
+        """Returns the names the artist was seen with besides the current one, latest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT n.artist_name FROM artist_names n JOIN artists a ON a.artist_id = n.artist_id '
+                'WHERE n.artist_id = ? AND n.artist_name != a.artist_name ORDER BY n.last_seen DESC',
+                (artist_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_artist_name(self, artist_id):
+        artist_name = self._get_name(artist_id)
+
+        if artist_name is None and self._update_on_miss():
+            artist_name = self._get_name(artist_id)
+
+        if artist_name is None:
+            raise ValueError(f'Spotify artist with id {artist_id} not found.')
+
+        return artist_name
+
+    def get_artist_id(self, artist_name):
+        """Returns the ID of the artist with the name; raises a ValueError listing the
+           candidates if several artists have that name."""
+        artist_ids = self._get_ids(artist_name)
+
+        if len(artist_ids) == 0 and self._update_on_miss():
+            artist_ids = self._get_ids(artist_name)
+
+        if len(artist_ids) == 0:
+            raise ValueError(f'Spotify artist with name {artist_name} not found.')
+
+        if len(artist_ids) > 1:
+            candidates = ', '.join(
+                f'{artist_id} (now {self._get_name(artist_id)})' for artist_id in artist_ids)
+            raise ValueError(f'Multiple IDs found for artist {artist_name}: {candidates}')
+
+        return artist_ids[0]
+
+
+def get_instance():
+    global _singleton
+    # the discography looks artists up from the threads of a parallel refresh
+    with _singleton_lock:
+        if _singleton is None:
+            artist_directory = ArtistDirectory(
+                os.path.join(djlib_config.default_dir, 'spotify-artists.sqlite'))
+            if artist_directory.is_new:
+                print('Building the artist directory from the listening history...')
+                artist_directory.update_from_listening_history()
+            _singleton = artist_directory
+    return _singleton
@@ -0,0 +1,85 @@
+"""
+Parquet and Feather files for docs, as an alternative to CSV.
+
+Both formats store the column types, so lists, booleans, nullable ints and timezone-aware
+datetimes come back as they were written, without parsing. The index is stored along with
+the columns. Files are read with memory mapping and written to a temporary file that then
+replaces the old one.
+
+pyarrow is only needed, and only imported, when a doc of one of these types is used.
+"""
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ['parquet', 'feather']
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError('Parquet and Feather docs require pyarrow (pip install pyarrow)')
+    return pyarrow
+
+
+def _to_list(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return []
+    return value
+
+
+def read(path, format, *, index_column=None, list_columns=(), datetime_columns=()) -> pd.DataFrame:
+    pa = _import_pyarrow()
+
+    if format == 'parquet':
+        table = pa.parquet.read_table(path, memory_map=True)
+    elif format == 'feather':
+        table = pa.feather.read_table(path, memory_map=True)
+    else:
+        raise ValueError(f'Unknown columnar format {format}')
+
+    df = table.to_pandas()
+
+    # Arrow lists come back as numpy arrays
+    for column in df.columns:
+        if column in list_columns or pa.types.is_list(table.schema.field(column).type):
+            df[column] = df[column].map(_to_list)
+
+    # columns written as strings, e.g. before the doc was converted
+    for column in datetime_columns:
+        if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column], utc=True, format='ISO8601')
+
+    if index_column is not None and df.index.name != index_column:
+        df = df.set_index(index_column, drop=False)
+
+    logger.debug('Read %d rows from %s', len(df), path)
+    return df
+
+
+def write(df: pd.DataFrame, path, format):
+    pa = _import_pyarrow()
+
+    table = pa.Table.from_pandas(df, preserve_index=True)
+
+    tmp_path = path + '.tmp'
+    if format == 'parquet':
+        pa.parquet.write_table(table, tmp_path)
+    elif format == 'feather':
+        pa.feather.write_feather(table, tmp_path)
+    else:
+        raise ValueError(f'Unknown columnar format {format}')
+    os.replace(tmp_path, path)
+
+    logger.debug('Wrote %d rows to %s', len(df), path)
+    return
@@ -1,5 +1,12 @@
 
 
+import logging
+import os
+import os.path
+import pickle
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import pandas as pd
 import numpy as np
 
@@ -7,53 +14,187 @@ import spyroslib.containers as ct
 import djlib_config
 
 from local_util import *
+from segmented_log import SegmentedLog
+from doc_journal import DocJournal
+import columnar_file
+import sheet_diff
+import sheet_cache
+import spotify_track_store
+
+logger = logging.getLogger(__name__)
+
+class IdMap:
+    """
+    Cached rekordbox_id <-> spotify_id mapping, built from the rekordbox_to_spotify doc.
+    The doc is read and indexed once; it's re-read when its file changes, or after
+    invalidate(). Translations are hash lookups in the cached indexes instead of merges.
+    Columns the tracks already have win over the mapping's, except for the ID being
+    translated to.
+    A spotify_id mapped from more than one rekordbox_id translates to the first of them.
+    """
+    def __init__(self, doc_name='rekordbox_to_spotify'):
+        self._doc_name = doc_name
+        self._mtime = None
+        # all entries, including the ones marked as not found on Spotify
+        self._by_rekordbox = None
+        # entries with a spotify_id
+        self._mapped_by_rekordbox = None
+        self._by_spotify = None
+
+        self.num_builds = 0
+        return
 
-def translate_spotify_id_to_rekordbox(spotify_df: pd.DataFrame) -> pd.DataFrame:
-    """Converts a dataframe indexed by spotify_id to one indexed by rekordbox_id"""
-    # TODO this should really be in a different file and passed in as a function argument
+    def invalidate(self):
+        self._by_rekordbox = None
+        return
 
-    if spotify_df.index.name != 'spotify_id':
-        raise ValueError('Expected a DF indexed by spotify_id')
+    def _ensure(self):
+        doc = Doc(self._doc_name)
+        mtime = doc.getmtime()
 
-    rekordbox_to_spotify_mapping = Doc('rekordbox_to_spotify').get_df()
+        if self._by_rekordbox is not None and mtime == self._mtime:
+            return
 
-    # remove empty mappings
-    rekordbox_to_spotify_mapping = rekordbox_to_spotify_mapping.loc[
-        ~pd.isna(rekordbox_to_spotify_mapping.spotify_id)
-    ]
+        mapping = doc.get_df()
 
-    spotify_df = spotify_df.merge(
-        right=rekordbox_to_spotify_mapping,
-        how='inner',
-        left_index=True,
-        right_on='spotify_id'
-    )
+        mapped = mapping.loc[mapping.spotify_id.notna()]
 
-    spotify_df = spotify_df.set_index(keys='rekordbox_id', drop=False)
+        duplicated = mapped.spotify_id.duplicated()
+        if duplicated.any():
+            logger.warning('%s: %d spotify IDs are mapped from more than one rekordbox ID',
+                           self._doc_name, int(duplicated.sum()))
 
-    return spotify_df
+        self._by_rekordbox = mapping
+        self._mapped_by_rekordbox = mapped
+        self._by_spotify = mapped.loc[~duplicated].set_index('spotify_id', drop=False)
+        self._mtime = mtime
+        self.num_builds += 1
 
-def translate_rekordbox_id_to_spotify(rekordbox_df: pd.DataFrame) -> pd.DataFrame:
-    if rekordbox_df.index.name != 'rekordbox_id':
-        raise ValueError('Expected a DF indexed by rekordbox_id')
+        logger.debug('%s: ID map built, %d entries, %d mapped',
+                     self._doc_name, len(mapping), len(self._by_spotify))
+        return
+
+    @staticmethod
+    def _attach(df: pd.DataFrame, mapping: pd.DataFrame, *, inner, id_columns=(), exclude=()):
+        """Returns df with the mapping's columns for each row's index value added;
+           inner=True drops the rows that aren't in the mapping."""
+        if inner:
+            df = df.loc[mapping.index.get_indexer(df.index) != -1]
+
+        columns = [
+            column for column in mapping.columns
+            if column not in exclude and (column in id_columns or column not in df.columns)
+        ]
+
+        result = df.drop(columns=[column for column in columns if column in df.columns])
+
+        # a lookup in the mapping's index; rows that aren't there get missing values
+        values = mapping[columns].reindex(df.index)
+        for column in columns:
+            result[column] = values[column].to_numpy()
+
+        return result
+
+    def translate_spotify_id_to_rekordbox(self, spotify_df: pd.DataFrame) -> pd.DataFrame:
+        """Converts a dataframe indexed by spotify_id to one indexed by rekordbox_id"""
+        if spotify_df.index.name != 'spotify_id':
+            raise ValueError('Expected a DF indexed by spotify_id')
+
+        self._ensure()
+
+        spotify_df = self._attach(spotify_df, self._by_spotify, inner=True,
+                                  id_columns=['rekordbox_id'])
+
+        return spotify_df.set_index(keys='rekordbox_id', drop=False)
+
+    def translate_rekordbox_id_to_spotify(self, rekordbox_df: pd.DataFrame) -> pd.DataFrame:
+        if rekordbox_df.index.name != 'rekordbox_id':
+            raise ValueError('Expected a DF indexed by rekordbox_id')
+
+        self._ensure()
+
+        rekordbox_df = self._attach(rekordbox_df, self._mapped_by_rekordbox, inner=True,
+                                    id_columns=['spotify_id'])
 
-    rekordbox_to_spotify_mapping = Doc('rekordbox_to_spotify').get_df()
+        return rekordbox_df.set_index(keys='spotify_id', drop=False)
 
-    # remove empty mappings
-    rekordbox_to_spotify_mapping = rekordbox_to_spotify_mapping.loc[
-        ~pd.isna(rekordbox_to_spotify_mapping.spotify_id)
-    ]
+    def add_spotify_fields(self, rekordbox_tracks: pd.DataFrame, drop_missing_ids=False,
+                           fill_metadata=False):
+        """fill_metadata: also fill in the track metadata the mapping lacks from the track
+           store (see spotify_track_store), fetching what the store lacks."""
+        if rekordbox_tracks.index.name != 'rekordbox_id':
+            raise ValueError('Argument is not indexed by rekordbox_id')
 
-    rekordbox_df = rekordbox_df.merge(
-        right=rekordbox_to_spotify_mapping,
-        how='inner',
-        left_index=True,
-        right_index=True
-    )
+        self._ensure()
 
-    rekordbox_df = rekordbox_df.set_index(keys='spotify_id', drop=False)
+        tracks = self._attach(
+            rekordbox_tracks,
+            self._mapped_by_rekordbox if drop_missing_ids else self._by_rekordbox,
+            inner=drop_missing_ids)
 
-    return rekordbox_df
+        if fill_metadata:
+            tracks = fill_mapped_track_metadata(tracks)
+
+        return tracks
+
+    def add_rekordbox_fields(self, spotify_tracks: pd.DataFrame, drop_missing_ids=False):
+        if spotify_tracks.index.name != 'spotify_id':
+            raise ValueError('Argument is not indexed by spotify_id')
+
+        self._ensure()
+
+        return self._attach(spotify_tracks, self._by_spotify, inner=drop_missing_ids,
+                            exclude=['spotify_id'])
+
+
+_id_map = None
+
+def fill_mapped_track_metadata(tracks: pd.DataFrame, columns=None, hydrate=True) -> pd.DataFrame:
+    """Fills in track metadata from the track store for the rows of a DF that aren't indexed
+       by spotify_id but have a spotify_id column, like the rekordbox_to_spotify mapping."""
+    mapped = tracks.spotify_id.notna().to_numpy()
+    if not mapped.any():
+        return tracks
+
+    if columns is None:
+        columns = spotify_track_store.METADATA_COLUMNS
+
+    lookup = tracks.loc[mapped, [column for column in columns if column in tracks.columns]]
+    lookup.index = pd.Index(tracks.spotify_id[mapped], name='spotify_id')
+    filled = spotify_track_store.get_instance().fill_metadata(lookup, columns=columns, hydrate=hydrate)
+
+    tracks = tracks.copy()
+    for column in columns:
+        if column not in tracks.columns:
+            tracks[column] = None
+        tracks.loc[mapped, column] = filled[column].to_numpy()
+    return tracks
+
+def _fill_appended_track_metadata(container, df: pd.DataFrame) -> pd.DataFrame:
+    """Fills in the metadata columns the container has for appended tracks that lack them,
+       from what the track store already has; doesn't fetch anything."""
+    if df.index.name != 'spotify_id' or len(df) == 0:
+        return df
+
+    columns = [column for column in spotify_track_store.METADATA_COLUMNS
+               if column in container.get_df().columns]
+    if len(columns) == 0:
+        return df
+
+    return spotify_track_store.get_instance().fill_metadata(df, columns=columns, hydrate=False)
+
+def get_id_map() -> IdMap:
+    global _id_map
+    if _id_map is None:
+        _id_map = IdMap()
+    return _id_map
+
+def translate_spotify_id_to_rekordbox(spotify_df: pd.DataFrame) -> pd.DataFrame:
+    """Converts a dataframe indexed by spotify_id to one indexed by rekordbox_id"""
+    return get_id_map().translate_spotify_id_to_rekordbox(spotify_df)
+
+def translate_rekordbox_id_to_spotify(rekordbox_df: pd.DataFrame) -> pd.DataFrame:
+    return get_id_map().translate_rekordbox_id_to_spotify(rekordbox_df)
 
 def djlibman_id_translator_func(this_index_name, other_df):
     if this_index_name == 'spotify_id':
@@ -76,25 +217,331 @@ ct.set_default_id_translator_func(djlibman_id_translator_func)
 ct.set_default_printer_func(lambda df: pretty_print_tracks(df, enum=True))
 
 
+class Session:
+    """
+    A unit of work: container write-backs inside the session are deferred and done once, at
+    the end, after a single confirmation prompt.
+    Writes are keyed by the container's identity (its class and name), so writing the same
+    queue or playlist several times, even through different container objects, costs one
+    write-back of the last contents. Reading a container with a deferred write returns the
+    deferred contents.
+    The write-backs are done in dependency order (see _flush_rank): the listening history
+    first, so a track is never dropped from a queue before it's in the history, then the
+    other docs, then Spotify, and Rekordbox playlists last, followed by a single write of the
+    Rekordbox XML.
+    Containers that read deferred contents take them as what they'll compare their next
+    write against (see Doc._observe); if the deferred writes are discarded, they forget it.
+    """
+    def __init__(self, prompt=True):
+        self._prompt = prompt
+        # key -> [container, df]; the container whose write was deferred first
+        self._pending = OrderedDict()
+        # key -> the containers that read the deferred contents
+        self._readers = {}
+        self._flushing = False
+        return
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _get_key(self, container):
+        return type(container).__name__, container.get_name()
+
+    def defer(self, container, df):
+        """Returns True if the write-back of df to container was deferred."""
+        if self._flushing:
+            return False
+
+        key = self._get_key(container)
+        if key in self._pending:
+            self._pending[key][1] = df
+        else:
+            self._pending[key] = [container, df]
+        return True
+
+    def get_pending_df(self, container):
+        key = self._get_key(container)
+        pending = self._pending.get(key)
+        if pending is None:
+            return None
+
+        readers = self._readers.setdefault(key, [])
+        if not any(reader is container for reader in readers):
+            readers.append(container)
+        return pending[1]
+
+    def discard(self):
+        for readers in self._readers.values():
+            for reader in readers:
+                if hasattr(reader, '_forget_observed'):
+                    reader._forget_observed()
+        self._pending.clear()
+        self._readers.clear()
+        return
+
+    def _write_back(self, pending):
+        """Writes back the (container, df) entries, in order."""
+        self._flushing = True
+        try:
+            rekordbox_changed = False
+            for container, df in pending:
+                logger.debug('Session: writing back %s', container.get_name())
+                if isinstance(container, RekordboxPlaylist):
+                    container._write_back(df, write_thru=False)
+                    rekordbox_changed = True
+                else:
+                    container._write_back(df)
+
+                for reader in self._readers.pop(self._get_key(container), []):
+                    if reader is not container and hasattr(reader, '_observe'):
+                        reader._observe(df)
+
+            if rekordbox_changed:
+                djlib_config.rekordbox.write()
+        finally:
+            self._flushing = False
+        return
+
+    def flush_listening_history(self):
+        """Writes back the listening history only and discards the other writes, e.g. when
+           the session is interrupted: the tracks listened to are kept, and as the history
+           is written first anyway, no other container depends on the writes discarded."""
+        history = [entry for entry in self._pending.values()
+                   if isinstance(entry[0], ListeningHistory)]
+        if len(history) > 0:
+            self._write_back(history)
+        if len(self._pending) > len(history):
+            logger.warning('Session: discarding %d deferred writes', len(self._pending) - len(history))
+        self.discard()
+        return
+
+    def flush(self):
+        if len(self._pending) == 0:
+            return
+
+        pending = sorted(self._pending.values(),
+                         key=lambda entry: getattr(entry[0], '_flush_rank', 1))
+
+        print(f'Writing {len(pending)} containers:')
+        for container, df in pending:
+            print(f'    {container.get_name()}: {len(df)} tracks')
+
+        if self._prompt:
+            choice = get_user_choice('Proceed?')
+            if choice != 'yes':
+                print('Discarding the changes')
+                self.discard()
+                return
+
+        self._write_back(pending)
+
+        self._pending.clear()
+        self._readers.clear()
+        return
+
+_session = None
+
+@contextmanager
+def session(prompt=True):
+    """
+    with session():
+        ...
+    Defers the write-backs of the containers written inside the block to its end; see
+    Session. A session inside another one joins it. If the block raises, or is interrupted,
+    the listening history is still written and the other deferred writes are discarded.
+    """
+    global _session
+
+    if _session is not None:
+        yield _session
+        return
+
+    _session = Session(prompt=prompt)
+    try:
+        yield _session
+    except BaseException:
+        _session.flush_listening_history()
+        raise
+    else:
+        _session.flush()
+    finally:
+        _session = None
+    return
+
+def _defer_write_back(container, df):
+    return _session is not None and _session.defer(container, df)
+
+def _get_pending_df(container):
+    if _session is None:
+        return None
+    df = _session.get_pending_df(container)
+    return None if df is None else df.copy()
+
+
 class Doc(ct.Doc):
+    """
+    journal: keep delta backups (see doc_journal) instead of rotating full copies; defaults
+    to backup_mode = journal in the doc's config section.
+    type can also be parquet or feather (see columnar_file); spyroslib treats these docs as
+    CSVs, but they're read and written here. They're backed up with the journal.
+    Google Sheet docs from the config file write only the cells that changed since they were
+    read (see sheet_diff), unless rows or columns were added, removed or reordered. They're
+    downloaded only if they changed since the last time (see sheet_cache).
+    """
     def __init__(self,
                  name,
+                 journal=None,
                  **kwargs):
         if 'google_intf' not in kwargs:
             kwargs['google_intf'] = djlib_config.google
         if 'default_dir' not in kwargs:
             kwargs['default_dir'] = djlib_config.default_dir
+
+        self._sheet_config = None
+        self._sheet_snapshot = None
+        config = djlib_config.doc_configs.get(name)
+        if (config is not None and config['type'] == 'google_sheet' and 'sheet' in config and
+                'type' not in kwargs):
+            self._sheet_config = config
+
+        self._columnar = djlib_config.doc_columnar.get(name)
+        if kwargs.get('type') in columnar_file.FORMATS:
+            self._columnar = dict(kwargs, format=kwargs['type'])
+            kwargs['type'] = 'csv'
+        if self._columnar is not None and kwargs['default_dir'] is not None:
+            # relative paths are in default_dir, as for CSV docs
+            self._columnar = dict(self._columnar,
+                                  path=os.path.join(kwargs['default_dir'], self._columnar['path']))
+
+        if journal is None:
+            journal = (djlib_config.doc_backup_mode.get(name) == 'journal' or
+                       (self._columnar is not None and
+                        self._columnar.get('backups', djlib_config._backups) > 0))
+        self._journal = None
+        if journal:
+            self._journal = DocJournal(os.path.join(djlib_config.default_dir, 'journals', name))
+            if kwargs.get('backups', 0) > 0:
+                logger.info('%s: journal backups replace the %d rotating backups asked for',
+                            name, kwargs['backups'])
+            kwargs['backups'] = 0
+
         super(Doc, self).__init__(name, **kwargs)
         return
 
+    def _observe(self, df):
+        """Takes df as the contents the next write is compared against."""
+        if self._sheet_config is not None:
+            self._observe_sheet(df)
+        if self._journal is not None:
+            self._journal.observe(df)
+        return
+
+    def _observe_sheet(self, df):
+        self._sheet_snapshot = sheet_diff.SheetSnapshot(
+            df, datetime_format=self._sheet_config.get('datetime_format'),
+            index_column=self._sheet_config.get('index_column'))
+        return
+
+    def _forget_observed(self):
+        """The next write can't be compared against anything; it's written in full."""
+        self._sheet_snapshot = None
+        if self._journal is not None:
+            self._journal.forget()
+        return
+
+    def _read(self, force=False):
+        df = _get_pending_df(self)
+        if df is not None:
+            # as it will be once the session writes it
+            self._observe(df)
+            return df
+
+        if self._columnar is not None:
+            df = columnar_file.read(
+                self._columnar['path'], self._columnar['format'],
+                index_column=self._columnar.get('index_column'),
+                list_columns=self._columnar.get('list_columns', []),
+                datetime_columns=self._columnar.get('datetime_columns', []))
+        elif self._sheet_config is not None and not force:
+            df = sheet_cache.get_instance().read(
+                self.get_name(), self._sheet_config['path'],
+                lambda: super(Doc, self)._read(force))
+        else:
+            df = super(Doc, self)._read(force)
+        self._observe(df)
+        return df
+
+    def _write_back(self, df):
+        if _defer_write_back(self, df):
+            return
+
+        if self._columnar is not None:
+            columnar_file.write(df, self._columnar['path'], self._columnar['format'])
+        elif self._sheet_snapshot is not None and self._sheet_snapshot.matches_structure(df):
+            self._write_sheet_diff(df)
+        else:
+            super(Doc, self)._write_back(df)
+            if self._sheet_config is not None:
+                self._observe_sheet(df)
+        if self._sheet_config is not None:
+            sheet_cache.get_instance().written(self.get_name(), self._sheet_config['path'], df)
+        if self._journal is not None:
+            self._journal.record(df)
+        return
+
+    def _write_sheet_diff(self, df):
+        spreadsheet_id = sheet_cache.get_instance().get_file_id(self._sheet_config['path'])
+
+        num_cells = sheet_diff.write_diff(
+            self._sheet_snapshot, df, spreadsheet_id, self._sheet_config['sheet'],
+            header_row=self._sheet_config.get('header', 0) + 1)
+        print(f'{self.get_name()}: {num_cells} cells changed')
+        return
+
+    def get_backup_versions(self) -> pd.DataFrame:
+        if self._journal is None:
+            raise ValueError(f'{self.get_name()} does not keep journal backups')
+        return self._journal.get_versions()
+
+    def restore(self, at=None):
+        """Replaces the contents with the version written at time at; write() to keep it."""
+        if self._journal is None:
+            raise ValueError(f'{self.get_name()} does not keep journal backups')
+        self.set_df(self._journal.restore(at))
+        return
+
 class SpotifyPlaylist(ct.Container):
+    """len() and has_changed() are answered from the playlist's metadata (track count and
+       snapshot ID) as long as the tracks haven't been loaded."""
+    _flush_rank = 2
+
     def __init__(self, name: str, modify=True, create=False, overwrite=False):
         self._playlist_name = name
+        # snapshot_id of the playlist when its tracks were read
+        self._snapshot_id = None
         super(SpotifyPlaylist, self).__init__(
             f"Spotify playlist {name}",
             modify=modify, create=create, overwrite=overwrite)
         return
 
+    def __len__(self):
+        if self._df is None:
+            # a write deferred by the session isn't on Spotify yet
+            pending_df = _get_pending_df(self)
+            if pending_df is not None:
+                return len(pending_df)
+            if not self.exists():
+                return 0
+            return djlib_config.spotify.get_playlist_metadata(self._playlist_name)['total']
+        return super(SpotifyPlaylist, self).__len__()
+
+    def has_changed(self):
+        """Whether the playlist changed on Spotify since its tracks were read."""
+        if self._snapshot_id is None:
+            return False
+        return djlib_config.spotify.get_playlist_metadata(
+            self._playlist_name)['snapshot_id'] != self._snapshot_id
+
     def _get_index_name(self):
         return 'spotify_id'
 
@@ -102,19 +549,53 @@ class SpotifyPlaylist(ct.Container):
         return djlib_config.spotify.playlist_exists(self._playlist_name)
 
     def _read(self, force=False):
+        df = _get_pending_df(self)
+        if df is not None:
+            return df
+
+        # the snapshot before the tracks; a change in between shows up as a change later
+        self._snapshot_id = djlib_config.spotify.get_playlist_metadata(self._playlist_name)['snapshot_id']
         return djlib_config.spotify.get_playlist_tracks(self._playlist_name)
 
     def _write_back(self, df):
+        if _defer_write_back(self, df):
+            return
+
         if not self._exists:
             djlib_config.spotify.create_playlist(self._playlist_name)
         djlib_config.spotify.replace_tracks_in_playlist(self._playlist_name, df)
+        self._snapshot_id = djlib_config.spotify.get_playlist_metadata(self._playlist_name)['snapshot_id']
         return
 
 class SpotifyLiked(ct.Container):
+    """len() and has_changed() are answered from a one-item request (track count and latest
+       track) as long as the tracks haven't been loaded.
+       Writing sends only the tracks added and removed since the tracks were read, compared
+       to the IDs read then. The liked tracks are downloaded again only if they changed on
+       Spotify in the meantime, in which case those changes are kept."""
+    _flush_rank = 2
+
     def __init__(self):
+        # metadata and IDs of the liked tracks when they were read or last written
+        self._metadata = None
+        self._liked_ids = None
         super(SpotifyLiked, self).__init__('Spotify Liked Tracks', modify=True, create=False, overwrite=False)
         return
 
+    def __len__(self):
+        if self._df is None:
+            pending_df = _get_pending_df(self)
+            if pending_df is not None:
+                return len(pending_df)
+            return djlib_config.spotify.get_liked_tracks_count()
+        return super(SpotifyLiked, self).__len__()
+
+    def has_changed(self):
+        """Whether the liked tracks changed on Spotify since they were read."""
+        if self._metadata is None:
+            return False
+        return djlib_config.spotify.get_liked_tracks_metadata() != self._metadata
+
     def _get_index_name(self):
         return 'spotify_id'
 
@@ -122,22 +603,44 @@ class SpotifyLiked(ct.Container):
         return True
 
     def _read(self, force=False):
-        return djlib_config.spotify.get_liked_tracks()
+        df = _get_pending_df(self)
+        if df is not None:
+            return df
+
+        self._metadata = djlib_config.spotify.get_liked_tracks_metadata()
+        df = djlib_config.spotify.get_liked_tracks()
+        self._liked_ids = df.index.copy()
+        return df
 
     def _write_back(self, df):
-        liked_tracks = djlib_config.spotify.get_liked_tracks()
+        if _defer_write_back(self, df):
+            return
+
+        if self._liked_ids is None:
+            liked_ids = djlib_config.spotify.get_liked_tracks().index
+            tracks_to_add = df.index.difference(liked_ids, sort=False)
+            tracks_to_remove = liked_ids.difference(df.index, sort=False)
+        else:
+            tracks_to_add = df.index.difference(self._liked_ids, sort=False)
+            tracks_to_remove = self._liked_ids.difference(df.index, sort=False)
 
-        tracks_to_add = df.index.difference(liked_tracks.index, sort=False)
-        tracks_to_remove = liked_tracks.index.difference(df.index, sort=False)
+            if (len(tracks_to_add) > 0 or len(tracks_to_remove) > 0) and self.has_changed():
+                # keep the changes made on Spotify; only apply ours on top of them
+                print('Spotify Liked Tracks changed since they were read; reading them again')
+                liked_ids = djlib_config.spotify.get_liked_tracks().index
+                tracks_to_add = tracks_to_add.difference(liked_ids, sort=False)
+                tracks_to_remove = tracks_to_remove.intersection(liked_ids, sort=False)
 
         if len(tracks_to_add) > 0:
             print(f'Adding {len(tracks_to_add)} Spotify Liked Tracks')
-            djlib_config.spotify.add_liked_tracks(tracks_to_add)
+            djlib_config.spotify.add_liked_tracks(tracks_to_add, skip_liked=False)
 
         if len(tracks_to_remove) > 0:
             print(f'Removing {len(tracks_to_remove)} Spotify Liked Tracks')
             djlib_config.spotify.remove_liked_tracks(tracks_to_remove)
 
+        self._liked_ids = df.index.copy()
+        self._metadata = djlib_config.spotify.get_liked_tracks_metadata()
         return
 
 
@@ -163,6 +666,8 @@ class RekordboxCollection(ct.Container):
 
 
 class RekordboxPlaylist(ct.Container):
+    _flush_rank = 3
+
     def __init__(self, name: str, modify=True, create=False, overwrite=False):
         self._playlist_name = name
         super(RekordboxPlaylist, self).__init__(
@@ -177,9 +682,16 @@ class RekordboxPlaylist(ct.Container):
         return djlib_config.rekordbox.playlist_exists(self._playlist_name)
 
     def _read(self, force=False):
+        df = _get_pending_df(self)
+        if df is not None:
+            return df
+
         return djlib_config.rekordbox.get_playlist_tracks(self._playlist_name)
 
     def _write_back(self, df, write_thru=True):
+        if _defer_write_back(self, df):
+            return
+
         djlib_config.rekordbox.create_playlist(self._playlist_name, df, overwrite=True)
         if write_thru:
             djlib_config.rekordbox.write()
@@ -188,15 +700,22 @@ class RekordboxPlaylist(ct.Container):
 
 
 class Queue(Doc):
-    """A special doc for the Spotify queue; it sets added_at to now() when adding tracks."""
+    """A special doc for the Spotify queue; it sets added_at to now() when adding tracks.
+       It keeps journal backups unless a number of rotating backups is given."""
     def __init__(
             self,
             name: str = 'queue', *,
             modify=True,
             create=True,
             overwrite=True,
-            backups=5,
+            backups=None,
+            journal=None,
             **kwargs):
+        if backups is None:
+            if journal is None:
+                journal = True
+            backups = 0 if journal else 5
+
         super(Queue, self).__init__(
             name=name,
             type='csv',
@@ -207,62 +726,229 @@ class Queue(Doc):
             header=0,
             datetime_columns=['release_date', 'added_at'],
             backups=backups,
+            journal=journal,
             **kwargs
         )
 
     def _preprocess_before_append(self, df: pd.DataFrame):
         df = df.assign(added_at=pd.Timestamp.utcnow())
-        return df
+        return _fill_appended_track_metadata(self, df)
+
+    def get_df_with_metadata(self, columns=None, hydrate=True) -> pd.DataFrame:
+        """The tracks with popularity, album and release date filled in from the track
+           store (see spotify_track_store)."""
+        return spotify_track_store.get_instance().fill_metadata(
+            self.get_df(), columns=columns, hydrate=hydrate)
 
 
 class ListeningHistory(Doc):
     """A special doc for the listening history. It supports filtering by signature along with ID,
-       plus it prohibits some operations that don't make sense."""
+       plus it prohibits some operations that don't make sense.
+       With storage = segments in its config section, it's kept in an append-only log
+       partitioned by month (see segmented_log) instead of being rewritten on every write;
+       the configured CSV is then only written by export_csv().
+       The track signatures are kept in a spotify_id -> signature index that's pickled next to
+       the other data files, so only tracks that are new since the last time need their
+       signatures computed; lookups go through a set."""
+
+    _flush_rank = 0
 
     def __init__(
             self,
             name: str = 'listening_history'):
+        self._segments = None
+        kwargs = {}
+        if djlib_config.doc_storage.get(name) == 'segments':
+            self._segments = SegmentedLog(
+                os.path.join(djlib_config.default_dir, f'{name}-segments'),
+                index_column='spotify_id',
+                partition_column='added_at',
+                datetime_columns=['release_date', 'added_at'])
+            # the log is its own history
+            kwargs['backups'] = 0
+
         super(ListeningHistory, self).__init__(
             name=name,
             modify=True,
             create=False,
             overwrite=False,
-            index_name='spotify_id'
+            index_name='spotify_id',
+            **kwargs
         )
 
+        # spotify_id -> signature, loaded from the index file
+        self._signature_by_id = None
         self._track_signatures = None
+        # the DF the signatures were brought up to date with
+        self._signatures_df = None
 
     def _rvalue_check(self, operation):
         raise ValueError(
             'ListeningHistory should not be added to or removed from other containers')
 
+    def _check_existence(self):
+        if self._segments is not None and self._segments.exists():
+            return True
+        return super(ListeningHistory, self)._check_existence()
+
+    def getmtime(self):
+        if self._segments is not None and self._segments.exists():
+            return self._segments.getmtime()
+        return super(ListeningHistory, self).getmtime()
+
+    def _read(self, force=False):
+        if self._segments is None:
+            return super(ListeningHistory, self)._read(force)
+
+        df = _get_pending_df(self)
+        if df is not None:
+            self._observe(df)
+            return df
+
+        if not self._segments.exists():
+            # first use: seed the log from the CSV
+            df = super(ListeningHistory, self)._read(force)
+            print(f'{self.get_name()}: moving {len(df)} tracks to segmented storage')
+            self._segments.rewrite(df)
+            return df
+
+        return self._segments.read()
+
+    def _write_back(self, df):
+        if self._segments is None:
+            return super(ListeningHistory, self)._write_back(df)
+
+        if _defer_write_back(self, df):
+            return
+
+        num_rows = self._segments.write(df)
+        logger.debug('%s: %d rows appended', self.get_name(), num_rows)
+        return
+
+    def compact(self):
+        if self._segments is None:
+            raise ValueError(f'{self.get_name()} does not use segmented storage')
+        self._segments.compact(self.get_df())
+        return
+
+    def export_csv(self):
+        """Writes the whole history to the configured CSV."""
+        if self._segments is None:
+            raise ValueError(f'{self.get_name()} does not use segmented storage')
+        # straight to the CSV, even inside a session
+        ct.Doc._write_back(self, self.get_df())
+        return
+
     def _preprocess_before_append(self, df: pd.DataFrame):
         df = df.assign(added_at=pd.Timestamp.utcnow())
-        return df
+        return _fill_appended_track_metadata(self, df)
+
+    def get_df_with_metadata(self, columns=None, hydrate=True) -> pd.DataFrame:
+        """The tracks with popularity, album and release date filled in from the track
+           store (see spotify_track_store)."""
+        return spotify_track_store.get_instance().fill_metadata(
+            self.get_df(), columns=columns, hydrate=hydrate)
 
     def append(self, other, prompt=None, silent=False):
         super(ListeningHistory, self).append(other, prompt=prompt, silent=silent)
 
-        self._track_signatures = None
+        # the signatures of the new tracks are added on the next lookup
+        self._signatures_df = None
         return
 
     def remove(self, other, prompt=None, force=False, silent=False):
         if not force:
             raise ValueError('Why remove from listening history?')
         super(ListeningHistory, self).remove(other, prompt=prompt, silent=silent)
+        self._signatures_df = None
+
+    def _get_signature_index_path(self):
+        return os.path.join(djlib_config.default_dir, f'{self.get_name()}-signatures.pickle')
+
+    def _load_signature_index(self):
+        path = self._get_signature_index_path()
+        if not os.path.exists(path):
+            return {}
+
+        try:
+            with open(path, 'rb') as index_file:
+                return pickle.load(index_file)
+        except Exception as e:
+            logger.warning('Could not read the listening history signature index %s: %s; '
+                           'rebuilding it', path, str(e))
+            return {}
+
+    def _save_signature_index(self):
+        path = self._get_signature_index_path()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as index_file:
+            pickle.dump(self._signature_by_id, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return
 
     def _ensure_track_signatures(self):
         self._ensure_df()
 
-        self._track_signatures = pd.Index(
-            self._df.apply(
-                get_track_signature,
-                axis=1
-            )
-        )
+        if self._signatures_df is self._df:
+            return
+
+        if self._signature_by_id is None:
+            self._signature_by_id = self._load_signature_index()
+            self._track_signatures = None
+
+        indexed_ids = pd.Index(list(self._signature_by_id.keys()), dtype=object)
+        new_ids = self._df.index.difference(indexed_ids, sort=False)
+        removed_ids = indexed_ids.difference(self._df.index, sort=False)
+
+        if len(new_ids) > 0:
+            new_tracks = self._df.loc[self._df.index.isin(new_ids)]
+            new_signatures = get_track_signatures(new_tracks)
+            self._signature_by_id.update(zip(new_signatures.index, new_signatures))
+
+            if self._track_signatures is not None:
+                self._track_signatures.update(new_signatures)
+
+        for spotify_id in removed_ids:
+            del self._signature_by_id[spotify_id]
+
+        if self._track_signatures is None or len(removed_ids) > 0:
+            self._track_signatures = set(self._signature_by_id.values())
 
+        if len(new_ids) > 0 or len(removed_ids) > 0:
+            logger.debug('Listening history signature index: %d added, %d removed',
+                         len(new_ids), len(removed_ids))
+            self._save_signature_index()
+
+        self._signatures_df = self._df
         return
 
+    def _in_history(self, index: pd.Index) -> np.ndarray:
+        # get_indexer uses the hash table that the history index keeps between calls,
+        # so the cost is in the size of index rather than of the history
+        if self._df.index.is_unique:
+            return self._df.index.get_indexer(index) != -1
+        return index.isin(self._df.index)
+
+    def _signature_listened(self, tracks: pd.DataFrame) -> np.ndarray:
+        signatures = get_track_signatures(tracks)
+        return np.fromiter((signature in self._track_signatures for signature in signatures),
+                           dtype=bool, count=len(signatures))
+
+    def is_listened(self, tracks: pd.DataFrame) -> np.ndarray:
+        """Returns a boolean array telling which of the tracks (a DF indexed by spotify_id)
+           are in the listening history, by spotify ID or by track signature."""
+        self._ensure_df()
+
+        listened = self._in_history(tracks.index)
+
+        if len(tracks) == 0 or listened.all():
+            return listened
+
+        self._ensure_track_signatures()
+        listened |= self._signature_listened(tracks)
+
+        return listened
+
     def filter(self, other: ct.Container, prompt=None, silent=False):
         self._ensure_track_signatures()
 
@@ -278,21 +964,14 @@ class ListeningHistory(Doc):
             raise ValueError('Only Spotify tracks indexed by spotify_id can be filtered '
                              'through listening history')
 
-        other_not_listened_index = other_df.index.difference(self._df.index, sort=False)
-        filtered_through_spotify_id = len(other_df.index) - len(other_not_listened_index)
+        listened_by_spotify_id = self._in_history(other_df.index)
+        filtered_through_spotify_id = int(listened_by_spotify_id.sum())
 
         if filtered_through_spotify_id != 0:
-            other_df = other_df.loc[other_not_listened_index]
+            other_df = other_df.loc[~listened_by_spotify_id]
 
-        # for some reason Pandas.apply doesn't work correctly if the dataframe is empty;
-        # it returns an empty dataframe instead of a boolean array
         if len(other_df) > 0:
-            other_not_listened_sigs = other_df.apply(
-                lambda track: get_track_signature(track) not in self._track_signatures,
-                axis=1
-            )
-
-            other_df_not_listened_sigs = other_df.loc[other_not_listened_sigs]
+            other_df_not_listened_sigs = other_df.loc[~self._signature_listened(other_df)]
 
             filtered_through_track_sigs = len(other_df) - len(other_df_not_listened_sigs)
 
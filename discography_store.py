@@ -0,0 +1,551 @@
+"""
+Single-file SQLite store for the Spotify discography.
+
+It replaces the per-entity CSV directories (spotify-artist-albums, spotify-album-tracks and
+spotify-artist-tracks) that spotify_discography used to keep. Those meant a directory scan
+and a CSV parse for every artist or album that was opened.
+
+Tables:
+- albums: one row per album, plus the time its tracks were fetched (NULL if never)
+- album_tracks: the tracks of every fetched album
+- track_artists: (album_id, spotify_id, artist_id) for every artist credited on a track
+- artist_albums: the artist -> album links returned by artists/{id}/albums, with the
+  album group (album, single, compilation, appears_on) relative to the artist, and the
+  album fetch policy that decided the album's tracks weren't worth fetching, if one did
+- artist_refresh: when an artist's albums and tracks were last checked, plus when the
+  full album list was last fetched and the album total Spotify reported then
+- refresh_progress: checkpoints of multi-artist refresh runs, so they can resume
+
+An artist's discography is the tracks of the artist's albums on which the artist is
+credited; that's one indexed join.
+"""
+
+import logging
+import os
+import os.path
+import re
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+_ALBUM_COLUMNS = ['album_id', 'name', 'artist_ids', 'artist_names', 'popularity', 'album_type',
+                  'release_date', 'total_tracks']
+
+_TRACK_COLUMNS = ['spotify_id', 'name', 'artist_ids', 'artist_names', 'duration_ms',
+                  'release_date', 'popularity', 'added_at', 'album_id', 'album_name']
+
+_DATETIME_COLUMNS = ['release_date', 'added_at']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS albums (
+    album_id TEXT PRIMARY KEY,
+    name TEXT,
+    artist_ids TEXT,
+    artist_names TEXT,
+    popularity REAL,
+    album_type TEXT,
+    release_date TEXT,
+    total_tracks INTEGER,
+    tracks_fetched_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS album_tracks (
+    album_id TEXT NOT NULL,
+    spotify_id TEXT NOT NULL,
+    name TEXT,
+    artist_ids TEXT,
+    artist_names TEXT,
+    duration_ms INTEGER,
+    release_date TEXT,
+    popularity REAL,
+    added_at TEXT,
+    album_name TEXT,
+    PRIMARY KEY (album_id, spotify_id)
+);
+
+CREATE TABLE IF NOT EXISTS track_artists (
+    album_id TEXT NOT NULL,
+    spotify_id TEXT NOT NULL,
+    artist_id TEXT NOT NULL,
+    PRIMARY KEY (album_id, artist_id, spotify_id)
+);
+
+CREATE TABLE IF NOT EXISTS artist_albums (
+    artist_id TEXT NOT NULL,
+    album_id TEXT NOT NULL,
+    album_group TEXT,
+    skipped_by TEXT,
+    PRIMARY KEY (artist_id, album_id)
+);
+
+CREATE INDEX IF NOT EXISTS artist_albums_by_album ON artist_albums (album_id);
+CREATE INDEX IF NOT EXISTS track_artists_by_artist ON track_artists (artist_id, album_id);
+CREATE INDEX IF NOT EXISTS album_tracks_by_release_date ON album_tracks (release_date);
+CREATE INDEX IF NOT EXISTS albums_by_release_date ON albums (release_date);
+
+CREATE TABLE IF NOT EXISTS refresh_progress (
+    run_name TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    artist_id TEXT NOT NULL,
+    done_at REAL,
+    PRIMARY KEY (run_name, stage, artist_id)
+);
+
+CREATE TABLE IF NOT EXISTS artist_refresh (
+    artist_id TEXT PRIMARY KEY,
+    artist_name TEXT,
+    albums_checked_at REAL,
+    tracks_checked_at REAL,
+    albums_fetched_at REAL,
+    album_total INTEGER
+);
+"""
+
+# columns added after the first version of the schema: (table, column, type)
+_ADDED_COLUMNS = [
+    ('artist_refresh', 'albums_fetched_at', 'REAL'),
+    ('artist_refresh', 'album_total', 'INTEGER'),
+    ('artist_albums', 'album_group', 'TEXT'),
+    ('artist_albums', 'skipped_by', 'TEXT'),
+]
+
+
+def _to_sql_value(value):
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return value.item()
+    return value
+
+
+def _to_utc(value) -> pd.Timestamp:
+    # naive times are taken to be UTC
+    value = pd.Timestamp(value)
+    return value.tz_localize('UTC') if value.tz is None else value.tz_convert('UTC')
+
+
+def _records(df: pd.DataFrame, columns):
+    return [
+        tuple(_to_sql_value(value) for value in row)
+        for row in df.reindex(columns=columns).itertuples(index=False, name=None)
+    ]
+
+
+def _postprocess(df: pd.DataFrame, index_column):
+    for column in _DATETIME_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column], utc=True, format='ISO8601')
+    df = df.set_index(index_column, drop=False)
+    return df
+
+
+class DiscographyStore:
+    def __init__(self, path):
+        self._path = path
+        self.is_new = not os.path.exists(path)
+
+        # the connection is shared between the threads of a parallel refresh;
+        # all access goes through the lock
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._add_missing_columns()
+        self._conn.commit()
+        return
+
+    def _add_missing_columns(self):
+        for table, column, column_type in _ADDED_COLUMNS:
+            existing_columns = [row[1] for row in self._conn.execute(f'PRAGMA table_info({table})')]
+            if column not in existing_columns:
+                self._conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+        return
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _query(self, sql, params=(), index_column=None):
+        with self._lock:
+            df = pd.read_sql_query(sql, self._conn, params=params)
+        if index_column is not None:
+            df = _postprocess(df, index_column)
+        return df
+
+    def _scalar(self, sql, params=()):
+        with self._lock:
+            row = self._conn.execute(sql, params).fetchone()
+        return None if row is None else row[0]
+
+    # Albums
+
+    def get_artist_albums(self, artist_id) -> pd.DataFrame:
+        return self._query(
+            f'SELECT {", ".join("a." + c for c in _ALBUM_COLUMNS)} '
+            f'FROM artist_albums aa JOIN albums a ON a.album_id = aa.album_id '
+            f'WHERE aa.artist_id = ? ORDER BY aa.rowid',
+            (artist_id,),
+            index_column='album_id')
+
+    def get_artist_album_count(self, artist_id) -> int:
+        return self._scalar('SELECT COUNT(*) FROM artist_albums WHERE artist_id = ?', (artist_id,))
+
+    def add_artist_albums(self, artist_id, albums: pd.DataFrame, replace=False):
+        """Stores the albums and links them to the artist. With replace=True, the artist's
+           existing links are dropped first."""
+        with self._lock, self._conn:
+            if replace:
+                self._conn.execute('DELETE FROM artist_albums WHERE artist_id = ?', (artist_id,))
+            self._put_albums(albums)
+            album_groups = albums['album_group'] if 'album_group' in albums.columns \
+                else pd.Series(None, index=albums.index, dtype=object)
+            self._conn.executemany(
+                'INSERT INTO artist_albums (artist_id, album_id, album_group) VALUES (?, ?, ?) '
+                'ON CONFLICT (artist_id, album_id) DO UPDATE SET '
+                'album_group = COALESCE(excluded.album_group, album_group)',
+                [(artist_id, album_id, _to_sql_value(album_group))
+                 for album_id, album_group in zip(albums.index, album_groups)])
+        return
+
+    def _put_albums(self, albums: pd.DataFrame):
+        # keep tracks_fetched_at of albums that are already there
+        self._conn.executemany(
+            f'INSERT INTO albums ({", ".join(_ALBUM_COLUMNS)}) '
+            f'VALUES ({", ".join("?" * len(_ALBUM_COLUMNS))}) '
+            f'ON CONFLICT (album_id) DO UPDATE SET '
+            + ', '.join(f'{c} = excluded.{c}' for c in _ALBUM_COLUMNS[1:]),
+            _records(albums, _ALBUM_COLUMNS))
+        return
+
+    # Album tracks
+
+    def album_tracks_fetched(self, album_id) -> bool:
+        return self._scalar('SELECT tracks_fetched_at FROM albums WHERE album_id = ?',
+                            (album_id,)) is not None
+
+    def get_unfetched_albums(self, artist_id, skipped_by=None) -> pd.DataFrame:
+        """Returns the artist's albums whose tracks were never fetched, with album_group and
+           artist_id. skipped_by: leave out the albums that this policy skipped before."""
+        return self._query(
+            f'SELECT {", ".join("a." + c for c in _ALBUM_COLUMNS)}, aa.album_group, aa.artist_id '
+            f'FROM artist_albums aa JOIN albums a ON a.album_id = aa.album_id '
+            f'WHERE aa.artist_id = ? AND a.tracks_fetched_at IS NULL '
+            f'AND (aa.skipped_by IS NULL OR aa.skipped_by IS NOT ?) ORDER BY aa.rowid',
+            (artist_id, skipped_by),
+            index_column='album_id')
+
+    def mark_skipped(self, links, skipped_by):
+        """Records that the policy skipped the (artist_id, album_id) links."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'UPDATE artist_albums SET skipped_by = ? WHERE artist_id = ? AND album_id = ?',
+                [(skipped_by, artist_id, album_id) for artist_id, album_id in links])
+        return
+
+    def get_album_tracks(self, album_id) -> pd.DataFrame:
+        return self._query(
+            f'SELECT {", ".join(_TRACK_COLUMNS)} FROM album_tracks WHERE album_id = ? '
+            f'ORDER BY rowid',
+            (album_id,),
+            index_column='spotify_id')
+
+    def put_album_tracks(self, album_id, tracks: pd.DataFrame, fetched_at=None):
+        """Stores the complete track list of an album and marks the album as fetched."""
+        if fetched_at is None:
+            fetched_at = time.time()
+
+        with self._lock, self._conn:
+            if len(tracks) > 0:
+                self._put_tracks(tracks)
+            self._conn.execute(
+                'INSERT INTO albums (album_id, tracks_fetched_at) VALUES (?, ?) '
+                'ON CONFLICT (album_id) DO UPDATE SET tracks_fetched_at = excluded.tracks_fetched_at',
+                (album_id, fetched_at))
+        return
+
+    def _put_tracks(self, tracks: pd.DataFrame):
+        self._conn.executemany(
+            f'INSERT OR REPLACE INTO album_tracks ({", ".join(_TRACK_COLUMNS)}) '
+            f'VALUES ({", ".join("?" * len(_TRACK_COLUMNS))})',
+            _records(tracks, _TRACK_COLUMNS))
+
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO track_artists (album_id, spotify_id, artist_id) VALUES (?, ?, ?)',
+            [
+                (album_id, spotify_id, artist_id)
+                for album_id, spotify_id, artist_ids in zip(
+                    tracks['album_id'], tracks['spotify_id'], tracks['artist_ids'])
+                if isinstance(artist_ids, str)
+                for artist_id in artist_ids.split('|')
+            ])
+        return
+
+    # Artist tracks
+
+    def get_artist_tracks(self, artist_id) -> pd.DataFrame:
+        return self._query(
+            f'SELECT {", ".join("t." + c for c in _TRACK_COLUMNS)} '
+            f'FROM artist_albums aa '
+            f'JOIN track_artists ta ON ta.album_id = aa.album_id AND ta.artist_id = aa.artist_id '
+            f'JOIN album_tracks t ON t.album_id = ta.album_id AND t.spotify_id = ta.spotify_id '
+            f'WHERE aa.artist_id = ? ORDER BY aa.rowid, t.rowid',
+            (artist_id,),
+            index_column='spotify_id')
+
+    def query_tracks(self, *, artist_ids=None, released_after=None, released_before=None,
+                     album_types=None) -> pd.DataFrame:
+        """
+        Returns the discography tracks of all the artists matching the filters in one query,
+        each track once, with the album_type of its album added.
+        artist_ids: only tracks of these artists (all artists if None)
+        released_after / released_before: release date range, both inclusive; naive
+                                          times are taken to be UTC
+        album_types: e.g. ['album', 'single']
+        """
+        joins = ''
+        conditions = []
+        params = []
+
+        if released_after is not None:
+            conditions.append('t.release_date >= ?')
+            params.append(_to_sql_value(_to_utc(released_after)))
+        if released_before is not None:
+            conditions.append('t.release_date <= ?')
+            params.append(_to_sql_value(_to_utc(released_before)))
+        if album_types is not None:
+            album_types = list(album_types)
+            conditions.append(f'a.album_type IN ({", ".join("?" * len(album_types))})')
+            params += album_types
+
+        with self._lock:
+            if artist_ids is not None:
+                # the artist set can be larger than SQLite's parameter limit
+                self._conn.execute(
+                    'CREATE TEMP TABLE IF NOT EXISTS query_artists (artist_id TEXT PRIMARY KEY)')
+                self._conn.execute('DELETE FROM query_artists')
+                self._conn.executemany('INSERT OR IGNORE INTO query_artists VALUES (?)',
+                                       [(artist_id,) for artist_id in artist_ids])
+                joins = 'JOIN query_artists q ON q.artist_id = ta.artist_id '
+
+            df = self._query(
+                f'SELECT DISTINCT {", ".join("t." + c for c in _TRACK_COLUMNS)}, a.album_type '
+                f'FROM track_artists ta '
+                f'{joins}'
+                f'JOIN artist_albums aa ON aa.artist_id = ta.artist_id AND aa.album_id = ta.album_id '
+                f'JOIN album_tracks t ON t.album_id = ta.album_id AND t.spotify_id = ta.spotify_id '
+                f'JOIN albums a ON a.album_id = t.album_id '
+                f'{"WHERE " + " AND ".join(conditions) if conditions else ""}',
+                tuple(params),
+                index_column='spotify_id')
+
+        return df
+
+    # Refresh times
+
+    def get_refresh_times(self, artist_id):
+        """Returns (albums_checked_at, tracks_checked_at) as UNIX times; None for never."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT albums_checked_at, tracks_checked_at FROM artist_refresh WHERE artist_id = ?',
+                (artist_id,)).fetchone()
+        return (None, None) if row is None else row
+
+    def get_album_fetch_info(self, artist_id):
+        """Returns (albums_fetched_at, album_total) from the last full album fetch;
+           None for never or unknown."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT albums_fetched_at, album_total FROM artist_refresh WHERE artist_id = ?',
+                (artist_id,)).fetchone()
+        return (None, None) if row is None else row
+
+    def set_album_fetch_info(self, artist_id, artist_name, fetched_at, album_total):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO artist_refresh (artist_id, artist_name, albums_fetched_at, album_total) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT (artist_id) DO UPDATE SET '
+                'artist_name = excluded.artist_name, '
+                'albums_fetched_at = excluded.albums_fetched_at, '
+                'album_total = excluded.album_total',
+                (artist_id, artist_name, fetched_at, album_total))
+        return
+
+    def set_refresh_time(self, artist_id, artist_name, *, albums=None, tracks=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO artist_refresh (artist_id, artist_name) VALUES (?, ?) '
+                'ON CONFLICT (artist_id) DO UPDATE SET artist_name = excluded.artist_name',
+                (artist_id, artist_name))
+            if albums is not None:
+                self._conn.execute(
+                    'UPDATE artist_refresh SET albums_checked_at = ? WHERE artist_id = ?',
+                    (albums, artist_id))
+            if tracks is not None:
+                self._conn.execute(
+                    'UPDATE artist_refresh SET tracks_checked_at = ? WHERE artist_id = ?',
+                    (tracks, artist_id))
+        return
+
+    def get_artist_refresh_stats(self) -> pd.DataFrame:
+        """Returns, for every artist that was ever refreshed: albums_checked_at (UNIX time),
+           num_releases (distinct release dates), first_release and last_release."""
+        df = self._query(
+            'SELECT r.artist_id, r.albums_checked_at, '
+            'COUNT(DISTINCT a.release_date) AS num_releases, '
+            'MIN(a.release_date) AS first_release, MAX(a.release_date) AS last_release '
+            'FROM artist_refresh r '
+            'LEFT JOIN artist_albums aa ON aa.artist_id = r.artist_id '
+            'LEFT JOIN albums a ON a.album_id = aa.album_id '
+            'GROUP BY r.artist_id')
+        for column in ['first_release', 'last_release']:
+            df[column] = pd.to_datetime(df[column], utc=True, format='ISO8601')
+        return df.set_index('artist_id')
+
+    # Checkpoints of multi-artist refreshes
+
+    def get_progress(self, run_name, stage) -> set:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT artist_id FROM refresh_progress WHERE run_name = ? AND stage = ?',
+                (run_name, stage)).fetchall()
+        return {row[0] for row in rows}
+
+    def mark_progress(self, run_name, stage, artist_ids):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO refresh_progress (run_name, stage, artist_id, done_at) '
+                'VALUES (?, ?, ?, ?)',
+                [(run_name, stage, artist_id, now) for artist_id in artist_ids])
+        return
+
+    def clear_progress(self, run_name):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM refresh_progress WHERE run_name = ?', (run_name,))
+        return
+
+    # Migration
+
+    def migrate_from_csv_dirs(self, base_dir):
+        """One-shot import of the spotify-artist-albums, spotify-album-tracks and
+           spotify-artist-tracks directories under base_dir. File mtimes become
+           the refresh and fetch times."""
+
+        def list_files(doc_type):
+            doc_dir = os.path.join(base_dir, 'spotify-' + doc_type)
+            if not os.path.isdir(doc_dir):
+                return []
+            pattern = re.compile(r'^%s-([0-9A-Za-z]+)-(.*)\.csv$' % doc_type)
+            result = []
+            for file in os.listdir(doc_dir):
+                m = pattern.match(file)
+                if m is not None:
+                    path = os.path.join(doc_dir, file)
+                    result.append((m.group(1), m.group(2), path, os.path.getmtime(path)))
+            return result
+
+        def read_csv(path):
+            df = pd.read_csv(path)
+            for column in _DATETIME_COLUMNS:
+                if column in df.columns:
+                    df[column] = pd.to_datetime(df[column], utc=True, format='ISO8601')
+            return df
+
+        album_tracks_files = list_files('album-tracks')
+        artist_albums_files = list_files('artist-albums')
+        artist_tracks_files = list_files('artist-tracks')
+
+        print(f'Migrating {len(album_tracks_files)} album tracks files, '
+              f'{len(artist_albums_files)} artist albums files and '
+              f'{len(artist_tracks_files)} artist tracks files into {self._path}')
+
+        with self._lock, self._conn:
+            for album_id, _, path, mtime in album_tracks_files:
+                tracks = read_csv(path)
+                if len(tracks) > 0:
+                    self._put_tracks(tracks)
+                self._conn.execute(
+                    'INSERT INTO albums (album_id, tracks_fetched_at) VALUES (?, ?) '
+                    'ON CONFLICT (album_id) DO UPDATE SET tracks_fetched_at = excluded.tracks_fetched_at',
+                    (album_id, mtime))
+
+            for artist_id, artist_name, path, mtime in artist_albums_files:
+                albums = read_csv(path)
+                if len(albums) > 0:
+                    self._put_albums(albums)
+                    self._conn.executemany(
+                        'INSERT OR IGNORE INTO artist_albums (artist_id, album_id) VALUES (?, ?)',
+                        [(artist_id, album_id) for album_id in albums['album_id']])
+                self._conn.execute(
+                    'INSERT INTO artist_refresh (artist_id, artist_name, albums_checked_at) '
+                    'VALUES (?, ?, ?) ON CONFLICT (artist_id) DO UPDATE SET '
+                    'albums_checked_at = excluded.albums_checked_at',
+                    (artist_id, artist_name, mtime))
+
+            for artist_id, artist_name, path, mtime in artist_tracks_files:
+                # the tracks themselves are in the album tracks files; keep any stragglers
+                tracks = read_csv(path)
+                if len(tracks) > 0:
+                    self._conn.executemany(
+                        f'INSERT OR IGNORE INTO album_tracks ({", ".join(_TRACK_COLUMNS)}) '
+                        f'VALUES ({", ".join("?" * len(_TRACK_COLUMNS))})',
+                        _records(tracks, _TRACK_COLUMNS))
+                    self._conn.executemany(
+                        'INSERT OR IGNORE INTO track_artists (album_id, spotify_id, artist_id) '
+                        'VALUES (?, ?, ?)',
+                        [(album_id, spotify_id, artist_id)
+                         for album_id, spotify_id in zip(tracks['album_id'], tracks['spotify_id'])])
+                self._conn.execute(
+                    'INSERT INTO artist_refresh (artist_id, artist_name, tracks_checked_at) '
+                    'VALUES (?, ?, ?) ON CONFLICT (artist_id) DO UPDATE SET '
+                    'tracks_checked_at = excluded.tracks_checked_at',
+                    (artist_id, artist_name, mtime))
+
+        print('Migration done')
+        return
+
+    def import_tables(self, *, albums=None, artist_albums=None, tracks=None,
+                      fetched_albums=None, artist_refresh=None):
+        """Bulk import in a single transaction, of DFs with the columns of the tables:
+           - albums, tracks: album and album track rows
+           - artist_albums: artist_id, album_id
+           - fetched_albums: album_id, tracks_fetched_at
+           - artist_refresh: artist_id, artist_name, albums_checked_at, tracks_checked_at
+           Existing rows are updated; missing values don't overwrite existing ones."""
+        with self._lock, self._conn:
+            if albums is not None and len(albums) > 0:
+                self._put_albums(albums)
+
+            if artist_albums is not None and len(artist_albums) > 0:
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO artist_albums (artist_id, album_id) VALUES (?, ?)',
+                    _records(artist_albums, ['artist_id', 'album_id']))
+
+            if tracks is not None and len(tracks) > 0:
+                self._put_tracks(tracks)
+
+            if fetched_albums is not None and len(fetched_albums) > 0:
+                self._conn.executemany(
+                    'INSERT INTO albums (album_id, tracks_fetched_at) VALUES (?, ?) '
+                    'ON CONFLICT (album_id) DO UPDATE SET tracks_fetched_at = excluded.tracks_fetched_at',
+                    _records(fetched_albums, ['album_id', 'tracks_fetched_at']))
+
+            if artist_refresh is not None and len(artist_refresh) > 0:
+                self._conn.executemany(
+                    'INSERT INTO artist_refresh '
+                    '(artist_id, artist_name, albums_checked_at, tracks_checked_at) '
+                    'VALUES (?, ?, ?, ?) ON CONFLICT (artist_id) DO UPDATE SET '
+                    'artist_name = COALESCE(excluded.artist_name, artist_name), '
+                    'albums_checked_at = COALESCE(excluded.albums_checked_at, albums_checked_at), '
+                    'tracks_checked_at = COALESCE(excluded.tracks_checked_at, tracks_checked_at)',
+                    _records(artist_refresh,
+                             ['artist_id', 'artist_name', 'albums_checked_at', 'tracks_checked_at']))
+        return
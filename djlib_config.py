@@ -10,7 +10,9 @@ import pandas as pd
 import rekordbox_interface
 import spotify_interface_old
 import spotify_interface
+import spotify_interface_async
 import soundcloud_interface
+import columnar_file
 
 from spyroslib import google_interface
 from spyroslib import containers as ct
@@ -19,16 +21,39 @@ default_dir = None
 
 rekordbox = None
 google = None
+# the cached OAuth token of the google section, resolved like the other interfaces' tokens
+google_token_file = None
+_google_credentials = None
 spotify = None
+spotify_async = None
+spotify_bulk = None
 soundcloud = None
 docs = {}
+# storage backends handled in containers rather than spyroslib, by doc name; e.g. 'segments'
+doc_storage = {}
+# backup modes handled in containers rather than spyroslib, by doc name; e.g. 'journal'
+doc_backup_mode = {}
+# parquet and feather docs, by doc name: the format and the doc's configuration; spyroslib
+# only knows them as csv docs
+doc_columnar = {}
+# the configuration of every doc in the config file, by doc name, with its type
+doc_configs = {}
 _backups = 0
 discography_cache_dir = None
+discography_db = None
 artist_albums_ttl_days = 30
+artist_albums_full_refresh_days = 90
+# discography fetch policy; see spotify_discography._AlbumFetchPolicy
+album_include_groups = None
+compilation_skip_list = []
+appears_on_max_tracks = 40
+track_metadata_ttl_days = 30
 
 # TODO make these configurable
 fuzzy_match_cutoff_threshold = 0.6
 fuzzy_match_automatic_accept_threshold = 0.9
+# compare only strings that share words or trigrams; see fuzzy_matching
+fuzzy_match_blocking = False
 
 _log_file = './djlibman.log'
 _log_level = logging.INFO
@@ -37,12 +62,25 @@ def init(config_file=None):
     global default_dir
     global rekordbox
     global google
+    global google_token_file
     global soundcloud
     global spotify
+    global spotify_async
+    global spotify_bulk
     global discography_cache_dir
+    global discography_db
     global artist_albums_ttl_days
+    global artist_albums_full_refresh_days
+    global album_include_groups
+    global compilation_skip_list
+    global appears_on_max_tracks
+    global track_metadata_ttl_days
     global discography_verbose
     global docs
+    global doc_storage
+    global doc_backup_mode
+    global doc_columnar
+    global doc_configs
     global _backups
     global _log_file
     global _log_level
@@ -103,19 +141,37 @@ def init(config_file=None):
 
         elif section.name == 'google':
             google = google_interface.GoogleInterface(section)
+            google_token_file = os.path.join(
+                os.path.dirname(os.path.realpath(__file__)),
+                section['cached_token_file']
+            )
 
         elif section.name == 'soundcloud':
             soundcloud = soundcloud_interface.SoundcloudInterface(section)
 
         elif section.name == 'spotify':
             spotify = spotify_interface.SpotifyInterface(section)
+            spotify_async = spotify_interface_async.AsyncSpotifyInterface(spotify)
+            spotify_bulk = spotify_interface_async.SyncFacade(spotify_async)
 
         elif section_name == 'spotify_discography':
             for field in section.keys():
                 if field == 'discography_cache_dir':
                     discography_cache_dir = section[field]
+                elif field == 'discography_db':
+                    discography_db = section[field]
                 elif field == 'artist_albums_ttl_days':
                     artist_albums_ttl_days = section.getint(field)
+                elif field == 'artist_albums_full_refresh_days':
+                    artist_albums_full_refresh_days = section.getint(field)
+                elif field == 'album_include_groups':
+                    album_include_groups = [group.strip() for group in section[field].split(',')]
+                elif field == 'compilation_skip_list':
+                    compilation_skip_list = [entry.strip() for entry in section[field].split('|')]
+                elif field == 'appears_on_max_tracks':
+                    appears_on_max_tracks = section.getint(field)
+                elif field == 'track_metadata_ttl_days':
+                    track_metadata_ttl_days = section.getint(field)
                 elif field == 'discography_verbose':
                     discography_verbose = section.getint(field)
                 else:
@@ -133,6 +189,12 @@ def init(config_file=None):
             for field in section.keys():
                 if field in ['type']:
                     continue
+                if field == 'storage':
+                    doc_storage[name] = section[field]
+                    continue
+                if field == 'backup_mode':
+                    doc_backup_mode[name] = section[field]
+                    continue
                 if field in ['path', 'index_column', 'sheet', 'datetime_format']:
                     kwargs[field] = section[field]
                 elif field in ['header', 'backups']:
@@ -142,11 +204,31 @@ def init(config_file=None):
                 else:
                     raise Exception("Unknown field in config section %s: %s" % (section_name, field))
 
+            doc_configs[name] = dict(kwargs, type=type)
+
+            if type in columnar_file.FORMATS:
+                doc_columnar[name] = dict(kwargs, format=type)
+                type = 'csv'
+
             _add_doc(name, type, **kwargs)
 
         else:
             raise Exception("Unrecognized config section: '%s'" % section_name)
 
+def get_google_credentials():
+    """The OAuth credentials of the google section, for the Google APIs called directly
+       rather than through GoogleInterface; loaded once and shared by all of them."""
+    global _google_credentials
+
+    if _google_credentials is None:
+        if google_token_file is None:
+            raise ValueError('No google section in the config file')
+
+        from google.oauth2.credentials import Credentials
+        _google_credentials = Credentials.from_authorized_user_file(google_token_file)
+
+    return _google_credentials
+
 def _add_doc(name, type, **kwargs):
     global google
     global default_dir
@@ -0,0 +1,242 @@
+"""
+Delta backups for docs: a base snapshot plus a journal of row-level changes per write,
+instead of rotating full copies of the file on every write.
+
+Layout, per doc:
+
+    <default_dir>/journals/<doc name>/base-<time>.pickle      the whole DF at <time>
+    <default_dir>/journals/<doc name>/journal-<time>.pickle   the writes after that base
+
+Every write appends one record to the current journal: the time, the IDs of deleted rows,
+and the inserted or changed rows. Rows are compared through per-row hashes computed when
+the doc is read, so unchanged rows cost nothing. A write that reorders rows, inserts rows
+anywhere but at the end, or changes the columns can't be expressed as row changes; it
+starts a new base instead. So does every write of a DF whose index isn't unique, since its
+rows can't be told apart by ID, and a journal that reaches _MAX_RECORDS records.
+The last _KEEP_GENERATIONS bases with their journals are kept, and restore() rebuilds the
+DF as of any time they cover.
+"""
+
+import logging
+import os
+import os.path
+import pickle
+import re
+import time
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+_MAX_RECORDS = 100
+
+_KEEP_GENERATIONS = 3
+
+_BASE_PATTERN = re.compile(r'^base-(\d+\.\d+)\.pickle$')
+
+
+def _row_hashes(df: pd.DataFrame) -> pd.Series:
+    try:
+        return pd.util.hash_pandas_object(df, index=True)
+    except TypeError:
+        # list columns
+        return pd.util.hash_pandas_object(df.astype(str), index=True)
+
+
+def _to_time(at):
+    if at is None:
+        return time.time()
+    if isinstance(at, (int, float)):
+        return float(at)
+    return pd.Timestamp(at).timestamp()
+
+
+class DocJournal:
+    def __init__(self, directory):
+        self._directory = directory
+
+        # state of the doc as last read or written
+        self._index = None
+        self._columns = None
+        self._hashes = None
+        # records in the current journal; counted on first use
+        self._num_records = None
+        return
+
+    def _generations(self):
+        """Returns the base times, oldest first."""
+        if not os.path.isdir(self._directory):
+            return []
+        return sorted(
+            (m.group(1)
+             for m in map(_BASE_PATTERN.match, os.listdir(self._directory))
+             if m is not None),
+            key=float
+        )
+
+    def _base_path(self, generation):
+        return os.path.join(self._directory, f'base-{generation}.pickle')
+
+    def _journal_path(self, generation):
+        return os.path.join(self._directory, f'journal-{generation}.pickle')
+
+    def observe(self, df: pd.DataFrame):
+        """Remembers the state of the doc as read, to compare the next write against."""
+        self._index = df.index.copy()
+        self._columns = list(df.columns)
+        self._hashes = _row_hashes(df)
+        return
+
+    def forget(self):
+        """Forgets the state of the doc; the next write starts a new base."""
+        self._index = None
+        self._columns = None
+        self._hashes = None
+        return
+
+    def record(self, df: pd.DataFrame):
+        """Records a write of df: as row changes if possible, otherwise as a new base."""
+        generations = self._generations()
+
+        if self._hashes is None or len(generations) == 0:
+            self._rebase(df)
+            return
+
+        if list(df.columns) != self._columns:
+            self._rebase(df)
+            return
+
+        if not (df.index.is_unique and self._index.is_unique):
+            self._rebase(df)
+            return
+
+        deleted = ~self._index.isin(df.index)
+        surviving_index = self._index[~deleted]
+
+        # surviving rows must keep their order, and new rows must come after them
+        if not df.index[:len(surviving_index)].equals(surviving_index):
+            self._rebase(df)
+            return
+
+        new_hashes = _row_hashes(df)
+        old_hashes = self._hashes.loc[~deleted].to_numpy()
+        changed = new_hashes.to_numpy()[:len(surviving_index)] != old_hashes
+
+        num_changed = int(changed.sum())
+        num_inserted = len(df) - len(surviving_index)
+        upserted = pd.concat([
+            df.iloc[:len(surviving_index)].loc[changed],
+            df.iloc[len(surviving_index):]
+        ])
+
+        if len(upserted) == 0 and not deleted.any():
+            self.observe(df)
+            return
+
+        journal_path = self._journal_path(generations[-1])
+        record = {
+            'time': time.time(),
+            'deleted': self._index[deleted].to_list(),
+            'upserted': upserted,
+        }
+        with open(journal_path, 'ab') as journal_file:
+            pickle.dump(record, journal_file, protocol=pickle.HIGHEST_PROTOCOL)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+        logger.debug('Journal %s: %d deleted, %d changed, %d inserted',
+                     self._directory, int(deleted.sum()), num_changed, num_inserted)
+
+        self._index = df.index.copy()
+        self._hashes = new_hashes
+
+        if self._num_records is None:
+            self._num_records = len(self._read_records(generations[-1]))
+        else:
+            self._num_records += 1
+
+        if self._num_records >= _MAX_RECORDS:
+            self._rebase(df)
+        return
+
+    def _rebase(self, df: pd.DataFrame):
+        os.makedirs(self._directory, exist_ok=True)
+
+        generation = f'{time.time():.6f}'
+        tmp_path = self._base_path(generation) + '.tmp'
+        with open(tmp_path, 'wb') as base_file:
+            pickle.dump(df, base_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._base_path(generation))
+
+        for old_generation in self._generations()[:-_KEEP_GENERATIONS]:
+            for path in [self._base_path(old_generation), self._journal_path(old_generation)]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        logger.debug('Journal %s: new base with %d rows', self._directory, len(df))
+
+        self._num_records = 0
+        self.observe(df)
+        return
+
+    def _read_records(self, generation):
+        path = self._journal_path(generation)
+        records = []
+        if not os.path.exists(path):
+            return records
+
+        with open(path, 'rb') as journal_file:
+            while True:
+                try:
+                    records.append(pickle.load(journal_file))
+                except EOFError:
+                    break
+        return records
+
+    def get_versions(self) -> pd.DataFrame:
+        """Returns the times that can be restored, with the number of rows deleted and
+           upserted at each."""
+        versions = []
+        for generation in self._generations():
+            versions.append({'time': float(generation), 'base': True, 'deleted': None, 'upserted': None})
+            for record in self._read_records(generation):
+                versions.append({'time': record['time'], 'base': False,
+                                 'deleted': len(record['deleted']),
+                                 'upserted': len(record['upserted'])})
+
+        df = pd.DataFrame.from_records(versions, columns=['time', 'base', 'deleted', 'upserted'])
+        df['time'] = pd.to_datetime(df['time'], unit='s', utc=True)
+        return df
+
+    def restore(self, at=None) -> pd.DataFrame:
+        """Returns the DF as it was written at time at (a timestamp or UNIX time; the latest
+           write if None)."""
+        at = _to_time(at)
+
+        generations = [generation for generation in self._generations() if float(generation) <= at]
+        if len(generations) == 0:
+            raise ValueError(f'No backup of {self._directory} from before {pd.Timestamp(at, unit="s")}')
+
+        generation = generations[-1]
+        with open(self._base_path(generation), 'rb') as base_file:
+            df = pickle.load(base_file)
+
+        for record in self._read_records(generation):
+            if record['time'] > at:
+                break
+
+            # records are only written for DFs with a unique index
+            if not df.index.is_unique:
+                raise ValueError(f'Journal {self._directory} has row changes for a DF whose '
+                                 f'index is not unique')
+
+            upserted = record['upserted']
+            df = df.loc[~df.index.isin(record['deleted'])]
+
+            existing = upserted.index.isin(df.index)
+            if existing.any():
+                df = df.copy()
+                df.loc[upserted.index[existing]] = upserted.loc[existing]
+            df = pd.concat([df, upserted.loc[~existing]])
+
+        return df
@@ -0,0 +1,172 @@
+"""
+Fuzzy one-to-one matching of two lists of strings, split into blocks of strings that share
+words or trigrams.
+
+fuzzy_one_to_one_mapping compares every string of one list with every string of the other.
+Here, candidate pairs are generated first, from inverted indexes over the strings of the
+second list (lowercased, accents removed):
+- word tokens: strings that share a word, e.g. an artist name, are candidates
+- character trigrams: strings that share at least _MIN_SHARED_TRIGRAMS_FRACTION of the
+  trigrams of the shorter one are candidates; this catches misspelled or differently
+  split words
+Words and trigrams in more than _MAX_POSTINGS_FRACTION of the strings (e.g. 'the', 'mix')
+aren't indexed; they'd make nearly every pair a candidate.
+
+The candidate pairs form a bipartite graph. Every connected component is matched with one
+fuzzy_one_to_one_mapping call, in a process pool, so the ratios and the one-to-one
+assignment within a block are the library's own.
+
+The blocking is a heuristic: a pair that shares no uncommon word and few trigrams is never
+compared, even if it would reach the cutoff. It's off unless
+djlib_config.fuzzy_match_blocking is set; test_fuzzy_matching.py checks that the matches
+are the same as the full comparison's.
+"""
+
+import logging
+import re
+import unicodedata
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from spyroslib.general_utils import fuzzy_one_to_one_mapping
+
+logger = logging.getLogger(__name__)
+
+# blocks handed to a worker process at a time
+_MATCH_CHUNKSIZE = 16
+
+_MIN_SHARED_TRIGRAMS_FRACTION = 0.3
+
+_MAX_POSTINGS_FRACTION = 0.05
+# words and trigrams are always indexed if they're in at most this many strings
+_MIN_MAX_POSTINGS = 50
+
+_WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def _normalize(sequence):
+    sequence = unicodedata.normalize('NFKD', str(sequence)).encode('ascii', 'ignore').decode('ascii')
+    return sequence.lower()
+
+
+def _words(sequence):
+    return set(_WORD_PATTERN.findall(sequence))
+
+
+def _trigrams(sequence):
+    sequence = ' '.join(_WORD_PATTERN.findall(sequence))
+    return {sequence[k:k + 3] for k in range(len(sequence) - 2)}
+
+
+def _inverted_index(features, max_postings):
+    index = {}
+    for j, keys in enumerate(features):
+        for key in keys:
+            index.setdefault(key, []).append(j)
+    return {key: postings for key, postings in index.items() if len(postings) <= max_postings}
+
+
+def get_candidate_pairs(sequences1, sequences2):
+    """Returns, for every string of sequences1, the sorted indexes of the strings of
+       sequences2 it's to be compared with."""
+    normalized2 = [_normalize(sequence) for sequence in sequences2]
+    trigrams2 = [_trigrams(sequence) for sequence in normalized2]
+
+    max_postings = max(_MIN_MAX_POSTINGS, int(len(sequences2) * _MAX_POSTINGS_FRACTION))
+    word_index = _inverted_index([_words(sequence) for sequence in normalized2], max_postings)
+    trigram_index = _inverted_index(trigrams2, max_postings)
+
+    candidates = []
+    for sequence in sequences1:
+        sequence = _normalize(sequence)
+
+        js = set()
+        for word in _words(sequence):
+            js.update(word_index.get(word, ()))
+
+        trigrams = _trigrams(sequence)
+        shared = Counter()
+        for trigram in trigrams:
+            shared.update(trigram_index.get(trigram, ()))
+        for j, num_shared in shared.items():
+            if num_shared >= _MIN_SHARED_TRIGRAMS_FRACTION * min(len(trigrams), len(trigrams2[j])):
+                js.add(j)
+
+        candidates.append(sorted(js))
+
+    return candidates
+
+
+def get_blocks(candidates, num_sequences2):
+    """Returns the connected components of the candidate pairs that have strings from both
+       lists, as (indexes1, indexes2), each sorted."""
+    # nodes: the strings of sequences1, then those of sequences2
+    parents = list(range(len(candidates) + num_sequences2))
+
+    def find(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    for i, js in enumerate(candidates):
+        for j in js:
+            root1, root2 = find(i), find(len(candidates) + j)
+            if root1 != root2:
+                parents[max(root1, root2)] = min(root1, root2)
+
+    blocks = {}
+    for node in range(len(parents)):
+        indexes1, indexes2 = blocks.setdefault(find(node), ([], []))
+        if node < len(candidates):
+            indexes1.append(node)
+        else:
+            indexes2.append(node - len(candidates))
+
+    return [(indexes1, indexes2) for indexes1, indexes2 in blocks.values()
+            if len(indexes1) > 0 and len(indexes2) > 0]
+
+
+def _match_block(args):
+    # runs in a worker process
+    indexes1, indexes2, sequences1, sequences2, kwargs = args
+
+    result = fuzzy_one_to_one_mapping(sequences1, sequences2, **kwargs)
+
+    return [
+        pair | {'index1': indexes1[pair['index1']], 'index2': indexes2[pair['index2']]}
+        for pair in result['pairs']
+    ]
+
+
+def blocked_fuzzy_one_to_one_mapping(sequences1, sequences2, cutoff_ratio, workers=None, **kwargs):
+    """Like fuzzy_one_to_one_mapping(sequences1, sequences2, cutoff_ratio=cutoff_ratio,
+       **kwargs), matching every block of strings (see get_blocks) on its own. The pairs are
+       returned best ratio first."""
+    sequences1 = list(sequences1)
+    sequences2 = list(sequences2)
+
+    candidates = get_candidate_pairs(sequences1, sequences2)
+    blocks = get_blocks(candidates, len(sequences2))
+
+    logger.debug('Fuzzy matching %d x %d strings: %d candidate pairs in %d blocks, the largest %d x %d',
+                 len(sequences1), len(sequences2), sum(len(js) for js in candidates), len(blocks),
+                 max((len(indexes1) for indexes1, _ in blocks), default=0),
+                 max((len(indexes2) for _, indexes2 in blocks), default=0))
+
+    tasks = [
+        (indexes1, indexes2,
+         [sequences1[i] for i in indexes1], [sequences2[j] for j in indexes2],
+         dict(kwargs, cutoff_ratio=cutoff_ratio))
+        for indexes1, indexes2 in blocks
+    ]
+
+    pairs = []
+    if len(tasks) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for block_pairs in executor.map(_match_block, tasks, chunksize=_MATCH_CHUNKSIZE):
+                pairs.extend(block_pairs)
+
+    pairs.sort(key=lambda pair: (-pair['ratio'], pair['index1']))
+
+    return {'pairs': pairs}
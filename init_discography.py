@@ -1,45 +1,84 @@
 """
 Initializes the new discography (v2) from discography v1 files
+
+Cache files are read in a process pool and concatenated into one DF per table, which is
+deduplicated once. Albums, artist albums and album tracks are imported into the discography
+store in one transaction; it derives artist tracks from them, so none are written out.
 """
 
 import sys
 import os
 import os.path
 import re
-from fileinput import filename
+from concurrent.futures import ProcessPoolExecutor
 
 from djlibman import *
 
-def create_spotify_albums():
-    all_cache_files = os.listdir(djlib_config.discography_cache_dir)
+_DATETIME_COLUMNS = ['release_date', 'added_at']
+
+# files handed to a worker process at a time
+_READ_CHUNKSIZE = 64
 
-    artist_albums_files = [
+
+def _list_cache_files(pattern):
+    return [
         filename
-        for filename in all_cache_files
-        if re.match(r'^artist-albums-.*\.csv$', filename)
+        for filename in os.listdir(djlib_config.discography_cache_dir)
+        if re.match(pattern, filename)
     ]
 
-    print(f'Found {len(artist_albums_files)} artist albums files in cache')
-    print()
+def _read_cache_file(path):
+    # runs in a worker process
+    try:
+        return pd.read_csv(path)
+    except pd.errors.EmptyDataError:
+        return None
 
-    spotify_albums = Doc('spotify_albums', create=True, overwrite=True)
+def _read_cache_files(filenames, workers=None, file_column=None) -> pd.DataFrame:
+    """Reads the cache files in parallel and returns their rows concatenated, in file order.
+       file_column: the name of a column to add with the file name of every row."""
+    filenames = list(filenames)
+    paths = [os.path.join(djlib_config.discography_cache_dir, filename) for filename in filenames]
 
-    total_albums = 0
-    for artist_albums_fn in artist_albums_files:
-        print(f'Reading {artist_albums_fn}... ', end='')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        dfs = [
+            df if file_column is None else df.assign(**{file_column: filename})
+            for filename, df in zip(
+                filenames, executor.map(_read_cache_file, paths, chunksize=_READ_CHUNKSIZE))
+            if df is not None and len(df) > 0
+        ]
 
-        artist_albums_doc = Doc(artist_albums_fn, modify=False,
-                                path=os.path.join(djlib_config.discography_cache_dir, artist_albums_fn),
-                                type='csv',
-                                datetime_columns=['release_date'])
+    if len(dfs) == 0:
+        return pd.DataFrame()
 
-        print(f'{len(artist_albums_doc)} albums')
-        total_albums += len(artist_albums_doc)
+    df = pd.concat(dfs, ignore_index=True)
 
-        if len(spotify_albums) == 0:
-            spotify_albums.set_df(artist_albums_doc.get_df())
-        else:
-            spotify_albums.append(artist_albums_doc, prompt=False)
+    for column in _DATETIME_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column], utc=True, format='ISO8601')
+
+    return df
+
+def _deduplicate(df: pd.DataFrame, index_column):
+    """Keeps the first row for every ID, like appending the files one by one did."""
+    if len(df) == 0:
+        return df
+    df = df.loc[~df[index_column].duplicated()]
+    return df.set_index(index_column, drop=False)
+
+def create_spotify_albums(workers=None):
+    artist_albums_files = _list_cache_files(r'^artist-albums-.*\.csv$')
+
+    print(f'Found {len(artist_albums_files)} artist albums files in cache')
+    print()
+
+    albums = _read_cache_files(artist_albums_files, workers=workers)
+    total_albums = len(albums)
+
+    albums = _deduplicate(albums, 'album_id')
+
+    spotify_albums = Doc('spotify_albums', create=True, overwrite=True)
+    spotify_albums.set_df(albums)
 
     print(f'{total_albums} albums read; {len(spotify_albums)} albums left after deduplication')
     spotify_albums.write()
@@ -47,36 +86,27 @@ def create_spotify_albums():
     return
 
 def create_spotify_artist_albums_last_check():
-    all_cache_files = os.listdir(djlib_config.discography_cache_dir)
-
-    artist_albums_files = [
-        filename
-        for filename in all_cache_files
-        if re.match(r'^artist-albums-.*\.csv$', filename)
-    ]
+    artist_albums_files = _list_cache_files(r'^artist-albums-.*\.csv$')
 
     print(f'Found {len(artist_albums_files)} artist albums files in cache')
     print()
 
-    df = pd.DataFrame(data=[], columns=['artist_id', 'artist_name', 'check_time'],
-                      index=pd.Index(data=[], name='artist_id'))
+    records = []
     for artist_albums_fn in artist_albums_files:
         m = re.match(r'^artist-albums-([^\-]+)-(.*).csv$', artist_albums_fn)
 
         assert m is not None
 
-        artist_id = m.group(1)
-        artist_name = m.group(2)
-        check_unixtime = os.path.getmtime(
+        records.append({
+            'artist_id': m.group(1),
+            'artist_name': m.group(2),
+            'check_time': os.path.getmtime(
                 os.path.join(djlib_config.discography_cache_dir, artist_albums_fn))
+        })
 
-        check_time = pd.to_datetime(check_unixtime, unit='s', utc=True)
-
-        df.loc[artist_id] = {
-            'artist_id': artist_id,
-            'artist_name': artist_name,
-            'check_time': check_time
-            }
+    df = pd.DataFrame.from_records(records, columns=['artist_id', 'artist_name', 'check_time'])
+    df['check_time'] = pd.to_datetime(df['check_time'], unit='s', utc=True)
+    df = _deduplicate(df, 'artist_id')
 
     spotify_artist_albums_last_check = Doc('spotify_artist_albums_last_check',
                                            create=True, overwrite=True)
@@ -85,38 +115,19 @@ def create_spotify_artist_albums_last_check():
 
     return
 
-def create_spotify_tracks():
-    all_cache_files = os.listdir(djlib_config.discography_cache_dir)
-
-    album_tracks_files = [
-        filename
-        for filename in all_cache_files
-        if re.match(r'^album-tracks-.*\.csv$', filename)
-    ]
+def create_spotify_tracks(workers=None):
+    album_tracks_files = _list_cache_files(r'^album-tracks-.*\.csv$')
 
     print(f'Found {len(album_tracks_files)} album tracks files in cache')
     print()
 
-    spotify_tracks = Doc('spotify_tracks', create=True, overwrite=True)
-
-    total_tracks = 0
-    for album_tracks_fn in album_tracks_files:
-        print(f'Reading {album_tracks_fn}... ', end='')
-
-        album_tracks_doc = Doc(album_tracks_fn, modify=False,
-                                path=os.path.join(djlib_config.discography_cache_dir,
-                                                  album_tracks_fn),
-                                type='csv',
-                                index_column='spotify_id',
-                                datetime_columns=['release_date', 'added_at'])
+    tracks = _read_cache_files(album_tracks_files, workers=workers)
+    total_tracks = len(tracks)
 
-        print(f'{len(album_tracks_doc)} tracks')
-        total_tracks += len(album_tracks_doc)
+    tracks = _deduplicate(tracks, 'spotify_id')
 
-        if len(spotify_tracks) == 0:
-            spotify_tracks.set_df(album_tracks_doc.get_df())
-        else:
-            spotify_tracks.append(album_tracks_doc, prompt=False)
+    spotify_tracks = Doc('spotify_tracks', create=True, overwrite=True)
+    spotify_tracks.set_df(tracks)
 
     print(f'{total_tracks} tracks read; {len(spotify_tracks)} inserted')
     spotify_tracks.write()
@@ -124,104 +135,109 @@ def create_spotify_tracks():
     return
 
 
-_open_artist_tracks_docs = {}
-
-def _get_artist_tracks_doc(artist_id: str, artist_name: str):
-    if artist_id in _open_artist_tracks_docs:
-        return _open_artist_tracks_docs[artist_id]
-
-    artist_tracks_dir = os.path.join(djlib_config.default_dir, 'spotify-artist-tracks')
-
-    artist_tracks_files = os.listdir(artist_tracks_dir)
-
-    artist_tracks_file = None
-    artist_tracks_pattern = re.compile(r'^artist-tracks-%s-.*\.csv$' % artist_id)
-    for file in artist_tracks_files:
-        if re.match(artist_tracks_pattern, file):
-            artist_tracks_file = file
-            break
-
-    if artist_tracks_file is None:
-        artist_tracks_file = f'artist-tracks-{artist_id}-{artist_name.replace('/', '-')}.csv'
-        new_file = True
-    else:
-        new_file = False
-
-    artist_tracks_doc = Doc(
-        name=f'artist tracks {artist_id} {artist_name}',
-        path=os.path.join(artist_tracks_dir, artist_tracks_file),
-        type='csv',
-        index_column='spotify_id',
-        datetime_columns=['release_date', 'added_at'],
-        backups=0,
-        create=new_file,
-        overwrite=new_file,
-        modify=True
-    )
-
-    _open_artist_tracks_docs[artist_id] = artist_tracks_doc
-
-    return artist_tracks_doc
-
-def _album_to_artist_tracks(album_doc: Doc):
-    tracks_by_artist = {}
-    artist_names_by_id = {}
-
-    album_df = album_doc.get_df()
-    for i in range(len(album_df)):
-        artist_ids = album_df.iloc[i]['artist_ids'].split('|')
-        artist_names = album_df.iloc[i]['artist_names'].split('|')
-
-        for j, artist_id in enumerate(artist_ids):
-            artist_names_by_id[artist_id] = artist_names[j]
-
-            if artist_id not in tracks_by_artist:
-                tracks_by_artist[artist_id] = []
-
-            tracks_by_artist[artist_id].append(i)
-
-    print(f'Album file {album_doc.get_name()}: {len(album_doc)} tracks, {len(tracks_by_artist)} artists')
-
-    for artist_id in tracks_by_artist:
-        artist_name = artist_names_by_id[artist_id]
-        artist_track_indices = tracks_by_artist[artist_id]
-        artist_tracks = album_df.iloc[artist_track_indices]
-
-        print(f'    Artist {artist_id} {artist_name}: {len(artist_tracks)} tracks')
-
-        artist_doc = _get_artist_tracks_doc(artist_id, artist_name)
+def _get_store():
+    import spotify_discography
+    return spotify_discography.get_instance().get_store()
+
+def _split_list_column(values: pd.Series):
+    """Splits '|'-separated lists; missing values become empty lists."""
+    return [value.split('|') if isinstance(value, str) and value != '' else [] for value in values]
+
+def _tracks_by_artist(tracks: pd.DataFrame):
+    """Returns the (artist_id, artist_name) of every credit on the tracks, one row per
+       credit, with the track's position in tracks as the index. Names are matched to IDs
+       by position; a missing name is None."""
+    artist_ids = _split_list_column(tracks['artist_ids'])
+    artist_names = _split_list_column(tracks['artist_names']) if 'artist_names' in tracks.columns \
+        else [[]] * len(tracks)
+
+    positions = []
+    credit_ids = []
+    credit_names = []
+    for position, (ids, names) in enumerate(zip(artist_ids, artist_names)):
+        positions.extend([position] * len(ids))
+        credit_ids.extend(ids)
+        credit_names.extend(names[:len(ids)] + [None] * (len(ids) - len(names)))
+
+    return pd.DataFrame({'artist_id': credit_ids, 'artist_name': credit_names},
+                        index=pd.Index(positions, dtype=int))
+
+def _get_file_info(filenames, pattern):
+    """Returns a DF of the ID and name in every cache file name, with its mtime."""
+    records = []
+    for filename in filenames:
+        m = re.match(pattern, filename)
+        assert m is not None
+        records.append({
+            'file': filename,
+            'id': m.group(1),
+            'name': m.group(2),
+            'mtime': os.path.getmtime(os.path.join(djlib_config.discography_cache_dir, filename)),
+        })
+    return pd.DataFrame.from_records(records, columns=['file', 'id', 'name', 'mtime']).set_index('file')
+
+def import_into_store(workers=None):
+    """Imports the albums, artist albums and album tracks of the cache into the discography
+       store; an artist's tracks are looked up from those, so there are no artist tracks
+       files to write. File mtimes become the check and fetch times."""
+    artist_albums_pattern = r'^artist-albums-([0-9A-Za-z]+)-(.*)\.csv$'
+    album_tracks_pattern = r'^album-tracks-([0-9A-Za-z]+)-(.*)\.csv$'
+
+    artist_albums_files = _get_file_info(_list_cache_files(artist_albums_pattern),
+                                         artist_albums_pattern)
+    album_tracks_files = _get_file_info(_list_cache_files(album_tracks_pattern),
+                                        album_tracks_pattern)
+
+    print(f'Found {len(artist_albums_files)} artist albums files and '
+          f'{len(album_tracks_files)} album tracks files in cache')
+    print()
 
-        if len(artist_doc) == 0:
-            artist_doc.set_df(artist_tracks)
+    albums = _read_cache_files(artist_albums_files.index, workers=workers, file_column='file')
+    tracks = _read_cache_files(album_tracks_files.index, workers=workers, file_column='file')
+
+    artist_albums = None
+    if len(albums) > 0:
+        albums['artist_id'] = albums['file'].map(artist_albums_files['id'])
+        artist_albums = albums[['artist_id', 'album_id']].drop_duplicates()
+        albums = _deduplicate(albums, 'album_id')
+
+    artist_refresh = pd.DataFrame({
+        'artist_id': artist_albums_files['id'].to_numpy(),
+        'artist_name': artist_albums_files['name'].to_numpy(),
+        'albums_checked_at': artist_albums_files['mtime'].to_numpy(),
+        'tracks_checked_at': None,
+    }).drop_duplicates('artist_id')
+
+    if len(tracks) > 0:
+        file_album_ids = tracks['file'].map(album_tracks_files['id'])
+        if 'album_id' in tracks.columns:
+            tracks['album_id'] = tracks['album_id'].fillna(file_album_ids)
         else:
-            artist_doc.append(artist_tracks, prompt=False)
-        artist_doc.write()
+            tracks['album_id'] = file_album_ids
+        tracks = tracks.loc[~tracks[['album_id', 'spotify_id']].duplicated()].reset_index(drop=True)
 
-    return
-
-def create_artist_tracks():
-    all_cache_files = os.listdir(djlib_config.discography_cache_dir)
+        # an artist's tracks were checked when the last album crediting the artist was
+        credits = _tracks_by_artist(tracks)
+        credits['checked_at'] = tracks['file'].map(album_tracks_files['mtime']).to_numpy()[credits.index.to_numpy()]
+        credited_artists = credits.groupby('artist_id', sort=False).agg(
+            artist_name=('artist_name', 'first'), tracks_checked_at=('checked_at', 'max'))
 
-    album_tracks_files = [
-        filename
-        for filename in all_cache_files
-        if re.match(r'^album-tracks-.*\.csv$', filename)
-    ]
+        artist_refresh = artist_refresh.set_index('artist_id').combine_first(credited_artists) \
+            .rename_axis('artist_id').reset_index()
 
-    print(f'Found {len(album_tracks_files)} album tracks files in cache')
-    print()
+        print(f'{len(tracks)} album tracks, {len(credited_artists)} credited artists')
 
-    for album_tracks_fn in album_tracks_files:
-        print(f'Reading {album_tracks_fn}... ')
+    fetched_albums = pd.DataFrame({
+        'album_id': album_tracks_files['id'].to_numpy(),
+        'tracks_fetched_at': album_tracks_files['mtime'].to_numpy(),
+    })
 
-        album_tracks_doc = Doc(album_tracks_fn, modify=False,
-                                path=os.path.join(djlib_config.discography_cache_dir,
-                                                  album_tracks_fn),
-                                type='csv',
-                                index_column='spotify_id',
-                                datetime_columns=['release_date', 'added_at'])
+    store = _get_store()
+    store.import_tables(albums=albums, artist_albums=artist_albums, tracks=tracks,
+                        fetched_albums=fetched_albums, artist_refresh=artist_refresh)
 
-        _album_to_artist_tracks(album_tracks_doc)
+    print(f'Imported {len(albums)} albums, {len(tracks)} album tracks and '
+          f'{len(artist_refresh)} artists')
 
     return
 
@@ -233,7 +249,7 @@ def main():
     # create_spotify_artist_albums_last_check()
     # create_spotify_tracks()
 
-    create_artist_tracks()
+    import_into_store()
     return
 
 if __name__ == '__main__':
@@ -3,67 +3,14 @@
 import classification
 from containers import *
 from spotify_util import *
+from fuzzy_matching import blocked_fuzzy_one_to_one_mapping
 
 
 def add_spotify_fields_to_rekordbox(rekordbox_tracks: pd.DataFrame, *, drop_missing_ids=False):
-    rekordbox_to_spotify = Doc('rekordbox_to_spotify')
-
-    rekordbox_to_spotify_df = rekordbox_to_spotify.get_df()
-
-    # avoid overlapping columns like rekordbox_id
-    rekordbox_to_spotify_columns = rekordbox_to_spotify_df.columns.difference(
-        rekordbox_tracks.columns, sort=False)
-
-    rekordbox_to_spotify_df = rekordbox_to_spotify_df[rekordbox_to_spotify_columns]
-
-    if drop_missing_ids:
-        rekordbox_to_spotify_df = dataframe_filter(
-            rekordbox_to_spotify_df,
-            lambda track: not pd.isna(track['spotify_id'])
-        )
-
-    if rekordbox_tracks.index.name != 'rekordbox_id':
-        raise ValueError('Argument is not indexed by rekordbox_id')
-
-    rekordbox_tracks_with_spotify_fields = rekordbox_tracks.merge(
-        right=rekordbox_to_spotify_df,
-        left_index=True,
-        right_index=True,
-        how=('inner' if drop_missing_ids else 'left')
-    )
-
-    return rekordbox_tracks_with_spotify_fields
+    return get_id_map().add_spotify_fields(rekordbox_tracks, drop_missing_ids=drop_missing_ids)
 
 def add_rekordbox_fields_to_spotify(spotify_tracks: pd.DataFrame, *, drop_missing_ids=False):
-    rekordbox_to_spotify = Doc('rekordbox_to_spotify')
-
-    rekordbox_to_spotify_df = rekordbox_to_spotify.get_df()
-
-    if drop_missing_ids:
-        rekordbox_to_spotify_df = dataframe_filter(
-            rekordbox_to_spotify_df,
-            lambda track: not pd.isna(track['spotify_id'])
-        )
-
-    rekordbox_to_spotify_df.set_index('spotify_id', inplace=True, drop=True)
-
-    # avoid overlapping columns like rekordbox_id
-    rekordbox_to_spotify_columns = rekordbox_to_spotify_df.columns.difference(
-        spotify_tracks.columns, sort=False)
-
-    rekordbox_to_spotify_df = rekordbox_to_spotify_df[rekordbox_to_spotify_columns]
-
-    if spotify_tracks.index.name != 'spotify_id':
-        raise ValueError('Argument is not indexed by spotify_id')
-
-    spotify_tracks_with_rekordbox_fields = spotify_tracks.merge(
-        right=rekordbox_to_spotify_df,
-        left_index=True,
-        right_index=True,
-        how=('inner' if drop_missing_ids else 'left')
-    )
-
-    return spotify_tracks_with_rekordbox_fields
+    return get_id_map().add_rekordbox_fields(spotify_tracks, drop_missing_ids=drop_missing_ids)
 
 def rekordbox_sanity_checks():
     top_level_playlist_names = ['Main Library', 'back catalog', 'non-DJ']
@@ -176,6 +123,103 @@ def djlib_values_sanity_check():
 
     return (errors == 0)
 
+def _normalize_cell(value):
+    """Returns a comparable form of a cell value, so values that differ only in their
+       representation (NaN vs None vs '', 5 vs 5.0, lists vs arrays, naive vs UTC
+       timestamps) compare equal. Strings stay strings; numbers in strings are compared as
+       numbers only in numeric columns (see _as_numbers)."""
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_normalize_cell(item) for item in value)
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        value = float(value)
+        return None if np.isnan(value) else value
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        value = pd.Timestamp(value)
+        return value.tz_convert(None) if value.tz is not None else value
+    if isinstance(value, str):
+        value = value.strip()
+        return None if value == '' else value
+    return value
+
+def _as_numbers(values: pd.Series):
+    """Returns the values as floats, NaN for missing, if the column is numeric: a numeric
+       dtype, or only numbers, numbers in strings and missing values. Otherwise None."""
+    if pd.api.types.is_bool_dtype(values):
+        return None
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=float, na_value=np.nan)
+    if not pd.api.types.is_object_dtype(values):
+        return None
+
+    values = values.map(lambda value: value.strip() if isinstance(value, str) else value)
+    present = values.notna() & (values != '')
+    if values.loc[present].map(lambda value: isinstance(value, (bool, np.bool_))).any():
+        return None
+
+    numbers = pd.to_numeric(values.where(present), errors='coerce')
+    # 'nan' and the like don't count as numbers
+    if (numbers.isna() & present).any():
+        return None
+    return numbers.to_numpy(dtype=float, na_value=np.nan)
+
+def _get_cell_changes(target: pd.DataFrame, source: pd.DataFrame, index, columns) -> pd.DataFrame:
+    """Compares the rows of target and source in index, column by column, and returns the
+       cells that differ as a DF with the columns id, column, old (target) and new (source)."""
+    changes = []
+
+    for column in columns:
+        old = target.loc[index, column]
+        new = source.loc[index, column]
+
+        old_values = _as_numbers(old)
+        new_values = _as_numbers(new) if old_values is not None else None
+
+        if new_values is not None:
+            differs = ~((old_values == new_values) | (np.isnan(old_values) & np.isnan(new_values)))
+        else:
+            differs = np.fromiter(
+                (_normalize_cell(o) != _normalize_cell(n) for o, n in zip(old, new)),
+                dtype=bool, count=len(index))
+
+        if differs.any():
+            changes.append(pd.DataFrame({
+                'id': index[differs],
+                'column': column,
+                'old': old.to_numpy()[differs],
+                'new': new.to_numpy()[differs],
+            }))
+
+    if len(changes) == 0:
+        return pd.DataFrame(columns=['id', 'column', 'old', 'new'])
+
+    return pd.concat(changes, ignore_index=True)
+
+def _apply_cell_changes(doc: Doc, changes: pd.DataFrame):
+    """Sets the changed cells in the doc and marks it as changed."""
+    if len(changes) == 0:
+        return
+
+    df = doc.get_df()
+    for column, column_changes in changes.groupby('column', sort=False):
+        new = pd.Series(column_changes.new.to_numpy(), index=column_changes.id.to_numpy(), dtype=object)
+
+        if not pd.api.types.is_object_dtype(df[column]):
+            try:
+                new = new.astype(df[column].dtype)
+            except (TypeError, ValueError):
+                # e.g. lists, or missing values in an int column
+                df[column] = df[column].astype(object)
+
+        df.loc[new.index, column] = new
+
+    # not calling set_df(); only these cells changed
+    doc._changed = True
+    return
+
 def djlib_maintenance():
     djlib = Doc('djlib')
     main_library = RekordboxPlaylist('Main Library')
@@ -190,8 +234,16 @@ def djlib_maintenance():
     rb_tracks_missing_from_djlib = main_library.get_df().index.difference(djlib.get_df().index, sort=False)
 
     # reconcile fields of existing tracks between Rekordbox and the Google sheet. Rekordbox is the source of truth.
-    djlib.get_df().loc[rb_tracks_in_djlib, djlib_auto_columns] = (
-        main_library.get_df().loc[rb_tracks_in_djlib, djlib_auto_columns])
+    changes = _get_cell_changes(djlib.get_df(), main_library.get_df(), rb_tracks_in_djlib,
+                                djlib_auto_columns)
+
+    if len(changes) == 0:
+        print('djlib fields are in sync with Rekordbox')
+    else:
+        print(f'{len(changes)} djlib fields of {changes.id.nunique()} tracks differ from Rekordbox:')
+        for column, num_changes in changes.column.value_counts().items():
+            print(f'    {column}: {num_changes}')
+        _apply_cell_changes(djlib, changes)
 
     if len(rb_tracks_missing_from_djlib) == 0:
         print('All Rekordbox Main Library tracks are in djlib')
@@ -207,8 +259,8 @@ def djlib_maintenance():
 
         djlib.append(missing_from_djlib[djlib_auto_columns])
 
-    # force=True is needed because field reconciliation won't appear as a change to the Container
-    djlib.write(force=True)
+    # written only if fields were reconciled or tracks appended
+    djlib.write()
 
     return
 
@@ -250,10 +302,17 @@ def rekordbox_to_spotify_maintenance(rekordbox_main_playlist='Main Library'):
         rekordbox_sequences = unmapped_rekordbox_tracks.apply(format_track_for_search, axis=1)
         listened_sequences = unmapped_listened_tracks.apply(format_track_for_search, axis=1)
 
-        result = fuzzy_one_to_one_mapping(
-            rekordbox_sequences.to_list(),
-            listened_sequences.to_list(),
-            cutoff_ratio=djlib_config.fuzzy_match_cutoff_threshold)
+        if djlib_config.fuzzy_match_blocking:
+            # only strings that share words or trigrams are compared; see fuzzy_matching
+            result = blocked_fuzzy_one_to_one_mapping(
+                rekordbox_sequences.to_list(),
+                listened_sequences.to_list(),
+                cutoff_ratio=djlib_config.fuzzy_match_cutoff_threshold)
+        else:
+            result = fuzzy_one_to_one_mapping(
+                rekordbox_sequences.to_list(),
+                listened_sequences.to_list(),
+                cutoff_ratio=djlib_config.fuzzy_match_cutoff_threshold)
 
         for mapping in result['pairs']:
             rekordbox_idx = mapping['index1']
@@ -335,8 +394,16 @@ def rekordbox_to_spotify_maintenance(rekordbox_main_playlist='Main Library'):
         pretty_print_tracks(unmapped_rekordbox_tracks, indent=' '*4, enum=True)
 
     if len(new_mappings) > 0:
+        # the metadata columns of the mapping, for the tracks mapped from search results or
+        # listening history entries that lack them
+        new_mappings = fill_mapped_track_metadata(
+            new_mappings,
+            columns=[column for column in spotify_track_store.METADATA_COLUMNS
+                     if column in new_mappings.columns])
+
         rekordbox_to_spotify.append(new_mappings)
         rekordbox_to_spotify.write()
+        get_id_map().invalidate()
 
     return
 
@@ -54,6 +54,29 @@ def get_track_signature(track):
 
     return tuple(artist_names + [name])
 
+def get_track_signatures(tracks):
+    """Vectorized get_track_signature() for a whole dataframe; returns a Series of the
+       same tuples, with the same index as the dataframe."""
+    names = tracks['name'].str.replace(r'(\[|\()[A-Z]{3,100} ?[0-9]+(\]|\))', '', regex=True)
+
+    names = names.str.upper()
+
+    names = names.str.replace(r'FEAT(\.|URING) .*', '', regex=True)
+
+    for s in ['(', ')', '[', ']', '-', ' AND ', ' X ', 'EXTENDED', 'ORIGINAL', 'REMIX', 'MIXED', 'MIX', 'RADIO', 'EDIT']:
+        names = names.str.replace(s, '', regex=False)
+
+    names = names.str.split().str.join(' ')
+
+    artist_names = tracks['artist_names'].str.upper().str.split('|')
+
+    signatures = [
+        tuple(sorted(track_artist_names)) + (name,)
+        for track_artist_names, name in zip(artist_names, names)
+    ]
+
+    return pd.Series(signatures, index=tracks.index, dtype=object)
+
 
 
 
@@ -6,7 +6,7 @@ import spotify_discography
 
 import spyroslib.containers as ct
 
-from containers import ListeningHistory, Queue
+from containers import Doc, ListeningHistory, Queue, session
 from library_workflow import add_spotify_fields_to_rekordbox
 from spotify_util import get_track_artists, add_artist_track_counts
 from classification import filter_tracks
@@ -14,7 +14,7 @@ from classification import filter_tracks
 from local_util import *
 
 def get_A_producers(run_name, *flavors):
-    djlib = ct.Doc('djlib')
+    djlib = Doc('djlib')
     listening_history = ListeningHistory()
 
     a_tracks = add_spotify_fields_to_rekordbox(
@@ -122,7 +122,9 @@ def discog_report_for_A_producers(run_name):
 
     return
 
-def refresh_A_producers(run_name):
+def refresh_A_producers(run_name, workers=None, budget=None):
+    """Refreshes the discographies of the A producers. With a request budget, only the
+       artists most likely to have new music are refreshed."""
     source_doc = ct.Doc(
         'a_artists',
         path=f'data/a_artists_reduced-{run_name}.csv',
@@ -134,31 +136,28 @@ def refresh_A_producers(run_name):
 
     discogs = spotify_discography.get_instance()
 
-    i = 0
-    for artist in a_artists.itertuples(index=False):
-        i += 1
-
-        # if i <= 2:
-        #     continue
+    start_time = time.time()
 
-        # if i > 3:
-        #     break
-
-        artist_id = artist.artist_id
-        artist_name = artist.artist_name
-
-        print(f'** Refreshing artist {artist_id} {artist_name}... ')
-
-        start_time = time.time()
-        discogs.refresh_artist(
-            artist_id=artist_id,
-            artist_name=artist_name,
+    if budget is not None:
+        discogs.refresh_artists_scheduled(
+            a_artists.set_index('artist_id', drop=False),
+            budget,
+            workers=workers,
+            run_name=f'A_producers-{run_name}')
+    else:
+        discogs.refresh_artists(
+            a_artists.artist_id,
+            a_artists.artist_name,
+            workers=workers,
             refresh_days=30,
-            force=False)
+            force=False,
+            run_name=f'A_producers-{run_name}')
 
-        end_time = time.time()
+    end_time = time.time()
 
-        print(f'** Refreshed artist {artist_id} {artist_name}: {end_time-start_time:.1f} seconds')
+    print(f'** Refreshed {len(a_artists)} artists: {end_time-start_time:.1f} seconds')
+
+    return
 
 def sample_artist_to_queue(
         queue_name,
@@ -180,63 +179,64 @@ def sample_artist_to_queue(
 
     print(f'Artist {artist_name}: Found {len(artist_discography)} tracks')
 
-    listening_history = ListeningHistory()
-    queue = Queue(queue_name)
+    with session(prompt=False):
+        listening_history = ListeningHistory()
+        queue = Queue(queue_name)
 
-    listening_history.filter(artist_discography, prompt=False, silent=True)
-    artist_discography.remove(queue, prompt=False, silent=True)
+        listening_history.filter(artist_discography, prompt=False, silent=True)
+        artist_discography.remove(queue, prompt=False, silent=True)
 
-    print(f'Left after removing listening history and queue: {len(artist_discography)} tracks')
+        print(f'Left after removing listening history and queue: {len(artist_discography)} tracks')
 
-    if total == -1:
-        total = sys.maxsize
-    if latest == -1:
-        latest = sys.maxsize
+        if total == -1:
+            total = sys.maxsize
+        if latest == -1:
+            latest = sys.maxsize
 
-    if len(artist_discography) < total:
-        print(f'Artist {artist_name}: adding all {len(artist_discography)} tracks to queue')
-        queue.append(artist_discography, prompt=False)
-        queue.write()
-        return
+        if len(artist_discography) < total:
+            print(f'Artist {artist_name}: adding all {len(artist_discography)} tracks to queue')
+            queue.append(artist_discography, prompt=False)
+            queue.write()
+            return
 
-    if latest > 0:
-        latest_cutoff_date = (pd.Timestamp.utcnow() -
-                              pd.Timedelta(value=latest_cutoff_days, unit='days'))
+        if latest > 0:
+            latest_cutoff_date = (pd.Timestamp.utcnow() -
+                                  pd.Timedelta(value=latest_cutoff_days, unit='days'))
 
-        latest_tracks = artist_discography.get_filtered(
-            lambda t: t['release_date'] >= latest_cutoff_date
-        )
+            latest_tracks = artist_discography.get_filtered(
+                lambda t: t['release_date'] >= latest_cutoff_date
+            )
 
-        if len(latest_tracks) > latest:
-            latest_tracks.sort_values(by='release_date', ascending=False, axis=0, inplace=True)
-            latest_tracks = latest_tracks[:latest]
+            if len(latest_tracks) > latest:
+                latest_tracks.sort_values(by='release_date', ascending=False, axis=0, inplace=True)
+                latest_tracks = latest_tracks[:latest]
 
-        artist_discography.remove(latest_tracks, prompt=False)
+            artist_discography.remove(latest_tracks, prompt=False)
 
-        print(f'Artist {artist_name}: Adding {len(latest_tracks)} latest tracks to queue')
-        # pretty_print_tracks(latest_tracks, indent=' '*4, enum=True, extra_attribs='release_date')
+            print(f'Artist {artist_name}: Adding {len(latest_tracks)} latest tracks to queue')
+            # pretty_print_tracks(latest_tracks, indent=' '*4, enum=True, extra_attribs='release_date')
 
-        queue.append(latest_tracks, prompt=False)
-        queue.write()
+            queue.append(latest_tracks, prompt=False)
+            queue.write()
 
-        remaining = total - len(latest_tracks)
-    else:
-        remaining = total
+            remaining = total - len(latest_tracks)
+        else:
+            remaining = total
 
-    if remaining > 0:
-        if len(artist_discography) > remaining:
-            artist_discography.sort('popularity', ascending=False)
+        if remaining > 0:
+            if len(artist_discography) > remaining:
+                artist_discography.sort('popularity', ascending=False)
 
-            most_popular_tracks = artist_discography.get_df()[:remaining]
-        else:
-            most_popular_tracks = artist_discography.get_df()
+                most_popular_tracks = artist_discography.get_df()[:remaining]
+            else:
+                most_popular_tracks = artist_discography.get_df()
 
-        print(f'Artist {artist_name}: adding {len(most_popular_tracks)} older tracks to queue')
-        print('Popular tracks:')
-        pretty_print_tracks(most_popular_tracks, indent=' '*4, enum=True, extra_attribs='popularity')
+            print(f'Artist {artist_name}: adding {len(most_popular_tracks)} older tracks to queue')
+            print('Popular tracks:')
+            pretty_print_tracks(most_popular_tracks, indent=' '*4, enum=True, extra_attribs='popularity')
 
-        queue.append(most_popular_tracks, prompt=False)
-        queue.write()
+            queue.append(most_popular_tracks, prompt=False)
+            queue.write()
 
     return
 
@@ -249,19 +249,21 @@ def populate_queue(run_name, queue_name):
         type='csv'
         )
 
-    i=0
-    for artist in next_q_artists.get_df().itertuples(index=False):
-        i += 1
-
-        # if i > 1:
-        #     break
-
-        sample_artist_to_queue(
-            queue_name=queue_name,
-            artist_id = artist.artist_id,
-            artist_name = artist.artist_name,
-            latest=artist.num_latest,
-            total=artist.num_total)
+    # the queue is written once, after all the artists
+    with session():
+        i=0
+        for artist in next_q_artists.get_df().itertuples(index=False):
+            i += 1
+
+            # if i > 1:
+            #     break
+
+            sample_artist_to_queue(
+                queue_name=queue_name,
+                artist_id = artist.artist_id,
+                artist_name = artist.artist_name,
+                latest=artist.num_latest,
+                total=artist.num_total)
 
     return
 
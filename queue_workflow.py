@@ -17,22 +17,23 @@ def sanity_check_disk_queue(disk_queue_name):
     library = RekordboxPlaylist('Main Library')
     print(f'Library: {len(library)} tracks')
 
-    # entries in the queue should be unique
-    queue.deduplicate()
-    queue.deduplicate(function=get_track_signature)
+    with session():
+        # entries in the queue should be unique
+        queue.deduplicate()
+        queue.deduplicate(function=get_track_signature)
 
-    # entries in listening history should be unique
-    listening_history.deduplicate()
+        # entries in listening history should be unique
+        listening_history.deduplicate()
 
-    # queue tracks should not be in listening history
-    listening_history.filter(queue)
+        # queue tracks should not be in listening history
+        listening_history.filter(queue)
 
-    # library tracks should be in listening history and should not be in queue
-    listening_history.append(library)
-    queue.remove(library)
+        # library tracks should be in listening history and should not be in queue
+        listening_history.append(library)
+        queue.remove(library)
 
-    queue.write()
-    listening_history.write()
+        queue.write()
+        listening_history.write()
 
     return
 
@@ -336,31 +337,33 @@ def queue_maintenance(
                 raise ValueError(f"Promote queue '{promote_source}' is at level {promote_source_level} "
                                  f"but promote target '{promote_target}' is at level {promote_target_level}")
 
-    # Sanity check! Queue and listening history must be disjoint
-    if disk_queue is not None:
-        sanity_check_disk_queue(disk_queue)
-
-    for i, level in enumerate(spotify_queues):
-        for spotify_queue in level:
-            sanity_check_spotify_queue(spotify_queue,
-                                       is_level_1=(i==0),
-                                       is_promote_queue=(spotify_queue == promote_source))
-
-    sys.stdout.flush()
-
-    if last_track is not None:
-        promote_tracks_in_spotify_queue(
-            last_track=last_track,
-            promote_source_name=promote_source,
-            promote_target_name=promote_target,
-            side_playlist_name=side_playlist,
-            unambiguous_prefix=unambiguous_prefix,
-            disk_queue=disk_queue if promote_source_level==1 else None,
-            method=method,
-            ref_playlist=ref_playlist,
-            remove_from_source=remove_from_source,
-            add_to_listening_history=(add_to_listening_history and promote_source_level==1)
-        )
+    # all the writes go out at the end
+    with session():
+        # Sanity check! Queue and listening history must be disjoint
+        if disk_queue is not None:
+            sanity_check_disk_queue(disk_queue)
+
+        for i, level in enumerate(spotify_queues):
+            for spotify_queue in level:
+                sanity_check_spotify_queue(spotify_queue,
+                                           is_level_1=(i==0),
+                                           is_promote_queue=(spotify_queue == promote_source))
+
+        sys.stdout.flush()
+
+        if last_track is not None:
+            promote_tracks_in_spotify_queue(
+                last_track=last_track,
+                promote_source_name=promote_source,
+                promote_target_name=promote_target,
+                side_playlist_name=side_playlist,
+                unambiguous_prefix=unambiguous_prefix,
+                disk_queue=disk_queue if promote_source_level==1 else None,
+                method=method,
+                ref_playlist=ref_playlist,
+                remove_from_source=remove_from_source,
+                add_to_listening_history=(add_to_listening_history and promote_source_level==1)
+            )
 
     return
 
@@ -0,0 +1,243 @@
+"""
+Append-only storage for docs that mostly grow, like the listening history.
+
+Rows live in CSV segments partitioned by month of a datetime column:
+
+    <directory>/2024-05-000000.csv
+    <directory>/2024-05-000001.csv
+    <directory>/undated-000000.csv
+
+Writing appends the rows after the ones stored, as one new segment per month they fall in,
+so the cost is proportional to the rows added. Every row is stored with its position in the
+log (_POSITION_COLUMN), and reading concatenates the segments and sorts the rows by it, so
+they're read back in the order they were written even though each month is stored apart.
+Once there are too many segments, each month is compacted back into a single segment.
+Removing rows rewrites the whole log.
+
+The whole set of segments is replaced by building it in <directory>.new, renaming the
+directory to <directory>.old and <directory>.new to the directory. A crash can leave either
+of them behind; the next access finishes the swap if the new log was complete, i.e. the old
+one was already moved aside, and rolls it back otherwise.
+
+Rows are stored by position, so the index needn't be unique (a track listened to twice is
+two rows). The stored rows are expected to stay at the start of the DF that's written; if
+they don't, the log is rewritten. A stored row that is changed in place is not written again
+until the next rewrite or compaction.
+"""
+
+import logging
+import os
+import os.path
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+_SEGMENT_PATTERN = re.compile(r'^(\d{4}-\d{2}|undated)-(\d{6})\.csv$')
+
+_UNDATED_PARTITION = 'undated'
+
+# the position of the row in the log; the rows of segments written without it are read
+# first, in segment order
+_POSITION_COLUMN = 'log_position'
+
+# compact once there are more segments than this
+_DEFAULT_MAX_SEGMENTS = 100
+
+
+class SegmentedLog:
+    def __init__(self, directory, *, index_column, partition_column, datetime_columns=(),
+                 max_segments=_DEFAULT_MAX_SEGMENTS):
+        self._directory = directory
+        self._index_column = index_column
+        self._partition_column = partition_column
+        self._datetime_columns = list(datetime_columns)
+        self._max_segments = max_segments
+
+        # the index of the rows in the segments on disk, in the order they were written
+        self._stored_index = None
+        return
+
+    def _recover(self):
+        """Finishes or rolls back a rewrite that was interrupted."""
+        new_directory = self._directory + '.new'
+        old_directory = self._directory + '.old'
+
+        if os.path.isdir(self._directory):
+            # the swap happened, or never started
+            for directory in [new_directory, old_directory]:
+                if os.path.exists(directory):
+                    logger.warning('Segmented log %s: removing %s left by an interrupted rewrite',
+                                   self._directory, directory)
+                    shutil.rmtree(directory)
+            return
+
+        if os.path.isdir(old_directory):
+            if os.path.isdir(new_directory):
+                # the old log was moved aside, so the new one is complete
+                logger.warning('Segmented log %s: finishing an interrupted rewrite', self._directory)
+                os.rename(new_directory, self._directory)
+                shutil.rmtree(old_directory)
+            else:
+                logger.warning('Segmented log %s: rolling back an interrupted rewrite', self._directory)
+                os.rename(old_directory, self._directory)
+            return
+
+        if os.path.isdir(new_directory):
+            # the first rewrite was interrupted before the new log was complete
+            logger.warning('Segmented log %s: removing the incomplete first rewrite', self._directory)
+            shutil.rmtree(new_directory)
+        return
+
+    def exists(self):
+        self._recover()
+        return os.path.isdir(self._directory)
+
+    def getmtime(self):
+        """The time segments were last added or the log rewritten."""
+        return os.path.getmtime(self._directory) if self.exists() else None
+
+    def _segments(self, directory=None):
+        """Returns (partition, sequence number, file name) for every segment, in order."""
+        if directory is None:
+            directory = self._directory
+        if not os.path.isdir(directory):
+            return []
+
+        segments = []
+        for filename in os.listdir(directory):
+            m = _SEGMENT_PATTERN.match(filename)
+            if m is not None:
+                segments.append((m.group(1), int(m.group(2)), filename))
+
+        return sorted(segments)
+
+    def get_num_segments(self):
+        return len(self._segments())
+
+    def read(self) -> pd.DataFrame:
+        self._recover()
+        segments = self._segments()
+
+        dfs = [
+            pd.read_csv(os.path.join(self._directory, filename))
+            for _, _, filename in segments
+        ]
+        dfs = [df for df in dfs if len(df) > 0]
+
+        if len(dfs) == 0:
+            df = pd.DataFrame(columns=[self._index_column])
+        else:
+            df = pd.concat(dfs, ignore_index=True)
+
+        if _POSITION_COLUMN in df.columns:
+            df = df.sort_values(_POSITION_COLUMN, kind='stable', na_position='first')
+            df = df.drop(columns=_POSITION_COLUMN).reset_index(drop=True)
+
+        for column in self._datetime_columns:
+            if column in df.columns:
+                df[column] = pd.to_datetime(df[column], utc=True, format='ISO8601')
+
+        df = df.set_index(self._index_column, drop=False)
+
+        logger.debug('Segmented log %s: read %d rows from %d segments',
+                     self._directory, len(df), len(segments))
+
+        self._stored_index = df.index.copy()
+        return df
+
+    def _partitions(self, df: pd.DataFrame) -> pd.Series:
+        return df[self._partition_column].dt.strftime('%Y-%m').fillna(_UNDATED_PARTITION)
+
+    def _to_csv(self, df: pd.DataFrame, positions, path):
+        if self._index_column not in df.columns:
+            df = df.reset_index()
+        df = df.assign(**{_POSITION_COLUMN: positions})
+
+        tmp_path = path + '.tmp'
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        return
+
+    def write(self, df: pd.DataFrame):
+        """Stores df, appending only the rows after the stored ones. Returns the number of
+           rows written."""
+        if self._stored_index is None:
+            if self.exists():
+                self.read()
+            else:
+                return self.rewrite(df)
+
+        num_stored = len(self._stored_index)
+        if len(df) < num_stored or not df.index[:num_stored].equals(self._stored_index):
+            # rows were removed or reordered
+            return self.rewrite(df)
+
+        new_rows = df.iloc[num_stored:]
+
+        if len(new_rows) == 0:
+            return 0
+
+        next_sequence = {}
+        for partition, sequence, _ in self._segments():
+            next_sequence[partition] = sequence + 1
+
+        partitions = self._partitions(new_rows).to_numpy()
+        positions = np.arange(num_stored, len(df))
+        for partition in sorted(set(partitions)):
+            is_in_partition = partitions == partition
+            sequence = next_sequence.get(partition, 0)
+            self._to_csv(new_rows[is_in_partition], positions[is_in_partition],
+                         os.path.join(self._directory, f'{partition}-{sequence:06d}.csv'))
+
+        logger.debug('Segmented log %s: appended %d rows', self._directory, len(new_rows))
+
+        self._stored_index = df.index.copy()
+
+        if self.get_num_segments() > self._max_segments:
+            self.compact(df)
+
+        return len(new_rows)
+
+    def rewrite(self, df: pd.DataFrame):
+        """Replaces the whole log with df, one segment per month. Returns the number of
+           rows written."""
+        new_directory = self._directory + '.new'
+        old_directory = self._directory + '.old'
+
+        for directory in [new_directory, old_directory]:
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+        os.makedirs(new_directory)
+
+        if len(df) > 0:
+            partitions = self._partitions(df).to_numpy()
+            for partition in sorted(set(partitions)):
+                is_in_partition = partitions == partition
+                self._to_csv(df[is_in_partition], np.flatnonzero(is_in_partition),
+                             os.path.join(new_directory, f'{partition}-000000.csv'))
+
+        if os.path.exists(self._directory):
+            os.rename(self._directory, old_directory)
+        os.rename(new_directory, self._directory)
+        if os.path.exists(old_directory):
+            shutil.rmtree(old_directory)
+
+        logger.debug('Segmented log %s: rewrote %d rows', self._directory, len(df))
+
+        self._stored_index = df.index.copy()
+        return len(df)
+
+    def compact(self, df: pd.DataFrame = None):
+        """Merges the segments of every month into one."""
+        if df is None:
+            df = self.read()
+
+        num_segments = self.get_num_segments()
+        self.rewrite(df)
+
+        print(f'Compacted {num_segments} segments into {self.get_num_segments()}')
+        return
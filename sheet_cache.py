@@ -0,0 +1,181 @@
+"""
+Local cache of Google Sheet docs.
+
+Downloading a sheet is slow, and most runs read sheets that haven't changed since the last
+one. The DF of every sheet doc read is pickled to
+
+    <default_dir>/sheet_cache/<doc name>.pickle
+
+along with the sheet's Drive revision (modifiedTime and version) at the time. The first
+read of a sheet in a process asks Drive for the current revision, a single small request,
+and downloads the sheet only if it differs from the cached one. Frames are then kept in
+memory for the rest of the process and returned without asking Drive again, so docs
+constructed over and over in one session share one load; every read gets its own copy of
+the frame to modify. Changes made to a sheet elsewhere during the session are only seen by
+forced reads, which bypass the cache.
+
+Drive is reached through an adapter with a single method, get_revision(file_id);
+set_drive_api() replaces it, e.g. to test without Google. If the revision can't be had, the
+sheet is downloaded without the cache.
+"""
+
+import logging
+import os
+import os.path
+import pickle
+
+import pandas as pd
+
+import djlib_config
+
+logger = logging.getLogger(__name__)
+
+_singleton = None
+
+_drive_api = None
+
+
+class GoogleDriveFiles:
+    """The Drive files API, authorized with the credentials of the google config section
+       (see djlib_config.get_google_credentials)."""
+    def __init__(self, credentials):
+        self._credentials = credentials
+        self._service = None
+        return
+
+    def _get_service(self):
+        if self._service is None:
+            from googleapiclient.discovery import build
+
+            self._service = build('drive', 'v3', credentials=self._credentials, cache_discovery=False)
+        return self._service
+
+    def get_revision(self, file_id):
+        result = self._get_service().files().get(
+            fileId=file_id, fields='modifiedTime,version').execute()
+        return result['modifiedTime'], result.get('version')
+
+
+def get_drive_api():
+    global _drive_api
+    if _drive_api is None:
+        _drive_api = GoogleDriveFiles(djlib_config.get_google_credentials())
+    return _drive_api
+
+
+def set_drive_api(drive_api):
+    global _drive_api
+    _drive_api = drive_api
+    return
+
+
+class SheetCache:
+    def __init__(self, directory):
+        self._directory = directory
+        # doc name -> (revision, df)
+        self._frames = {}
+        # sheet path -> spreadsheet ID
+        self._file_ids = {}
+
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def get_file_id(self, path):
+        file_id = self._file_ids.get(path)
+        if file_id is None:
+            file_id = djlib_config.google.get_file_id(name=path, type='sheet')
+            if file_id is None:
+                raise ValueError(f"Google sheet '{path}' does not exist")
+            self._file_ids[path] = file_id
+        return file_id
+
+    def _get_path(self, name):
+        return os.path.join(self._directory, f'{name}.pickle')
+
+    def _load(self, name):
+        path = self._get_path(name)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'rb') as cache_file:
+                entry = pickle.load(cache_file)
+        except Exception as e:
+            logger.warning('Could not read the sheet cache %s: %s', path, str(e))
+            return None
+
+        return entry['revision'], entry['df']
+
+    def _store(self, name, revision, df: pd.DataFrame):
+        df = df.copy()
+        self._frames[name] = (revision, df)
+
+        os.makedirs(self._directory, exist_ok=True)
+        path = self._get_path(name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump({'revision': revision, 'df': df}, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return
+
+    def _get_revision(self, name, sheet_path):
+        """Returns the sheet's revision on Drive, or None if it can't be had."""
+        try:
+            return get_drive_api().get_revision(self.get_file_id(sheet_path))
+        except Exception as e:
+            logger.warning('Sheet cache: could not get the revision of %s, bypassing the cache: %s',
+                           name, str(e))
+            return None
+
+    def read(self, name, sheet_path, download) -> pd.DataFrame:
+        """Returns the doc's DF from memory if it was loaded in this process, or from the
+           cache if the sheet hasn't changed on Drive since it was cached; otherwise calls
+           download() and caches what it returns. If the revision can't be checked, calls
+           download() and leaves the cache alone."""
+        entry = self._frames.get(name)
+        if entry is not None:
+            self.hits += 1
+            return entry[1].copy()
+
+        revision = self._get_revision(name, sheet_path)
+        if revision is None:
+            self.misses += 1
+            return download()
+
+        entry = self._load(name)
+        if entry is not None and entry[0] == revision:
+            self._frames[name] = entry
+            self.hits += 1
+            logger.debug('Sheet cache: %s is up to date (%s)', name, revision)
+            return entry[1].copy()
+
+        self.misses += 1
+        logger.debug('Sheet cache: downloading %s (%s)', name, revision)
+        df = download()
+        self._store(name, revision, df)
+        return df
+
+    def written(self, name, sheet_path, df: pd.DataFrame):
+        """Caches df as the contents of the sheet after it was written."""
+        revision = self._get_revision(name, sheet_path)
+        if revision is None:
+            # the next read can't tell whether the cached copy is current
+            self.invalidate(name)
+            return
+        self._store(name, revision, df)
+        return
+
+    def invalidate(self, name):
+        self._frames.pop(name, None)
+        path = self._get_path(name)
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+
+def get_instance():
+    global _singleton
+    if _singleton is None:
+        _singleton = SheetCache(os.path.join(djlib_config.default_dir, 'sheet_cache'))
+    return _singleton
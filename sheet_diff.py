@@ -0,0 +1,206 @@
+"""
+Cell-level writes for Google Sheet docs.
+
+When a sheet doc is read, the cell values of its DF are remembered. On write, the DF is
+converted to cell values again and compared with them; only the cells that differ are sent,
+grouped into one A1 range per run of consecutive changed rows in a column, all in a single
+batch update. Writing a column or a few cells then costs a request proportional to the
+edit, not to the sheet.
+
+A diff is only possible if the rows and columns are the same ones, in the same order, as
+when the doc was read; otherwise the caller writes the whole sheet. The DF's columns are the
+sheet's columns in order, preceded by the index column if it isn't one of the DF's columns.
+
+Cell values are what a full write would put in the sheet: empty for missing values, lists
+joined with ', ', TRUE/FALSE for booleans and datetimes in the doc's datetime_format. They
+are sent as USER_ENTERED, so the sheet parses numbers, booleans and dates as if typed in.
+
+The Sheets values API is reached through an adapter with a single method,
+batch_update(spreadsheet_id, data), data being a list of {'range': ..., 'values': ...}.
+set_values_api() replaces it, e.g. with a LocalSheetValues to test against.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+import djlib_config
+
+logger = logging.getLogger(__name__)
+
+_values_api = None
+
+
+class GoogleSheetValues:
+    """The Sheets values API, authorized with the credentials of the google config section
+       (see djlib_config.get_google_credentials)."""
+    def __init__(self, credentials):
+        self._credentials = credentials
+        self._service = None
+        return
+
+    def _get_service(self):
+        if self._service is None:
+            from googleapiclient.discovery import build
+
+            self._service = build('sheets', 'v4', credentials=self._credentials, cache_discovery=False)
+        return self._service
+
+    def batch_update(self, spreadsheet_id, data):
+        return self._get_service().spreadsheets().values().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={'valueInputOption': 'USER_ENTERED', 'data': data}
+        ).execute()
+
+
+class LocalSheetValues:
+    """A stand-in for the Sheets values API that applies updates to in-memory grids and
+       records the requests, to check what a write sends."""
+    def __init__(self):
+        # (spreadsheet_id, sheet) -> {(row, column): value}, both 1-based
+        self.cells = {}
+        self.requests = []
+        return
+
+    def batch_update(self, spreadsheet_id, data):
+        self.requests.append((spreadsheet_id, data))
+        for update in data:
+            sheet, first_row, first_column = _parse_range(update['range'])
+            grid = self.cells.setdefault((spreadsheet_id, sheet), {})
+            for i, row in enumerate(update['values']):
+                for j, value in enumerate(row):
+                    grid[(first_row + i, first_column + j)] = value
+        return {'totalUpdatedCells': sum(len(row) for update in data for row in update['values'])}
+
+
+def get_values_api():
+    global _values_api
+    if _values_api is None:
+        _values_api = GoogleSheetValues(djlib_config.get_google_credentials())
+    return _values_api
+
+
+def set_values_api(values_api):
+    global _values_api
+    _values_api = values_api
+    return
+
+
+def column_letter(position):
+    """0 -> A, 25 -> Z, 26 -> AA"""
+    letters = ''
+    position += 1
+    while position > 0:
+        position, remainder = divmod(position - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def _column_number(letters):
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord('A') + 1
+    return number
+
+
+def _parse_range(a1_range):
+    """e.g. 'Sheet'!B3:B7 -> ('Sheet', 3, 2)"""
+    sheet, cells = a1_range.rsplit('!', 1)
+    if sheet.startswith("'"):
+        sheet = sheet[1:-1].replace("''", "'")
+    first_cell = cells.split(':')[0]
+    letters = first_cell.rstrip('0123456789')
+    return sheet, int(first_cell[len(letters):]), _column_number(letters)
+
+
+def _a1_range(sheet, column, first_row, last_row):
+    sheet = "'" + sheet.replace("'", "''") + "'"
+    letter = column_letter(column)
+    return f'{sheet}!{letter}{first_row}:{letter}{last_row}'
+
+
+def _cell_value(value, datetime_format):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return ', '.join(str(item) for item in value)
+    if value is None or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return ''
+    if isinstance(value, (bool, np.bool_)):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, pd.Timestamp) and datetime_format is not None:
+        return value.strftime(datetime_format)
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def cell_values(df: pd.DataFrame, datetime_format=None) -> np.ndarray:
+    """Returns the cell values of the DF, as a 2D array of strings."""
+    values = np.empty(df.shape, dtype=object)
+    for j in range(df.shape[1]):
+        values[:, j] = [_cell_value(value, datetime_format) for value in df.iloc[:, j]]
+    return values
+
+
+class SheetSnapshot:
+    """The cell values of a sheet doc's DF as read or last written."""
+    def __init__(self, df: pd.DataFrame, datetime_format=None, index_column=None):
+        self._datetime_format = datetime_format
+        self._index_column = index_column
+        self._index = df.index.copy()
+        self._columns = list(df.columns)
+        self._values = self._cell_values(df)
+        return
+
+    def _cell_values(self, df: pd.DataFrame):
+        # the sheet columns, in order
+        if self._index_column is not None and self._index_column not in df.columns:
+            df = df.reset_index()
+        return cell_values(df, self._datetime_format)
+
+    def matches_structure(self, df: pd.DataFrame):
+        return list(df.columns) == self._columns and df.index.equals(self._index)
+
+    def diff(self, df: pd.DataFrame, sheet, header_row=1):
+        """Returns the updates that turn the snapshot into df, for a batch update;
+           header_row is the sheet row of the column names, the data starting after it.
+           The DF must match the structure of the snapshot."""
+        values = self._cell_values(df)
+        changed = values != self._values
+
+        data = []
+        for column in np.flatnonzero(changed.any(axis=0)):
+            rows = np.flatnonzero(changed[:, column])
+
+            # runs of consecutive rows
+            run_starts = np.concatenate([[0], np.flatnonzero(np.diff(rows) > 1) + 1])
+            run_ends = np.concatenate([run_starts[1:], [len(rows)]])
+
+            for start, end in zip(run_starts, run_ends):
+                first, last = rows[start], rows[end - 1]
+                data.append({
+                    'range': _a1_range(sheet, column,
+                                       header_row + 1 + first, header_row + 1 + last),
+                    'values': [[value] for value in values[first:last + 1, column]],
+                })
+
+        return data, values
+
+    def update(self, values):
+        self._values = values
+        return
+
+
+def write_diff(snapshot: SheetSnapshot, df: pd.DataFrame, spreadsheet_id, sheet, header_row=1):
+    """Sends the cells of df that changed since the snapshot in one batch update. Returns
+       the number of cells sent."""
+    data, values = snapshot.diff(df, sheet, header_row=header_row)
+
+    num_cells = sum(len(update['values']) for update in data)
+    if len(data) > 0:
+        get_values_api().batch_update(spreadsheet_id, data)
+
+    logger.debug('Sheet %s: %d cells in %d ranges written', sheet, num_cells, len(data))
+
+    snapshot.update(values)
+    return num_cells
@@ -14,9 +14,26 @@ import numpy as np
 
 from local_util import *
 from spyroslib import cache
+from token_manager import TokenManager
 
 logger = logging.getLogger(__name__)
 
+def _token_to_file_obj(token):
+    return {
+        'access_token': token['access_token'],
+        'refresh_token': token['refresh_token'],
+        # local time, as in the files written before the token manager
+        'expires_at': str(pd.Timestamp.fromtimestamp(token['expires_at']))
+    }
+
+def _token_from_file_obj(obj):
+    return {
+        'access_token': obj['access_token'],
+        'refresh_token': obj['refresh_token'],
+        'expires_at': pd.Timestamp(obj['expires_at']).to_pydatetime().timestamp()
+    }
+
+
 class SoundcloudInterface:
     def __init__(self, config):
         self._client_id = config['client_id']
@@ -34,54 +51,21 @@ class SoundcloudInterface:
         self._redirect_uri = config['redirect_uri']
         self._cached_token_file = config['cached_token_file']
 
-        self._access_token = None
-        self._refresh_token = None
-        self._access_token_expires_at = None
+        self._token_manager = TokenManager(
+            'SoundCloud',
+            self._cached_token_file,
+            authorize_func=self._authorization_workflow,
+            refresh_func=self._refresh_token_workflow,
+            to_file_func=_token_to_file_obj,
+            from_file_func=_token_from_file_obj
+        )
 
         self._cache = cache.Cache()
 
         return
 
     def _ensure_access_token(self):
-        if self._access_token is None:
-            if os.path.exists(self._cached_token_file):
-                try:
-                    self._read_access_token_file()
-                except Exception as e:
-                    print(f'Reading Soundcloud access token file failed: {str(e)}')
-                    self._authorization_workflow()
-
-        if self._access_token_expires_at is not None and \
-            pd.Timestamp.now() < self._access_token_expires_at:
-            return
-
-        if self._refresh_token is not None:
-            try:
-                self._refresh_token_workflow()
-            except Exception as e:
-                print(f'Refreshing Soundcloud access token failed: {str(e)}')
-                self._authorization_workflow()
-
-        return
-
-    def _read_access_token_file(self):
-        with open(self._cached_token_file) as token_fh:
-            obj = json.load(token_fh)
-            self._access_token = obj['access_token']
-            self._refresh_token = obj['refresh_token']
-            self._access_token_expires_at = pd.Timestamp(obj['expires_at'])
-
-    def _write_access_token_file(self):
-        with open(self._cached_token_file, 'w') as token_file:
-            json.dump(
-                obj={
-                    'access_token': self._access_token,
-                    'refresh_token': self._refresh_token,
-                    'expires_at': str(self._access_token_expires_at)
-                },
-                fp= token_file,
-                indent=2)
-        return
+        return self._token_manager.get_access_token()
 
     def _authorization_workflow(self):
         state = random_string(10)
@@ -150,17 +134,13 @@ class SoundcloudInterface:
 
         post_response_data = post_response.json()
 
-        self._access_token = post_response_data['access_token']
-        self._refresh_token = post_response_data['refresh_token']
-        expires_in = post_response_data['expires_in']
-        self._access_token_expires_at = pd.Timestamp.now() + pd.Timedelta(seconds=expires_in-10)
-
-        self._write_access_token_file()
-        return
-
-    def _refresh_token_workflow(self):
-        assert self._refresh_token is not None
+        return {
+            'access_token': post_response_data['access_token'],
+            'refresh_token': post_response_data['refresh_token'],
+            'expires_at': time.time() + post_response_data['expires_in'] - 10
+        }
 
+    def _refresh_token_workflow(self, refresh_token):
         post_headers = {
             'accept': 'application/json; charset=utf-8',
             'Content-Type': 'application/x-www-form-urlencoded'
@@ -171,7 +151,7 @@ class SoundcloudInterface:
             'client_id': self._client_id,
             'client_secret': self._client_secret,
             'redirect_uri': self._redirect_uri,
-            'refresh_token': self._refresh_token
+            'refresh_token': refresh_token
         }
 
         post_response = requests.post(
@@ -186,20 +166,18 @@ class SoundcloudInterface:
 
         post_response_data = post_response.json()
 
-        self._access_token = post_response_data['access_token']
-        self._refresh_token = post_response_data['refresh_token']
-        expires_in = post_response_data['expires_in']
-        self._access_token_expires_at = pd.Timestamp.now() + pd.Timedelta(seconds=expires_in-10)
-
-        self._write_access_token_file()
-        return
+        return {
+            'access_token': post_response_data['access_token'],
+            'refresh_token': post_response_data['refresh_token'],
+            'expires_at': time.time() + post_response_data['expires_in'] - 10
+        }
 
     def current_user(self):
-        self._ensure_access_token()
+        access_token = self._ensure_access_token()
 
         headers = {
             'accept': 'application/json; charset=utf-8',
-            'Authorization': f'OAuth {self._access_token}'
+            'Authorization': f'OAuth {access_token}'
         }
 
         response = requests.get(
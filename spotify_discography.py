@@ -11,134 +11,232 @@ Both these stages can be cached to disk, so that they don't have to be repeated
 - Album tracks should never change; once recovered, they can be used forever.
 - An artist's albums can change, but there is no need to refresh them very frequently;
   once a week or so should be enough.
+
+The cache lives in a single SQLite file (see discography_store). The older per-artist and
+per-album CSV directories are migrated into it the first time it's opened.
 """
 
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pytz
 
 import djlib_config
 from containers import *
 from spotify_util import *
+from discography_store import DiscographyStore
+from artist_directory import ArtistDirectory, get_instance as get_artist_directory
 
 logger = logging.getLogger(__name__)
 
 _singleton = None
 
-class _SpotifyDiscography:
-    def __init__(self):
-        self._artists_by_id = None
-        self._artists_by_name = None
-
-        self._open_docs = {
-            'artist-tracks': {},
-            'artist-albums': {},
-            'album-tracks': {},
-        }
+# Refresh scheduling; see rank_artists_for_refresh()
+# release interval assumed for artists with fewer than two known releases
+_DEFAULT_RELEASE_INTERVAL_DAYS = 365
+_MIN_RELEASE_INTERVAL_DAYS = 7
+# an artist is considered dormant after this many release intervals without a release
+_DORMANCY_INTERVALS = 3
+# weight of each of the artist's A and B tracks in the value of a refresh
+_A_TRACK_WEIGHT = 2
+_B_TRACK_WEIGHT = 1
+# a never-checked artist needs the full album list and the tracks of every album
+_NEW_ARTIST_EXPECTED_REQUESTS = 20
+_ALBUM_PAGE_SIZE = 50
+
+# Album fetch policy; see _AlbumFetchPolicy
+_ALBUM_TRACKS_PAGE_SIZE = 50
+# rough size of a track in an album tracks response, for reporting
+_ESTIMATED_BYTES_PER_TRACK = 2000
+
+
+class _ProgressReporter:
+    """Prints throughput and ETA for a long-running stage."""
+    def __init__(self, stage, total, every=10):
+        self._stage = stage
+        self._total = total
+        self._every = every
+        self._done = 0
+        self._start_time = time.time()
+
+    def step(self, n=1):
+        self._done += n
+        if self._done % self._every != 0 and self._done != self._total:
+            return
 
+        elapsed = time.time() - self._start_time
+        rate = self._done / elapsed if elapsed > 0 else 0.0
+        eta = (self._total - self._done) / rate if rate > 0 else float('nan')
+
+        print(f'{self._stage}: {self._done}/{self._total} done, {rate:.1f}/s, '
+              f'{elapsed:.0f} s elapsed, ETA {eta:.0f} s')
+        sys.stdout.flush()
+
+
+class _AlbumFetchPolicy:
+    """
+    Decides which albums' tracks are worth fetching, based on the album's group relative to
+    the artist (album, single, compilation, appears_on):
+    - albums in groups that aren't included are skipped
+    - compilations and appears_on albums by an artist or with a name on the skip list
+      (e.g. Various Artists, or a compilation series) are skipped
+    - appears_on albums with more than appears_on_max_tracks tracks are skipped; those are
+      mostly big compilations with one track by the artist
+    Album tracks are stored once for all artists, so a skipped album whose tracks were
+    fetched for another artist still counts towards this artist's discography.
+    Skipped artist-album links are marked in the store with the policy's key, so later
+    refreshes under the same settings don't consider (or count) them again; a change of
+    settings gives a new key, and every album is considered afresh.
+    Keeps count of what the skipped albums would have cost, each album once, apart from the
+    requests saved by the tracks embedded in album responses.
+    """
+    def __init__(self, include_groups=None, skip_list=(), appears_on_max_tracks=None):
+        self._include_groups = include_groups
+        self._skip_list = [entry.upper() for entry in skip_list if entry]
+        self._appears_on_max_tracks = appears_on_max_tracks
+
+        self._skipped_album_ids = set()
+        self.albums_skipped = 0
+        self.tracks_skipped = 0
+        self.requests_saved = 0
+        self.embedded_requests_saved = 0
         return
 
-    def _init_artists(self):
-        if self._artists_by_id is not None:
-            return
-
-        listening_history = ListeningHistory()
+    @staticmethod
+    def from_config():
+        return _AlbumFetchPolicy(
+            include_groups=djlib_config.album_include_groups,
+            skip_list=djlib_config.compilation_skip_list,
+            appears_on_max_tracks=djlib_config.appears_on_max_tracks)
+
+    def get_include_groups(self):
+        return self._include_groups
+
+    def get_key(self):
+        """Identifies the policy's settings."""
+        include_groups = None if self._include_groups is None else sorted(self._include_groups)
+        return f'{include_groups}|{sorted(self._skip_list)}|{self._appears_on_max_tracks}'
+
+    def select(self, albums: pd.DataFrame, store: DiscographyStore = None) -> pd.DataFrame:
+        """Returns the albums to fetch, each once. albums may list an album several times,
+           once per artist link; it's fetched if any of the links qualifies. Albums
+           without an album_group count as albums. With a store, the skipped links (from the
+           artist_id column) are marked in it."""
+        if len(albums) == 0:
+            return albums
+
+        group = albums['album_group'].fillna('album')
+
+        skip = pd.Series(False, index=albums.index)
+
+        if self._include_groups is not None:
+            skip |= ~group.isin(self._include_groups)
+
+        if len(self._skip_list) > 0:
+            names = albums['name'].fillna('').str.upper()
+            artist_names = '|' + albums['artist_names'].fillna('').str.upper() + '|'
+            listed = pd.Series(False, index=albums.index)
+            for entry in self._skip_list:
+                listed |= (names.str.contains(entry, regex=False) |
+                           artist_names.str.contains('|' + entry + '|', regex=False))
+            skip |= group.isin(['compilation', 'appears_on']) & listed
+
+        if self._appears_on_max_tracks is not None:
+            skip |= (group == 'appears_on') & (albums['total_tracks'] > self._appears_on_max_tracks)
+
+        selected = albums.loc[~skip]
+        selected = selected.loc[~selected.index.duplicated()]
+
+        if store is not None and skip.any():
+            skip_links = skip.to_numpy()
+            store.mark_skipped(zip(albums['artist_id'].to_numpy()[skip_links], albums.index[skip_links]),
+                               self.get_key())
+
+        skipped = albums.loc[skip & ~albums.index.isin(selected.index)]
+        skipped = skipped.loc[~skipped.index.duplicated()]
+        skipped = skipped.loc[~skipped.index.isin(self._skipped_album_ids)]
+        self._skipped_album_ids.update(skipped.index)
+
+        skipped_tracks = skipped['total_tracks'].fillna(0)
+
+        self.albums_skipped += len(skipped)
+        self.tracks_skipped += int(skipped_tracks.sum())
+        # the album request has the first page of tracks embedded
+        self.requests_saved += int(np.maximum(1, np.ceil(skipped_tracks / _ALBUM_TRACKS_PAGE_SIZE)).sum())
+
+        return selected
+
+    def record_fetched(self, num_albums):
+        # the separate albums/{id}/tracks request that the embedded first page replaces
+        self.embedded_requests_saved += num_albums
+        return
 
-        self._artists_by_id = get_track_artists(listening_history)
+    def report(self):
+        print(f'Fetch policy: skipped {self.albums_skipped} albums with {self.tracks_skipped} tracks; '
+              f'saved {self.requests_saved} requests, '
+              f'~{self.tracks_skipped * _ESTIMATED_BYTES_PER_TRACK / 1024 / 1024:.1f} MB')
+        print(f'Embedded first pages of album tracks: saved {self.embedded_requests_saved} requests')
+        return
 
-        self._artists_by_name = self._artists_by_id.set_index(keys='artist_name', inplace=False)
 
-        # if there are names with multiple IDs, keep the last one
-        self._artists_by_name = self._artists_by_name.loc[
-            ~self._artists_by_name.index.duplicated(keep='last')
-        ]
+class _SpotifyDiscography:
+    def __init__(self):
+        self._store = None
 
         return
 
-    def get_spotify_artists(self):
-        self._init_artists()
-        return self._artists_by_id
+    def _get_store(self) -> DiscographyStore:
+        if self._store is not None:
+            return self._store
 
-    def get_spotify_artist_id(self, artist_name):
-        self._init_artists()
-
-        if artist_name in self._artists_by_name.index:
-            return self._artists_by_name.loc[artist_name, 'artist_id']
-        else:
-            raise ValueError(f'Spotify artist with name {artist_name} not found.')
+        db_path = djlib_config.discography_db
+        if db_path is None:
+            db_path = os.path.join(djlib_config.default_dir, 'spotify-discography.sqlite')
 
-    def get_spotify_artist_name(self, artist_id):
-        self._init_artists()
+        self._store = DiscographyStore(db_path)
 
-        if artist_id in self._artists_by_id.index:
-            return self._artists_by_id.loc[artist_id, 'artist_name']
-        else:
-            raise ValueError(f'Spotify artist with id {artist_id} not found.')
+        if self._store.is_new:
+            self._store.migrate_from_csv_dirs(djlib_config.default_dir)
 
-    def _get_doc(self, doc_type: str, id: str, name: str, force=False) -> Doc:
-        if doc_type not in self._open_docs:
-            raise ValueError(f'Unknown doc type {doc_type}')
+        return self._store
 
-        if id in self._open_docs[doc_type]:
-            return self._open_docs[doc_type][id]
+    def get_store(self) -> DiscographyStore:
+        return self._get_store()
 
-        doc_dir = os.path.join(djlib_config.default_dir, 'spotify-' + doc_type)
+    def _get_artist_directory(self) -> ArtistDirectory:
+        artist_directory = get_artist_directory()
 
-        doc_files = os.listdir(doc_dir)
+        # artists that are only known from the discography; newly fetched album tracks
+        # are added as they come in
+        artist_directory.add_tracks_once('discography', self._get_store().query_tracks)
 
-        doc_file = None
-        doc_pattern = re.compile(r'^%s-%s-.*\.csv$' % (doc_type, id))
-        for file in doc_files:
-            if re.match(doc_pattern, file):
-                doc_file = file
-                break
+        return artist_directory
 
-        if doc_file is None:
-            doc_file = f'{doc_type}-{id}-{name.replace('/', '-')}.csv'
-            new_file = True
-        else:
-            new_file = False
-
-        if doc_type.endswith('albums'):
-            index_column = 'album_id'
-            datetime_columns = ['release_date']
-        elif doc_type.endswith('tracks'):
-            index_column = 'spotify_id'
-            datetime_columns = ['release_date', 'added_at']
-        else:
-            assert False
-
-        doc = Doc(
-            name=f'{doc_type} {id} {name}',
-            path=os.path.join(doc_dir, doc_file),
-            type='csv',
-            index_column=index_column,
-            datetime_columns=datetime_columns,
-            backups=0,
-            create=new_file,
-            overwrite=new_file or force,
-            modify=True
-        )
+    def get_spotify_artists(self):
+        return self._get_artist_directory().get_artists()
 
-        self._open_docs[doc_type][id] = doc
+    def get_spotify_artist_id(self, artist_name):
+        return self._get_artist_directory().get_artist_id(artist_name)
 
-        return doc
+    def get_spotify_artist_name(self, artist_id):
+        return self._get_artist_directory().get_artist_name(artist_id)
 
     def _refresh_artist_albums(self, artist_id, artist_name, *,
-                               refresh_days=30, force=False):
+                               refresh_days=30, force=False, silent=False):
         if refresh_days is None or refresh_days < 0:
             raise ValueError(f'Invalid value for refresh_days: {refresh_days}')
 
-        artist_albums_doc = self._get_doc('artist-albums', artist_id, artist_name, force=force)
+        store = self._get_store()
+
+        last_update, _ = store.get_refresh_times(artist_id)
 
         if force:
             refresh = True
-        elif not artist_albums_doc.exists():
+        elif last_update is None:
             logger.debug('Artist %s %s: albums have never been fetched', artist_id, artist_name)
             refresh = True
         else:
-            last_update = artist_albums_doc.getmtime()
             now = time.time()
 
             past_days = (now - last_update) / 24 / 3600
@@ -148,225 +246,213 @@ class _SpotifyDiscography:
             logger.debug('Artist %s %s: albums were last updated at %s, %.1f days ago; '
                          '%srefreshing',
                          artist_id, artist_name,
-                         pd.Timestamp(last_update), past_days,
+                         pd.Timestamp(last_update, unit='s'), past_days,
                          ('' if refresh else 'not ')
                          )
 
         if not refresh:
-            return
+            return False
 
-        print(f'Fetching albums for artist: {artist_id} {artist_name}...', end='')
+        album_total = None
+        if not force:
+            album_total = self._probe_artist_album_total(artist_id, artist_name)
+            if album_total is not None and album_total == store.get_album_fetch_info(artist_id)[1]:
+                # record the check; the albums we have are still the complete list
+                store.set_refresh_time(artist_id, artist_name, albums=time.time())
+                return False
 
-        artist_albums = get_artist_albums(artist_id)
+        if not silent:
+            print(f'Fetching albums for artist: {artist_id} {artist_name}...', end='')
 
-        if force:
-            print(f' {len(artist_albums)} fetched; replacing {len(artist_albums_doc)} existing albums')
+        artist_albums = djlib_config.spotify.get_artist_albums(
+            artist_id, include_groups=djlib_config.album_include_groups)
 
-            artist_albums_doc.set_df(artist_albums)
+        existing_albums_idx = store.get_artist_albums(artist_id).index
+
+        if force:
+            if not silent:
+                print(f' {len(artist_albums)} fetched; replacing {len(existing_albums_idx)} existing albums')
         else:
-            new_artist_albums_idx = artist_albums.index.difference(
-                artist_albums_doc.get_df().index, sort=False)
-            new_artist_albums = artist_albums.loc[new_artist_albums_idx]
+            new_artist_albums_idx = artist_albums.index.difference(existing_albums_idx, sort=False)
 
-            not_found_artist_albums_idx = artist_albums_doc.get_df().index.difference(
+            not_found_artist_albums_idx = existing_albums_idx.difference(
                 artist_albums.index, sort=False)
 
             # it seems this happens regularly for the more popular artists; downgrading to warning.
             if len(not_found_artist_albums_idx) > 0:
                 print(f'WARNING: Artist {artist_id} {artist_name}: {len(not_found_artist_albums_idx)} '
-                    f'out of {len(artist_albums_doc)} existing albums were not found in the '
+                    f'out of {len(existing_albums_idx)} existing albums were not found in the '
                     f'latest update')
-                # raise Exception(
-                #     f'Artist {artist_id} {artist_name}: {len(not_found_artist_albums_idx)} '
-                #     f'out of {len(artist_albums_doc)} existing albums were not found in the '
-                #     f'latest update; use force=True to replace the existing artist albums file')
 
-            print(f' {len(artist_albums)} fetched, {len(new_artist_albums)} new, '
-                  f'{len(artist_albums_doc) - len(new_artist_albums)} already there, '
-                  f'{len(not_found_artist_albums_idx)} not found')
+            if not silent:
+                print(f' {len(artist_albums)} fetched, {len(new_artist_albums_idx)} new, '
+                      f'{len(artist_albums) - len(new_artist_albums_idx)} already there, '
+                      f'{len(not_found_artist_albums_idx)} not found')
 
-            artist_albums_doc.append(new_artist_albums, prompt=False)
+        if len(artist_albums) > 0:
+            store.add_artist_albums(artist_id, artist_albums, replace=force)
 
-        # write it even if we found no new albums, so that the file's mtime moves to now
-        artist_albums_doc.write(force=True)
+        # record the check even if we found no new albums
+        now = time.time()
+        store.set_refresh_time(artist_id, artist_name, albums=now)
+        # the reported total can differ from the number of albums actually returned;
+        # keep the reported one when we have it, so the next probe compares like with like
+        store.set_album_fetch_info(artist_id, artist_name, now,
+                                   len(artist_albums) if album_total is None else album_total)
 
-        return
+        return True
+
+    def _probe_artist_album_total(self, artist_id, artist_name):
+        """
+        Returns the artist's current album total, fetched with a single one-item request, or
+        None if a full fetch is due anyway: the albums were never fully fetched, or not in
+        the last artist_albums_full_refresh_days. The periodic full fetch catches a release
+        being replaced by another, which leaves the total unchanged.
+        """
+        fetched_at, album_total = self._get_store().get_album_fetch_info(artist_id)
+
+        if fetched_at is None or album_total is None:
+            return None
+
+        past_days = (time.time() - fetched_at) / 24 / 3600
+        if past_days >= djlib_config.artist_albums_full_refresh_days:
+            logger.debug('Artist %s %s: last full album fetch %.1f days ago; fetching all albums',
+                         artist_id, artist_name, past_days)
+            return None
+
+        current_total = djlib_config.spotify.get_artist_album_count(
+            artist_id, include_groups=djlib_config.album_include_groups)
+
+        logger.debug('Artist %s %s: album total %d, %d at the last full fetch',
+                     artist_id, artist_name, current_total, album_total)
+
+        return current_total
 
 
     def _refresh_artist_tracks(self, artist_id, artist_name, *, force=False):
-        artist_tracks_doc = self._get_doc('artist-tracks', artist_id, artist_name, force=force)
-        artist_albums_doc = self._get_doc('artist-albums', artist_id, artist_name)
+        store = self._get_store()
 
-        orig_num_tracks = len(artist_tracks_doc)
+        albums_last_update, last_update = store.get_refresh_times(artist_id)
 
-        if not artist_albums_doc.exists():
+        if albums_last_update is None:
             logger.debug('Artist %s %s: albums have never been fetched, nothing to do',
                          artist_id, artist_name)
             return
 
         if force:
             refresh = True
-        elif not artist_tracks_doc.exists():
+        elif last_update is None:
             logger.debug('Artist %s %s: tracks have never been written', artist_id, artist_name)
             refresh = True
         else:
-            last_update = artist_tracks_doc.getmtime()
-
-            artist_albums_last_update = artist_albums_doc.getmtime()
-
-            refresh = last_update < artist_albums_last_update
+            refresh = last_update < albums_last_update
 
             logger.debug('Artist %s %s: albums were last updated at %s, tracks were last updated '
                          'at %s; %srefreshing',
                          artist_id, artist_name,
-                         pd.Timestamp(artist_albums_last_update), pd.Timestamp(last_update),
+                         pd.Timestamp(albums_last_update, unit='s'),
+                         pd.Timestamp(last_update, unit='s'),
                          ('' if refresh else 'not ')
                          )
 
         if not refresh:
             return
 
-        print(f'Writing tracks for artist: {artist_id} {artist_name}...', end='')
-
-        if force:
-            print(f" replacing {len(artist_tracks_doc)} existing tracks with tracks from "
-                  f"{len(artist_albums_doc)} albums")
-
-            artist_tracks_doc.truncate(prompt=False, silent=True)
-            new_artist_albums = artist_albums_doc.get_df()
-        else:
-            if len(artist_tracks_doc) > 0:
-                albums_in_artist_tracks = pd.Index(artist_tracks_doc.get_df().album_id).unique()
-            else:
-                albums_in_artist_tracks = pd.Index([])
-
-            not_found_artist_albums = albums_in_artist_tracks.difference(
-                artist_albums_doc.get_df().index, sort=False)
-
-            if len(not_found_artist_albums) > 0:
-                raise Exception(
-                    f'Artist {artist_id} {artist_name}: artist tracks contain {len(not_found_artist_albums)} '
-                    f'albums that are not in artist albums; use force=True to replace the existing '
-                    f'artist tracks file'
-                )
+        orig_num_tracks = len(store.get_artist_tracks(artist_id))
 
-            new_artist_albums_idx = artist_albums_doc.get_df().index.difference(
-                albums_in_artist_tracks, sort=False)
+        # album tracks never change, so even with force=True only albums whose tracks
+        # have never been fetched need requests
+        fetch_policy = _AlbumFetchPolicy.from_config()
+        new_artist_albums = fetch_policy.select(
+            store.get_unfetched_albums(artist_id, skipped_by=fetch_policy.get_key()), store=store)
 
-            new_artist_albums = artist_albums_doc.get_df().loc[new_artist_albums_idx]
-
-            print(f" {len(albums_in_artist_tracks)} albums' tracks already there, getting "
-                  f" {len(new_artist_albums)} new albums' tracks")
+        print(f'Writing tracks for artist: {artist_id} {artist_name}... getting '
+              f'{len(new_artist_albums)} new albums\' tracks')
 
         for album in new_artist_albums.itertuples():
-            album_tracks = self._get_album_tracks(album.album_id, album.name)
-
-            artist_album_tracks = album_tracks.get_df().loc[
-                album_tracks.get_df().apply(
-                    lambda track: artist_id in track['artist_ids'].split('|'),
-                    axis=1
-                )
-            ]
-
-            artist_tracks_doc.append(artist_album_tracks, prompt=False, silent=True)
-
+            self._get_album_tracks(album.album_id, album.name)
+        fetch_policy.record_fetched(len(new_artist_albums))
 
         print(f'Tracks for artist: {artist_id} {artist_name} went from {orig_num_tracks} to '
-              f'{len(artist_tracks_doc)}')
-        # write even if nothing changed, so that the mtime updates
-        artist_tracks_doc.write(force=True)
+              f'{len(store.get_artist_tracks(artist_id))}')
+
+        store.set_refresh_time(artist_id, artist_name, tracks=time.time())
 
         return
 
-    def _get_album_tracks(self, album_id, album_name):
+    def _get_album_tracks(self, album_id, album_name, silent=False):
         # TODO there is no way to force a refresh here; add something?
-        album_tracks_doc = self._get_doc('album-tracks', album_id, album_name)
+        store = self._get_store()
 
-        if album_tracks_doc.exists():
-            return album_tracks_doc
+        if store.album_tracks_fetched(album_id):
+            return store.get_album_tracks(album_id)
 
-        print(f'Fetching tracks for album: {album_id} {album_name}...', end='')
+        if not silent:
+            print(f'Fetching tracks for album: {album_id} {album_name}...', end='')
 
-        album_tracks = get_album_tracks(album_id)
+        album_tracks = djlib_config.spotify.get_album_tracks(album_id)
 
-        album_tracks_doc.set_df(album_tracks)
-        album_tracks_doc.write()
-        print(f' {len(album_tracks_doc)} tracks')
+        store.put_album_tracks(album_id, album_tracks)
+        get_artist_directory().add_tracks(album_tracks)
+        if not silent:
+            print(f' {len(album_tracks)} tracks')
 
-        return album_tracks_doc
+        return album_tracks
 
 
-    def _form_track_from_signature_group(self, same_sig_tracks):
-        """Returns a dataframe with a single row that's the best representative of the
-           entire track group.
+    def _deduplicate_tracks(self, artist_tracks):
+        """Collapses tracks with the same signature into a single row that's the best
+           representative of the group. All steps are whole-column operations:
+           - undesirable edits (mixed versions, radio edits) are never representatives;
+             a group with only undesirable edits is dropped
+           - among the rest, extended mixes are preferred if the group has any
+           - among those, the oldest release wins; ties go to the earlier row
+           - the representative's popularity is the sum of the group's popularities plus
+             the number of duplicates, because a track that gets reposted in more albums
+             is arguably more popular
+           Groups come out in order of first appearance.
         """
+        artist_tracks['signature'] = get_track_signatures(artist_tracks)
 
-        # a good place to insert complicated breakpoints...
-        # signature = same_sig_tracks.signature.iloc[0]
-
-        # remove undesirable edits
-        def is_desirable_edit(track):
-            name = track['name'].upper()
-            is_undesirable = (
-                    name.endswith(' - MIXED') or
-                    name.endswith('(MIXED)') or
-                    name.endswith('[MIXED]') or
-                    'RADIO EDIT' in name
-            )
-            return not is_undesirable
-
-        def is_extended_edit(track):
-            name = track['name'].upper()
-            is_extended = 'EXTENDED' in name or ' X ' in name
-            return is_extended
-
-        desirable_tracks = same_sig_tracks.loc[
-            same_sig_tracks.apply(is_desirable_edit, axis=1)
-        ]
-
-        if len(desirable_tracks) == 0:
-            # this usually happens in very pathological situations that don't interest us
-            return desirable_tracks
-            # desirable_tracks = same_sig_tracks
-
-        # try to find an extended mix if possible
-        extended_tracks = desirable_tracks.loc[
-            desirable_tracks.apply(is_extended_edit, axis=1)
-        ]
-        if len(extended_tracks) > 0:
-            desirable_tracks = extended_tracks
-
-        # select the oldest ID
-        if len(desirable_tracks) > 1:
-            desirable_tracks.sort_values(by='release_date', inplace=True)
-        track = desirable_tracks.iloc[:1]
-
-        # Combine the popularities of the tracks. For now I just add them up,
-        # and then also add the number of duplicates - because a track that gets
-        # reposted in more albums is arguably more popular.
-        popularity = same_sig_tracks.popularity.sum() + len(same_sig_tracks) - 1
-        track['popularity'] = popularity
-
-        assert isinstance(track, pd.DataFrame)
-        assert len(track) == 1
-
-        return track
+        group = pd.Series(pd.factorize(artist_tracks['signature'])[0], index=artist_tracks.index)
 
-    def _deduplicate_tracks(self, artist_tracks):
-        artist_tracks['signature'] = artist_tracks.apply(
-            get_track_signature,
-            axis=1
+        names = artist_tracks['name'].str.upper()
+
+        is_desirable = ~(
+            names.str.endswith(' - MIXED') |
+            names.str.endswith('(MIXED)') |
+            names.str.endswith('[MIXED]') |
+            names.str.contains('RADIO EDIT', regex=False)
         )
 
-        # not necessary but helps debugging
-        # artist_tracks.sort_values(by='name', inplace=True)
+        is_extended = is_desirable & (
+            names.str.contains('EXTENDED', regex=False) |
+            names.str.contains(' X ', regex=False)
+        )
+
+        group_has_extended = is_extended.groupby(group).transform('any')
+
+        is_candidate = is_extended | (is_desirable & ~group_has_extended)
 
-        gby = artist_tracks.groupby(by='signature', as_index=False, sort=False, group_keys=False)
+        candidates = pd.DataFrame({
+            'group': group.to_numpy(),
+            'release_date': artist_tracks['release_date'].to_numpy(),
+            'position': np.arange(len(artist_tracks)),
+        }).loc[is_candidate.to_numpy()]
 
-        dedup_tracks = gby.apply(
-            func=lambda group: self._form_track_from_signature_group(group)
+        # multi-column sorts are stable, so equal release dates keep the row order
+        representatives = candidates.sort_values(
+            by=['group', 'release_date'], na_position='last'
+        ).drop_duplicates(subset='group', keep='first')
+
+        group_popularity = (
+            artist_tracks['popularity'].groupby(group).sum() +
+            group.groupby(group).size() - 1
         )
 
+        dedup_tracks = artist_tracks.iloc[representatives['position'].to_numpy()].copy()
+        dedup_tracks['popularity'] = group_popularity.loc[representatives['group']].to_numpy()
+
         return dedup_tracks
 
     def _artist_id_and_name(self, artist_id, artist_name):
@@ -397,6 +483,188 @@ class _SpotifyDiscography:
 
         return
 
+    def refresh_artists(self, artist_ids, artist_names=None, *,
+                        workers=None,
+                        refresh_days=None,
+                        force=False,
+                        run_name='default'):
+        """
+        Refreshes the track database for many artists concurrently.
+        Album lists are fetched first, then the tracks of every album that hasn't been fetched
+        yet; an album shared between several artists is fetched only once. All requests go
+        through the Spotify interface's rate limiter.
+        Progress is checkpointed under run_name; if the run is interrupted, calling this again
+        with the same run_name skips the artists that were already done.
+        """
+        if workers is None:
+            workers = djlib_config.spotify.max_in_flight
+        if refresh_days is None:
+            refresh_days = djlib_config.artist_albums_ttl_days
+
+        artist_ids = list(artist_ids)
+        if artist_names is None:
+            artist_names = [self._artist_id_and_name(artist_id, None)[1] for artist_id in artist_ids]
+        artist_names_by_id = dict(zip(artist_ids, artist_names))
+
+        store = self._get_store()
+
+        # Stage 1: artist albums
+        done = store.get_progress(run_name, 'albums')
+        to_do = [artist_id for artist_id in artist_names_by_id if artist_id not in done]
+
+        print(f'Refreshing albums for {len(to_do)} artists '
+              f'({len(artist_names_by_id) - len(to_do)} already done in run {run_name})...')
+
+        progress = _ProgressReporter('Artist albums', len(to_do))
+        num_fetched = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self._refresh_artist_albums, artist_id,
+                                artist_names_by_id[artist_id],
+                                refresh_days=refresh_days, force=force, silent=True): artist_id
+                for artist_id in to_do
+            }
+            for future in as_completed(futures):
+                if future.result():
+                    num_fetched += 1
+                store.mark_progress(run_name, 'albums', [futures[future]])
+                progress.step()
+
+        print(f'Fetched albums for {num_fetched} artists; '
+              f'{len(to_do) - num_fetched} were fresh enough')
+
+        # Stage 2: album tracks, deduplicated across artists. Fetched albums are recorded in
+        # the store as they come in, so an interrupted run picks up where it stopped.
+        to_do = list(artist_names_by_id)
+
+        fetch_policy = _AlbumFetchPolicy.from_config()
+        unfetched_albums = [store.get_unfetched_albums(artist_id, skipped_by=fetch_policy.get_key())
+                            for artist_id in to_do]
+        unfetched_albums = [albums for albums in unfetched_albums if len(albums) > 0]
+
+        albums_to_fetch = {}
+        if len(unfetched_albums) > 0:
+            for album in fetch_policy.select(pd.concat(unfetched_albums), store=store).itertuples():
+                albums_to_fetch[album.album_id] = album.name
+
+        print(f'Fetching tracks for {len(albums_to_fetch)} albums of {len(to_do)} artists...')
+
+        progress = _ProgressReporter('Album tracks', len(albums_to_fetch), every=50)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._get_album_tracks, album_id, album_name, silent=True)
+                for album_id, album_name in albums_to_fetch.items()
+            ]
+            for future in as_completed(futures):
+                future.result()
+                progress.step()
+
+        now = time.time()
+        for artist_id in to_do:
+            store.set_refresh_time(artist_id, artist_names_by_id[artist_id], tracks=now)
+
+        store.clear_progress(run_name)
+
+        fetch_policy.record_fetched(len(albums_to_fetch))
+        fetch_policy.report()
+
+        print(f'Refreshed {len(artist_names_by_id)} artists')
+
+        return
+
+    def rank_artists_for_refresh(self, artists: pd.DataFrame) -> pd.DataFrame:
+        """
+        Ranks artists by the expected value of refreshing their discography now.
+        artists is indexed by artist_id; optional A and B columns hold the number of the
+        artist's tracks in those classes (see spotify_util.add_artist_track_counts).
+
+        The chance that the artist released something since the last check is modelled as a
+        Poisson process with the artist's historical release interval. The rate drops for
+        artists whose last release is several intervals ago. Artists that were never checked
+        come first. The value is that chance weighted by the artist's A and B tracks.
+
+        Returns a copy sorted by value, with the added columns days_since_check,
+        release_interval_days, days_since_release, p_new_release, value and
+        expected_requests.
+        """
+        if artists.index.name != 'artist_id':
+            raise ValueError('Artist dataframe is not indexed by artist_id')
+
+        stats = self._get_store().get_artist_refresh_stats().reindex(artists.index)
+        now = pd.Timestamp.utcnow()
+
+        checked_at = pd.to_datetime(stats.albums_checked_at, unit='s', utc=True)
+        days_since_check = (now - checked_at).dt.total_seconds() / 24 / 3600
+
+        num_releases = stats.num_releases.fillna(0)
+        release_span_days = (stats.last_release - stats.first_release).dt.total_seconds() / 24 / 3600
+        release_interval_days = (release_span_days / (num_releases - 1)).where(
+            num_releases >= 2, _DEFAULT_RELEASE_INTERVAL_DAYS).clip(lower=_MIN_RELEASE_INTERVAL_DAYS)
+
+        days_since_release = (now - stats.last_release).dt.total_seconds() / 24 / 3600
+
+        rate = 1 / release_interval_days
+        dormant_after_days = _DORMANCY_INTERVALS * release_interval_days
+        rate = rate.where(~(days_since_release > dormant_after_days),
+                          rate * dormant_after_days / days_since_release)
+
+        never_checked = days_since_check.isna()
+        p_new_release = (1 - np.exp(-rate * days_since_check)).where(~never_checked, 1.0)
+
+        track_weight = 1.0
+        if 'A' in artists.columns:
+            track_weight = track_weight + _A_TRACK_WEIGHT * artists.A.fillna(0)
+        if 'B' in artists.columns:
+            track_weight = track_weight + _B_TRACK_WEIGHT * artists.B.fillna(0)
+
+        # one album count probe, the album list if it changed, and two requests per new album
+        expected_requests = (1
+                             + p_new_release * np.ceil(num_releases.clip(lower=1) / _ALBUM_PAGE_SIZE)
+                             + 2 * rate * days_since_check.fillna(0))
+        expected_requests = expected_requests.where(~never_checked, _NEW_ARTIST_EXPECTED_REQUESTS)
+
+        ranked = artists.assign(
+            days_since_check=days_since_check,
+            release_interval_days=release_interval_days,
+            days_since_release=days_since_release,
+            p_new_release=p_new_release,
+            value=p_new_release * track_weight,
+            expected_requests=expected_requests,
+        )
+
+        return ranked.sort_values(by='value', ascending=False, kind='stable')
+
+    def refresh_artists_scheduled(self, artists: pd.DataFrame, budget, *,
+                                  workers=None,
+                                  run_name='scheduled'):
+        """
+        Refreshes the highest-ranked artists (see rank_artists_for_refresh()) whose expected
+        requests fit in budget; the others wait for a later run.
+        artists is indexed by artist_id and should have an artist_name column.
+        Returns the ranking, with a refreshed column.
+        """
+        ranked = self.rank_artists_for_refresh(artists)
+
+        refreshed = ranked.expected_requests.cumsum() <= budget
+        ranked['refreshed'] = refreshed
+
+        selected = ranked[refreshed]
+
+        print(f'Scheduling {len(selected)} of {len(ranked)} artists for refresh, '
+              f'{selected.expected_requests.sum():.0f} expected requests out of a budget of {budget}')
+
+        if len(selected) > 0:
+            self.refresh_artists(
+                selected.index,
+                selected.artist_name if 'artist_name' in selected.columns else None,
+                workers=workers,
+                # the ranking already decided; the album count probe still applies
+                refresh_days=0,
+                run_name=run_name)
+
+        return ranked
+
+
 
 
 
@@ -415,13 +683,50 @@ class _SpotifyDiscography:
 
         artist_id, artist_name = self._artist_id_and_name(artist_id, artist_name)
 
-        artist_tracks = self._get_doc('artist-tracks', artist_id, artist_name).get_df()
+        artist_tracks = self._get_store().get_artist_tracks(artist_id)
 
         if len(artist_tracks) > 0 and deduplicate_tracks:
             artist_tracks = self._deduplicate_tracks(artist_tracks)
 
         return artist_tracks
 
+    def query_tracks(self, *,
+                     artist_ids=None,
+                     released_after=None,
+                     released_before=None,
+                     album_types=None,
+                     unlistened=False,
+                     deduplicate_tracks=False):
+        """
+        Returns the known tracks of many artists at once, from the track database on disk.
+        E.g. all tracks released in the last 30 days by a set of artists:
+            query_tracks(artist_ids=a_artists.index,
+                         released_after=pd.Timestamp.utcnow() - pd.Timedelta(days=30))
+           artist_ids: only tracks of these artists (default: all known artists)
+           released_after / released_before: release date range, both inclusive
+           album_types: only tracks from these album types, e.g. ['album', 'single']
+           unlistened (default False): leave out the tracks in the listening history,
+                                       by spotify ID or track signature
+           deduplicate_tracks (default False): try to filter out duplicate releases of the
+                                               same track
+        """
+        if artist_ids is not None:
+            artist_ids = pd.Index(artist_ids).dropna().unique()
+
+        tracks = self._get_store().query_tracks(
+            artist_ids=artist_ids,
+            released_after=released_after,
+            released_before=released_before,
+            album_types=album_types)
+
+        if unlistened and len(tracks) > 0:
+            tracks = tracks.loc[~ListeningHistory().is_listened(tracks)].copy()
+
+        if deduplicate_tracks and len(tracks) > 0:
+            tracks = self._deduplicate_tracks(tracks)
+
+        return tracks
+
 
 def get_instance():
     global _singleton
@@ -8,20 +8,33 @@ import os.path
 import re
 import random
 import sys
+import threading
 import webbrowser
 from urllib.parse import urlencode, urlparse, parse_qs
 import requests
+from requests.adapters import HTTPAdapter
 
 import pandas as pd
 import numpy as np
 
 from spyroslib import cache
 from local_util import *
+from token_manager import TokenManager
 
 logger = logging.getLogger(__name__)
 
 _MAX_ITEMS_PER_REQUEST = 20
 
+# GET /tracks accepts up to 50 IDs per request
+_MAX_TRACKS_PER_REQUEST = 50
+
+# PUT and DELETE me/tracks accept up to 50 IDs per request
+_MAX_LIKED_TRACKS_PER_REQUEST = 50
+
+# connection pool size and request rate shared by all threads (and the async client)
+_DEFAULT_MAX_IN_FLIGHT = 16
+_DEFAULT_MAX_REQUESTS_PER_SECOND = 10
+
 _SCOPES = [
     'user-library-read',
     'user-library-modify',
@@ -40,7 +53,9 @@ _ALBUM_COLUMNS = {
     'popularity': lambda t: t['popularity'] if 'popularity' in t else None,
     'album_type': None,
     'release_date': lambda item: pd.to_datetime(item['release_date'], utc=True),
-    'total_tracks': lambda item: int(item['total_tracks'])
+    'total_tracks': lambda item: int(item['total_tracks']),
+    # only in artists/{id}/albums results: how the album relates to the artist
+    'album_group': lambda item: item.get('album_group'),
 }
 
 _TRACK_COLUMNS = {
@@ -79,6 +94,54 @@ def _postprocess_albums(results):
     projection = project(results, _ALBUM_COLUMNS)
     return projection
 
+def _postprocess_album_tracks(results, album_id, album_entry):
+    projection = project(
+        results,
+        {
+            'spotify_id': 'id',
+            'name': None,
+            'artist_ids': lambda t: '|'.join([artist['id'] for artist in t['artists']]),
+            'artist_names': lambda t: '|'.join([artist['name'].replace('|', '--') for artist in t['artists']]),
+            'duration_ms': int,
+            'release_date': lambda _: album_entry['release_date'],
+            'popularity': lambda _: album_entry['popularity'],
+            'added_at': lambda _: album_entry['release_date'],
+            'album_id': lambda _: album_id,
+            'album_name': lambda _: album_entry['name']
+        }
+    )
+    return projection
+
+def _artist_albums_params(include_groups, limit):
+    params = {'limit': limit}
+    if include_groups is not None:
+        params['include_groups'] = ','.join(include_groups)
+    return params
+
+def _to_dataframe(projection, index_column='spotify_id'):
+    df = pd.DataFrame.from_records(projection)
+    if not df.empty:
+        df = df.set_index(index_column, drop=False)
+    return df
+
+
+def _token_to_file_obj(token):
+    return {
+        'access_token': token['access_token'],
+        'token_type': 'Bearer',
+        'expires_in': 3600,
+        'scope': ' '.join(_SCOPES),
+        'expires_at': int(token['expires_at']),
+        'refresh_token': token['refresh_token']
+    }
+
+def _token_from_file_obj(obj):
+    return {
+        'access_token': obj['access_token'],
+        'refresh_token': obj['refresh_token'],
+        'expires_at': obj['expires_at']
+    }
+
 
 def _generate_code_verifier(length: int = 128) -> str:
     possible = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
@@ -89,6 +152,22 @@ def _generate_code_challenge(code_verifier: str) -> str:
     return base64.urlsafe_b64encode(digest).decode('utf-8').rstrip('=')
 
 
+class _RateLimiter:
+    """Thread-safe limiter that spaces out requests to at most max_per_second."""
+    def __init__(self, max_per_second):
+        self._interval = 1.0 / max_per_second if max_per_second > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
 class SpotifyInterface:
     def __init__(self, config):
         self._client_id = config['client_id']
@@ -111,57 +190,29 @@ class SpotifyInterface:
             config['cached_token_file']
         )
 
-        self._access_token = None
-        self._refresh_token = None
-        self._access_token_expires_at = None
+        self._token_manager = TokenManager(
+            'Spotify',
+            self._cached_token_file,
+            authorize_func=self._authorization_workflow,
+            refresh_func=self._refresh_token_workflow,
+            to_file_func=_token_to_file_obj,
+            from_file_func=_token_from_file_obj
+        )
+
+        # one pooled session and one limiter for every thread that talks to the API;
+        # the async client in spotify_interface_async goes through these as well
+        self.max_in_flight = int(config.get('max_in_flight', _DEFAULT_MAX_IN_FLIGHT))
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight)
+        self._session.mount('https://', adapter)
+        self._limiter = _RateLimiter(
+            float(config.get('max_requests_per_second', _DEFAULT_MAX_REQUESTS_PER_SECOND)))
 
         self._cache = cache.Cache()
         return
 
     def _ensure_access_token(self):
-        if self._access_token is None:
-            if os.path.exists(self._cached_token_file):
-                try:
-                    self._read_access_token_file()
-                except Exception as e:
-                    logger.debug('Reading Spotify access token file failed: %s', str(e))
-                    self._authorization_workflow()
-
-        if self._access_token_expires_at is not None and \
-            time.time() < self._access_token_expires_at - 60:
-            return
-
-        if self._refresh_token is not None:
-            try:
-                self._refresh_token_workflow()
-                return
-            except Exception as e:
-                logger.debug('Refreshing Spotify access token failed: %s', str(e))
-
-        self._authorization_workflow()
-        return
-
-    def _read_access_token_file(self):
-        with open(self._cached_token_file) as token_fh:
-            obj = json.load(token_fh)
-            self._access_token = obj['access_token']
-            self._refresh_token = obj['refresh_token']
-            self._access_token_expires_at = obj['expires_at']
-
-    def _write_access_token_file(self):
-        with open(self._cached_token_file, 'w') as token_file:
-            json.dump(
-                obj={
-                    'access_token': self._access_token,
-                    'token_type': 'Bearer',
-                    'expires_in': 3600,
-                    'scope': ' '.join(_SCOPES),
-                    'expires_at': int(self._access_token_expires_at),
-                    'refresh_token': self._refresh_token
-                },
-                fp=token_file,
-                indent=2
-            )
+        return self._token_manager.get_access_token()
 
     def _authorization_workflow(self):
         state = ''.join(random.choices('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=10))
@@ -221,19 +272,16 @@ class SpotifyInterface:
                             f'code {post_response.status_code} text {post_response.text}')
 
         post_response_data = post_response.json()
-        self._access_token = post_response_data['access_token']
-        self._refresh_token = post_response_data['refresh_token']
-        expires_in = post_response_data['expires_in']
-        self._access_token_expires_at = time.time() + expires_in
-
-        self._write_access_token_file()
-
-    def _refresh_token_workflow(self):
-        assert self._refresh_token is not None
+        return {
+            'access_token': post_response_data['access_token'],
+            'refresh_token': post_response_data['refresh_token'],
+            'expires_at': time.time() + post_response_data['expires_in']
+        }
 
+    def _refresh_token_workflow(self, refresh_token):
         post_data = {
             'grant_type': 'refresh_token',
-            'refresh_token': self._refresh_token
+            'refresh_token': refresh_token
         }
 
         auth_header = base64.b64encode(f"{self._client_id}:{self._client_secret}".encode()).decode()
@@ -253,18 +301,17 @@ class SpotifyInterface:
                             f'code {post_response.status_code} text {post_response.text}')
 
         post_response_data = post_response.json()
-        self._access_token = post_response_data['access_token']
-        if 'refresh_token' in post_response_data:
-            self._refresh_token = post_response_data['refresh_token']
-        expires_in = post_response_data['expires_in']
-        self._access_token_expires_at = time.time() + expires_in
-
-        self._write_access_token_file()
+        return {
+            'access_token': post_response_data['access_token'],
+            # Spotify doesn't always rotate the refresh token; the token manager keeps the old one
+            'refresh_token': post_response_data.get('refresh_token'),
+            'expires_at': time.time() + post_response_data['expires_in']
+        }
 
     def _api_request(self, method, url, params=None, json_data=None):
-        self._ensure_access_token()
+        access_token = self._ensure_access_token()
         headers = {
-            'Authorization': f'Bearer {self._access_token}',
+            'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json'
         }
 
@@ -273,8 +320,9 @@ class SpotifyInterface:
 
         retries = 3
         while retries > 0:
+            self._limiter.acquire()
             start_time = time.time()
-            response = requests.request(method, url, headers=headers, params=params, json=json_data)
+            response = self._session.request(method, url, headers=headers, params=params, json=json_data)
             end_time = time.time()
 
             logger.debug('Spotify API request %s %s: %.3f s, status %d', method, url, end_time - start_time, response.status_code)
@@ -314,7 +362,10 @@ class SpotifyInterface:
         raise Exception("Spotify API requests failed after retries due to server errors/rate limits.")
 
     def _batch_result(self, url, params=None):
-        results = self._api_request('GET', url, params=params)
+        return self._collect_pages(self._api_request('GET', url, params=params))
+
+    def _collect_pages(self, results):
+        """Returns the items of a paging object and of all the pages after it."""
         items = results['items']
         while results.get('next'):
             results = self._api_request('GET', results['next'])
@@ -380,6 +431,34 @@ class SpotifyInterface:
             return df
         return self._cache.look_up_or_get(body, _TTL, 'playlist_tracks', playlist_id)
 
+    def get_playlist_metadata(self, playlist_name_or_id):
+        """Returns the playlist's id, name, snapshot_id and number of tracks (total) without
+           downloading the tracks; a single request, not cached."""
+        playlist_id = self._get_playlist_id_if_necessary(playlist_name_or_id)
+        result = self._api_request('GET', f'playlists/{playlist_id}',
+                                   params={'fields': 'id,name,snapshot_id,tracks.total'})
+        return {
+            'id': result['id'],
+            'name': result['name'],
+            'snapshot_id': result['snapshot_id'],
+            'total': result['tracks']['total'],
+        }
+
+    def get_liked_tracks_metadata(self):
+        """Returns the number of liked tracks (total) and the ID and time of the latest one
+           (latest_id, latest_added_at) from a single one-item request. The liked library has
+           no snapshot ID; together these tell whether it changed."""
+        result = self._api_request('GET', 'me/tracks', params={'limit': 1})
+        latest = result['items'][0] if len(result['items']) > 0 else None
+        return {
+            'total': result['total'],
+            'latest_id': None if latest is None else latest['track']['id'],
+            'latest_added_at': None if latest is None else latest['added_at'],
+        }
+
+    def get_liked_tracks_count(self):
+        return self.get_liked_tracks_metadata()['total']
+
     def get_liked_tracks(self):
         def body():
             results = self._batch_result('me/tracks')
@@ -390,8 +469,17 @@ class SpotifyInterface:
             return df
         return self._cache.look_up_or_get(body, _TTL, 'liked_tracks')
 
-    def get_artist_albums(self, artist_id):
-        results = self._batch_result(f'artists/{artist_id}/albums')
+    def get_artist_album_count(self, artist_id, include_groups=None):
+        """Returns the number of albums Spotify lists for the artist; costs a single
+           one-item request."""
+        result = self._api_request('GET', f'artists/{artist_id}/albums',
+                                   params=_artist_albums_params(include_groups, limit=1))
+        return result['total']
+
+    def get_artist_albums(self, artist_id, include_groups=None):
+        """include_groups: e.g. ['album', 'single']; all groups if None"""
+        results = self._batch_result(f'artists/{artist_id}/albums',
+                                     params=_artist_albums_params(include_groups, limit=50))
         results = _postprocess_albums(results)
         df = pd.DataFrame.from_records(results)
         if not df.empty:
@@ -401,26 +489,10 @@ class SpotifyInterface:
     def get_album_tracks(self, album_id):
         album_info = self._api_request('GET', f'albums/{album_id}')
         album_entry = project(album_info, _ALBUM_COLUMNS)
-        results = self._batch_result(f'albums/{album_id}/tracks')
-        projection = project(
-            results,
-            {
-                'spotify_id': 'id',
-                'name': None,
-                'artist_ids': lambda t: '|'.join([artist['id'] for artist in t['artists']]),
-                'artist_names': lambda t: '|'.join([artist['name'].replace('|', '--') for artist in t['artists']]),
-                'duration_ms': int,
-                'release_date': lambda _: album_entry['release_date'],
-                'popularity': lambda _: album_entry['popularity'],
-                'added_at': lambda _: album_entry['release_date'],
-                'album_id': lambda _: album_id,
-                'album_name': lambda _: album_entry['name']
-            }
-        )
-        df = pd.DataFrame.from_records(projection)
-        if not df.empty:
-            df = df.set_index('spotify_id', drop=False)
-        return df
+        # the album object has the first page of tracks embedded
+        results = self._collect_pages(album_info['tracks'])
+        projection = _postprocess_album_tracks(results, album_id, album_entry)
+        return _to_dataframe(projection)
 
     def get_recently_played_tracks(self):
         result = self._api_request('GET', 'me/player/recently-played', params={'limit': 50})
@@ -435,7 +507,7 @@ class SpotifyInterface:
         results = []
         start = 0
         while start < len(ids):
-            end = min(start + _MAX_ITEMS_PER_REQUEST, len(ids))
+            end = min(start + _MAX_TRACKS_PER_REQUEST, len(ids))
             chunk = list(ids[start:end])
             res = self._api_request('GET', 'tracks', params={'ids': ','.join(chunk)})
             results += res['tracks']
@@ -443,7 +515,9 @@ class SpotifyInterface:
             
         if raw:
             return results
-            
+
+        # IDs that Spotify doesn't know come back as nulls
+        results = [result for result in results if result is not None]
         results = _postprocess_tracks(results)
         df = pd.DataFrame.from_records(results)
         if not df.empty:
@@ -526,21 +600,27 @@ class SpotifyInterface:
             
         self._cache.invalidate('playlist_tracks', playlist_id)
 
-    def add_liked_tracks(self, tracks):
+    def add_liked_tracks(self, tracks, skip_liked=True):
+        """skip_liked: first download the liked tracks to leave out the ones already liked,
+           which would otherwise get a new added_at; callers that know the tracks aren't
+           liked can set it to False to save the download."""
         if isinstance(tracks, pd.DataFrame):
             tracks = tracks.spotify_id
         if not isinstance(tracks, pd.Index):
             tracks = pd.Index(tracks)
-            
-        already_liked_tracks = self.get_liked_tracks().index
-        new_tracks = tracks.difference(already_liked_tracks, sort=False)
-        
-        if len(new_tracks) < len(tracks):
-            print('Ignoring %d already liked tracks' % (len(tracks) - len(new_tracks)))
-            
+
+        if skip_liked:
+            already_liked_tracks = self.get_liked_tracks().index
+            new_tracks = tracks.difference(already_liked_tracks, sort=False)
+
+            if len(new_tracks) < len(tracks):
+                print('Ignoring %d already liked tracks' % (len(tracks) - len(new_tracks)))
+        else:
+            new_tracks = tracks
+
         start = 0
         while start < len(new_tracks):
-            end = min(start + _MAX_ITEMS_PER_REQUEST, len(new_tracks))
+            end = min(start + _MAX_LIKED_TRACKS_PER_REQUEST, len(new_tracks))
             chunk = list(new_tracks[start:end])
             self._api_request('PUT', 'me/tracks', json_data={'ids': chunk})
             start = end
@@ -554,7 +634,7 @@ class SpotifyInterface:
             
         start = 0
         while start < len(tracks):
-            end = min(start + _MAX_ITEMS_PER_REQUEST, len(tracks))
+            end = min(start + _MAX_LIKED_TRACKS_PER_REQUEST, len(tracks))
             chunk = list(tracks[start:end])
             self._api_request('DELETE', 'me/tracks', json_data={'ids': chunk})
             start = end
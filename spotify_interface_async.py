@@ -0,0 +1,235 @@
+"""
+asyncio twin of SpotifyInterface, for bulk workflows (discography refreshes, regex playlist
+aggregation, bulk searches) that want to keep many requests in flight at once.
+
+The async client doesn't open connections of its own. Every request goes through the
+wrapped SpotifyInterface, so it shares that object's token, pooled session and rate limiter;
+the requests run on a thread pool sized to the session's connection pool.
+Paginated endpoints fetch the first page, read the total, and then fetch the remaining
+pages concurrently.
+
+The methods and the DataFrames they return are the same as SpotifyInterface's. Writes that
+depend on order (playlist replacement etc.) run the synchronous implementation in the pool.
+
+SyncFacade wraps an AsyncSpotifyInterface for the interactive shell; each call runs the
+coroutine to completion, e.g.
+
+    djlib_config.spotify_bulk.get_artist_albums_many(artist_ids)
+"""
+
+import asyncio
+import functools
+import inspect
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from spotify_interface import (
+    _MAX_TRACKS_PER_REQUEST,
+    _ALBUM_COLUMNS,
+    _artist_albums_params,
+    _postprocess_tracks,
+    _postprocess_albums,
+    _postprocess_album_tracks,
+    _to_dataframe,
+    is_spotify_id,
+)
+from local_util import *
+
+logger = logging.getLogger(__name__)
+
+_PAGE_SIZE = 50
+
+
+class AsyncSpotifyInterface:
+    def __init__(self, spotify, max_in_flight=None):
+        self._spotify = spotify
+        if max_in_flight is None:
+            max_in_flight = spotify.max_in_flight
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight,
+                                            thread_name_prefix='spotify-async')
+        return
+
+    async def _run_sync(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _api_request(self, method, url, params=None, json_data=None):
+        return await self._run_sync(self._spotify._api_request, method, url,
+                                    params=params, json_data=json_data)
+
+    async def _batch_result(self, url, params=None):
+        params = dict(params or {})
+        params.setdefault('limit', _PAGE_SIZE)
+
+        first_page = await self._api_request('GET', url, params=params)
+        return await self._collect_pages(url, first_page, params)
+
+    async def _collect_pages(self, url, first_page, params=None):
+        """Returns the items of a paging object and of all the pages after it, which are
+           fetched concurrently from url."""
+        params = dict(params or {})
+        page_size = params.setdefault('limit', first_page.get('limit') or _PAGE_SIZE)
+        items = first_page['items']
+
+        if not first_page.get('next'):
+            return items
+
+        total = first_page['total']
+        pages = await asyncio.gather(*[
+            self._api_request('GET', url, params=params | {'offset': offset})
+            for offset in range(len(items), total, page_size)
+        ])
+
+        for page in pages:
+            items += page['items']
+
+        logger.debug('Spotify async batch result %s: %d items, %d pages',
+                     url, len(items), len(pages) + 1)
+        return items
+
+    async def map(self, coroutine_function, args):
+        """Runs coroutine_function on every element of args concurrently and returns the
+           results in the same order."""
+        return await asyncio.gather(*[coroutine_function(arg) for arg in args])
+
+    def invalidate_cache(self):
+        self._spotify.invalidate_cache()
+
+    async def get_user_id(self):
+        return await self._run_sync(self._spotify.get_user_id)
+
+    async def get_playlists(self):
+        # goes through the synchronous cache
+        return await self._run_sync(self._spotify.get_playlists)
+
+    async def playlist_exists(self, playlist_name):
+        return playlist_name in (await self.get_playlists()).index
+
+    async def get_playlist_id(self, playlist_name):
+        return await self._run_sync(self._spotify.get_playlist_id, playlist_name)
+
+    async def _get_playlist_id_if_necessary(self, playlist_name_or_id):
+        if is_spotify_id(playlist_name_or_id):
+            return playlist_name_or_id
+        return await self.get_playlist_id(playlist_name_or_id)
+
+    async def get_playlist_tracks(self, playlist_name_or_id):
+        playlist_id = await self._get_playlist_id_if_necessary(playlist_name_or_id)
+        results = await self._batch_result(f'playlists/{playlist_id}/tracks')
+        return _to_dataframe(_postprocess_tracks(results))
+
+    async def get_liked_tracks(self):
+        results = await self._batch_result('me/tracks')
+        return _to_dataframe(_postprocess_tracks(results))
+
+    async def get_playlist_metadata(self, playlist_name_or_id):
+        return await self._run_sync(self._spotify.get_playlist_metadata, playlist_name_or_id)
+
+    async def get_liked_tracks_metadata(self):
+        return await self._run_sync(self._spotify.get_liked_tracks_metadata)
+
+    async def get_artist_album_count(self, artist_id, include_groups=None):
+        result = await self._api_request('GET', f'artists/{artist_id}/albums',
+                                         params=_artist_albums_params(include_groups, limit=1))
+        return result['total']
+
+    async def get_artist_albums(self, artist_id, include_groups=None):
+        results = await self._batch_result(f'artists/{artist_id}/albums',
+                                           params=_artist_albums_params(include_groups, limit=_PAGE_SIZE))
+        return _to_dataframe(_postprocess_albums(results), index_column='album_id')
+
+    async def get_album_tracks(self, album_id):
+        album_info = await self._api_request('GET', f'albums/{album_id}')
+        album_entry = project(album_info, _ALBUM_COLUMNS)
+        # the album object has the first page of tracks embedded
+        results = await self._collect_pages(f'albums/{album_id}/tracks', album_info['tracks'])
+        return _to_dataframe(_postprocess_album_tracks(results, album_id, album_entry))
+
+    async def get_recently_played_tracks(self):
+        result = await self._api_request('GET', 'me/player/recently-played', params={'limit': 50})
+        return _to_dataframe(_postprocess_tracks(result['items']))
+
+    async def get_tracks_by_id(self, ids, raw=False):
+        chunks = [
+            list(ids[start:start + _MAX_TRACKS_PER_REQUEST])
+            for start in range(0, len(ids), _MAX_TRACKS_PER_REQUEST)
+        ]
+        responses = await asyncio.gather(*[
+            self._api_request('GET', 'tracks', params={'ids': ','.join(chunk)})
+            for chunk in chunks
+        ])
+
+        results = []
+        for response in responses:
+            results += response['tracks']
+
+        if raw:
+            return results
+
+        # IDs that Spotify doesn't know come back as nulls
+        results = [result for result in results if result is not None]
+        return _to_dataframe(_postprocess_tracks(results))
+
+    async def search(self, search_string, limit=10, raw=False):
+        results = await self._api_request('GET', 'search',
+                                          params={'q': search_string, 'limit': limit, 'type': 'track'})
+        if raw:
+            return results
+        return _to_dataframe(_postprocess_tracks(results['tracks']['items']))
+
+    # Bulk variants; each returns one result per argument, in order
+
+    async def get_playlist_tracks_many(self, playlist_names_or_ids):
+        return await self.map(self.get_playlist_tracks, playlist_names_or_ids)
+
+    async def get_artist_albums_many(self, artist_ids):
+        return await self.map(self.get_artist_albums, artist_ids)
+
+    async def get_album_tracks_many(self, album_ids):
+        return await self.map(self.get_album_tracks, album_ids)
+
+    async def search_many(self, search_strings, limit=10):
+        return await self.map(functools.partial(self.search, limit=limit), search_strings)
+
+    # Writes are order-sensitive; they run the synchronous implementation
+
+    async def create_playlist(self, playlist_name):
+        return await self._run_sync(self._spotify.create_playlist, playlist_name)
+
+    async def delete_playlist(self, playlist_name):
+        return await self._run_sync(self._spotify.delete_playlist, playlist_name)
+
+    async def add_tracks_to_playlist(self, playlist_name_or_id, tracks, check_for_duplicates=True):
+        return await self._run_sync(self._spotify.add_tracks_to_playlist, playlist_name_or_id,
+                                    tracks, check_for_duplicates=check_for_duplicates)
+
+    async def replace_tracks_in_playlist(self, playlist_name_or_id, tracks):
+        return await self._run_sync(self._spotify.replace_tracks_in_playlist,
+                                    playlist_name_or_id, tracks)
+
+    async def remove_tracks_from_playlist(self, playlist_name_or_id, tracks):
+        return await self._run_sync(self._spotify.remove_tracks_from_playlist,
+                                    playlist_name_or_id, tracks)
+
+    async def add_liked_tracks(self, tracks, skip_liked=True):
+        return await self._run_sync(self._spotify.add_liked_tracks, tracks, skip_liked=skip_liked)
+
+    async def remove_liked_tracks(self, tracks):
+        return await self._run_sync(self._spotify.remove_liked_tracks, tracks)
+
+
+class SyncFacade:
+    """Exposes the coroutines of an AsyncSpotifyInterface as blocking calls."""
+    def __init__(self, async_spotify: AsyncSpotifyInterface):
+        self._async_spotify = async_spotify
+
+    def __getattr__(self, name):
+        attr = getattr(self._async_spotify, name)
+        if not inspect.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def run(*args, **kwargs):
+            return asyncio.run(attr(*args, **kwargs))
+
+        return run
@@ -0,0 +1,201 @@
+"""
+A local store of Spotify track metadata, keyed by spotify_id.
+
+Workflows that need metadata like popularity, album or release date for tracks they only
+know by ID (queues, listening history, the rekordbox_to_spotify mapping) can read it from
+here instead of re-downloading it every time.
+hydrate() fetches only the IDs that are missing from the store or older than
+track_metadata_ttl_days. It uses the maximum batch size of the tracks endpoint and keeps
+several batches in flight through the async Spotify client. IDs that Spotify doesn't know
+are stored as not_found, so they aren't requested again until they're stale.
+
+Queue and ListeningHistory fill in these columns from the store when tracks are appended,
+and have get_df_with_metadata(); the ID map fills them in with add_spotify_fields(...,
+fill_metadata=True), and new rekordbox_to_spotify mappings are filled in before they're
+written.
+"""
+
+import logging
+import os
+import os.path
+
+import pandas as pd
+
+import spyroslib.containers as ct
+import djlib_config
+# containers imports this module, so its names are looked up when used
+import containers
+
+logger = logging.getLogger(__name__)
+
+METADATA_COLUMNS = ['popularity', 'album_id', 'album_name', 'release_date']
+
+_singleton = None
+
+
+class _SpotifyTrackStore:
+    def __init__(self):
+        self._doc = None
+        return
+
+    def _get_doc(self):
+        if self._doc is not None:
+            return self._doc
+
+        path = os.path.join(djlib_config.default_dir, 'spotify_track_store.csv')
+        new_file = not os.path.exists(path)
+
+        self._doc = containers.Doc(
+            name='spotify track store',
+            path=path,
+            type='csv',
+            index_column='spotify_id',
+            datetime_columns=['release_date', 'added_at', 'fetched_at'],
+            backups=0,
+            create=new_file,
+            overwrite=True,
+            modify=True
+        )
+
+        return self._doc
+
+    def __len__(self):
+        return len(self._get_doc())
+
+    def _ids_to_fetch(self, ids: pd.Index, max_age_days):
+        store_df = self._get_doc().get_df()
+
+        missing_ids = ids.difference(store_df.index, sort=False)
+
+        if max_age_days is None or len(store_df) == 0:
+            return missing_ids
+
+        cutoff = pd.Timestamp.utcnow() - pd.Timedelta(days=max_age_days)
+        known_ids = ids.intersection(store_df.index, sort=False)
+        # read back as strings or naive timestamps depending on how the store was written
+        fetched_at = pd.to_datetime(store_df.loc[known_ids, 'fetched_at'], utc=True, format='ISO8601')
+        stale_ids = known_ids[(fetched_at.isna() | (fetched_at < cutoff)).to_numpy()]
+
+        return missing_ids.append(stale_ids)
+
+    def hydrate(self, ids, max_age_days=None, write=True):
+        """Makes sure the store has fresh metadata for all the IDs; fetches only the
+           missing or stale ones. Returns the number of tracks fetched."""
+        if max_age_days is None:
+            max_age_days = djlib_config.track_metadata_ttl_days
+
+        ids = pd.Index(ids).dropna().unique()
+
+        ids_to_fetch = self._ids_to_fetch(ids, max_age_days)
+
+        logger.debug('Track store: %d IDs requested, %d missing or stale',
+                     len(ids), len(ids_to_fetch))
+
+        if len(ids_to_fetch) == 0:
+            return 0
+
+        print(f'Fetching metadata for {len(ids_to_fetch)} tracks...', end='')
+
+        tracks = djlib_config.spotify_bulk.get_tracks_by_id(ids_to_fetch)
+
+        not_found_ids = ids_to_fetch.difference(tracks.index, sort=False)
+
+        print(f' {len(tracks)} fetched, {len(not_found_ids)} not found')
+
+        not_found = pd.DataFrame(
+            {'spotify_id': not_found_ids, 'not_found': True},
+            index=pd.Index(not_found_ids, name='spotify_id'))
+
+        self._add_rows(pd.concat([tracks.assign(not_found=False), not_found]), write=write)
+
+        return len(tracks)
+
+    def ingest(self, tracks, write=True):
+        """Adds or replaces tracks that were fetched elsewhere (playlists, search results)
+           without making any requests."""
+        if isinstance(tracks, ct.Container):
+            tracks = tracks.get_df()
+
+        if tracks.index.name != 'spotify_id':
+            raise ValueError('Expected a DF indexed by spotify_id')
+
+        self._add_rows(tracks.assign(not_found=False), write=write)
+        return
+
+    def _add_rows(self, rows: pd.DataFrame, write=True):
+        if len(rows) == 0:
+            return
+
+        rows = rows.assign(fetched_at=pd.Timestamp.utcnow())
+
+        doc = self._get_doc()
+        store_df = doc.get_df()
+
+        if len(store_df) == 0:
+            doc.set_df(rows)
+        else:
+            doc.set_df(pd.concat([
+                store_df.loc[store_df.index.difference(rows.index, sort=False)],
+                rows
+            ]))
+
+        if write:
+            doc.write(force=True)
+
+        return
+
+    def get_tracks(self, ids, hydrate=True) -> pd.DataFrame:
+        """Returns the store entries for the IDs, in the same order. IDs that Spotify
+           doesn't know about are left out."""
+        ids = pd.Index(ids, name='spotify_id')
+
+        if hydrate:
+            self.hydrate(ids)
+
+        store_df = self._get_doc().get_df()
+        if 'not_found' in store_df.columns:
+            store_df = store_df.loc[store_df['not_found'] != True]
+
+        return store_df.loc[ids.intersection(store_df.index, sort=False)]
+
+    def fill_metadata(self, tracks: pd.DataFrame, columns=None, hydrate=True) -> pd.DataFrame:
+        """Returns a copy of a spotify_id-indexed DF with the metadata columns filled in
+           from the store. Existing non-missing values are kept; only tracks with missing
+           values are looked up, and with hydrate=False, nothing is fetched."""
+        if tracks.index.name != 'spotify_id':
+            raise ValueError('Expected a DF indexed by spotify_id')
+
+        if columns is None:
+            columns = METADATA_COLUMNS
+
+        incomplete = pd.Series(False, index=tracks.index)
+        for column in columns:
+            if column in tracks.columns:
+                incomplete |= tracks[column].isna()
+            else:
+                incomplete[:] = True
+
+        incomplete_ids = tracks.index[incomplete.to_numpy()].dropna().unique()
+        if len(incomplete_ids) == 0:
+            return tracks
+
+        store_tracks = self.get_tracks(incomplete_ids, hydrate=hydrate)
+        store_tracks = store_tracks.reindex(index=tracks.index, columns=columns)
+
+        tracks = tracks.copy()
+        for column in columns:
+            # by position: listening history has repeated IDs, which can't be aligned on
+            if column in tracks.columns:
+                tracks[column] = tracks[column].where(tracks[column].notna(),
+                                                      store_tracks[column].to_numpy())
+            else:
+                tracks[column] = store_tracks[column].to_numpy()
+
+        return tracks
+
+
+def get_instance():
+    global _singleton
+    if _singleton is None:
+        _singleton = _SpotifyTrackStore()
+    return _singleton
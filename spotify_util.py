@@ -4,6 +4,7 @@ import spyroslib.containers
 
 from local_util import *
 from containers import *
+import artist_directory
 
 def format_track_for_search(track):
     """Creates a search string that's more likely to generate matches out of a
@@ -231,26 +232,10 @@ def add_artist_track_counts(artists: pd.DataFrame, tracks: pd.DataFrame, track_c
 
 
 def find_spotify_artist(artist_name):
-    """Returns the Spotify entry for the artist with the given name as a dictionary.
-    The ID is in there also.
-    The search is first done in the library, then expands to all of Spotify if necessary."""
+    """Returns the Spotify ID of the artist with the given name, from the artist directory.
+    Raises a ValueError listing the candidates if several artists have that name."""
 
-    listening_history = ListeningHistory()
-
-    artists = get_track_artists(listening_history)
-
-    candidate_ids = []
-
-    for id, name in artists.items():
-        if name == artist_name:
-            candidate_ids.append(id)
-
-    if len(candidate_ids) > 1:
-        raise ValueError(f'Multiple IDs found for artist {artist_name}: {candidate_ids}')
-    elif len(candidate_ids) == 0:
-        raise ValueError(f'Artist {artist_name} not found')
-
-    return candidate_ids[0]
+    return artist_directory.get_instance().get_artist_id(artist_name)
 
 def pretty_print_spotify_playlist(playlist_name, *, enum=True, liked_only=False):
     spotify_playlist = SpotifyPlaylist(playlist_name)
@@ -0,0 +1,51 @@
+
+import pandas as pd
+
+from discography_store import DiscographyStore
+
+
+def _get_store(tmp_path):
+    store = DiscographyStore(str(tmp_path / 'discography.db'))
+
+    albums = pd.DataFrame({
+        'album_id': ['album1', 'album2', 'album3'],
+        'name': ['Album 1', 'Album 2', 'Album 3'],
+        'album_type': ['album', 'single', 'single'],
+        'release_date': pd.to_datetime(['2024-01-01', '2024-02-01', '2024-03-01'], utc=True),
+    }).set_index('album_id', drop=False)
+    store.add_artist_albums('artist1', albums)
+
+    for album_id, release_date in zip(albums.index, albums['release_date']):
+        tracks = pd.DataFrame({
+            'spotify_id': [f'{album_id}_track'],
+            'name': ['Track'],
+            'artist_ids': ['artist1'],
+            'release_date': [release_date],
+            'album_id': [album_id],
+        })
+        store.put_album_tracks(album_id, tracks)
+
+    return store
+
+
+def test_query_tracks_with_naive_bounds(tmp_path):
+    store = _get_store(tmp_path)
+
+    df = store.query_tracks(released_after='2024-02-01', released_before=pd.Timestamp('2024-03-01'))
+
+    assert sorted(df.index) == ['album2_track', 'album3_track']
+    store.close()
+
+
+def test_query_tracks_with_tz_aware_bounds(tmp_path):
+    store = _get_store(tmp_path)
+
+    # 2024-01-31 20:00 in New York is 2024-02-01 01:00 UTC
+    df = store.query_tracks(
+        released_after=pd.Timestamp('2024-01-31 20:00', tz='America/New_York'),
+        released_before=pd.Timestamp('2024-03-01', tz='UTC'))
+    assert sorted(df.index) == ['album3_track']
+
+    df = store.query_tracks(released_after=pd.Timestamp.utcnow() - pd.Timedelta(days=30))
+    assert len(df) == 0
+    store.close()
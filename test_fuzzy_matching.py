@@ -0,0 +1,58 @@
+
+from spyroslib.general_utils import fuzzy_one_to_one_mapping
+
+from fuzzy_matching import blocked_fuzzy_one_to_one_mapping, get_blocks, get_candidate_pairs
+
+
+def _get_sequences():
+    rekordbox_sequences = [
+        'Daft Punk - Around the World',
+        'Daft Punk - Da Funk',
+        'Bicep - Glue',
+        'Bicep - Apricots',
+        'Röyksopp - Eple',
+        'Four Tet - Baby',
+        'Fred again.. - Marea (We\'ve Lost Dancing)',
+        'Moderat - A New Error',
+        'Unknown Artist - Untitled',
+    ]
+    listened_sequences = [
+        'Daft Punk - Around The World - Radio Edit',
+        'Daft Punk - Da Funk',
+        'Bicep - Glue (Original Mix)',
+        'Bicep - Apricot',
+        'Royksopp - Eple',
+        'Four Tet - Baby (Extended)',
+        'Fred again.., The Blessed Madonna - Marea (we\'ve lost dancing)',
+        'Moderat - Bad Kingdom',
+        'Burial - Archangel',
+    ]
+    return rekordbox_sequences, listened_sequences
+
+
+def _get_matches(result):
+    return sorted((pair['index1'], pair['index2'], pair['ratio']) for pair in result['pairs'])
+
+
+def test_blocks_have_strings_from_both_lists():
+    rekordbox_sequences, listened_sequences = _get_sequences()
+
+    candidates = get_candidate_pairs(rekordbox_sequences, listened_sequences)
+    blocks = get_blocks(candidates, len(listened_sequences))
+
+    assert 8 not in {i for indexes1, _ in blocks for i in indexes1}
+    assert 8 not in {j for _, indexes2 in blocks for j in indexes2}
+    for i, js in enumerate(candidates):
+        for j in js:
+            assert any(i in indexes1 and j in indexes2 for indexes1, indexes2 in blocks)
+
+
+def test_matches_are_the_same_as_the_full_mapping():
+    rekordbox_sequences, listened_sequences = _get_sequences()
+
+    for cutoff_ratio in [0.6, 0.9]:
+        full = fuzzy_one_to_one_mapping(rekordbox_sequences, listened_sequences, cutoff_ratio=cutoff_ratio)
+        blocked = blocked_fuzzy_one_to_one_mapping(rekordbox_sequences, listened_sequences, cutoff_ratio,
+                                                   workers=2)
+
+        assert _get_matches(blocked) == _get_matches(full)
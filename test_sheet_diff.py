@@ -0,0 +1,77 @@
+
+import pandas as pd
+
+import sheet_diff
+from sheet_diff import LocalSheetValues, SheetSnapshot, set_values_api, write_diff
+
+
+def _get_tracks():
+    return pd.DataFrame({
+        'Title': ['Song A', 'Song B', 'Song C', 'Song D'],
+        'Artist': ['Artist A', 'Artist B', 'Artist C', 'Artist D'],
+        'Rating': [1, 2, 3, 4],
+    })
+
+
+def test_only_changed_ranges_are_sent():
+    values_api = LocalSheetValues()
+    set_values_api(values_api)
+
+    df = _get_tracks()
+    snapshot = SheetSnapshot(df)
+
+    df = df.copy()
+    df.loc[0, 'Title'] = 'Song A (Remix)'
+    df.loc[2, 'Rating'] = 5
+    df.loc[3, 'Rating'] = 5
+
+    num_cells = write_diff(snapshot, df, 'spreadsheet', 'Tracks')
+
+    assert num_cells == 3
+    assert len(values_api.requests) == 1
+
+    _, data = values_api.requests[0]
+    assert data == [
+        {'range': "'Tracks'!A2:A2", 'values': [['Song A (Remix)']]},
+        {'range': "'Tracks'!C4:C5", 'values': [['5'], ['5']]},
+    ]
+
+    grid = values_api.cells[('spreadsheet', 'Tracks')]
+    assert grid == {(2, 1): 'Song A (Remix)', (4, 3): '5', (5, 3): '5'}
+
+    # nothing changed since the last write
+    assert write_diff(snapshot, df, 'spreadsheet', 'Tracks') == 0
+    assert len(values_api.requests) == 1
+
+    set_values_api(None)
+    return
+
+
+def test_index_column_maps_to_the_first_sheet_column():
+    values_api = LocalSheetValues()
+    set_values_api(values_api)
+
+    # the index column is the sheet's first column, whether or not the DF keeps it as a column
+    tracks = _get_tracks().assign(rekordbox_id=[11, 12, 13, 14])
+    for df in [tracks.set_index('rekordbox_id'),
+               tracks.set_index('rekordbox_id', drop=False)[['rekordbox_id', 'Title', 'Artist', 'Rating']]]:
+        values_api.requests.clear()
+
+        snapshot = SheetSnapshot(df, index_column='rekordbox_id')
+
+        df = df.copy()
+        df.loc[12, 'Rating'] = 5
+
+        write_diff(snapshot, df, 'spreadsheet', 'Main Library', header_row=1)
+
+        _, data = values_api.requests[0]
+        assert data == [{'range': "'Main Library'!D3:D3", 'values': [['5']]}]
+
+    set_values_api(None)
+    return
+
+
+def test_column_letter():
+    assert [sheet_diff.column_letter(position) for position in [0, 25, 26, 51, 52]] == \
+        ['A', 'Z', 'AA', 'AZ', 'BA']
+    return
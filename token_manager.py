@@ -0,0 +1,188 @@
+"""
+Thread-safe OAuth access token management, shared by the Spotify and SoundCloud interfaces.
+
+- Requests get the current token without blocking as long as it's valid.
+- The token is refreshed in a background thread some time before it expires, so that the
+  request path normally never waits for a refresh.
+- Concurrent refreshes are coalesced into one: whoever gets there first does the refresh,
+  everybody else waits for its result (or, in the background case, doesn't bother).
+- The cached token file is written atomically, so a crash or a concurrent reader never
+  sees a half-written file.
+
+The interfaces supply the actual workflows as functions that return token dictionaries
+with the keys access_token, refresh_token and expires_at (UNIX time).
+"""
+
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# refresh this many seconds before the token expires
+_DEFAULT_REFRESH_AHEAD = 300
+
+# don't hand out tokens that expire sooner than this
+_DEFAULT_EXPIRY_MARGIN = 60
+
+
+def write_json_atomically(path, obj):
+    """Writes obj to path as JSON through a temporary file in the same directory,
+       then moves it into place."""
+    directory = os.path.dirname(os.path.abspath(path))
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(obj, fp=tmp_file, indent=2)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return
+
+
+class TokenManager:
+    def __init__(self,
+                 service_name,
+                 token_file,
+                 *,
+                 authorize_func,
+                 refresh_func,
+                 to_file_func,
+                 from_file_func,
+                 refresh_ahead=_DEFAULT_REFRESH_AHEAD,
+                 expiry_margin=_DEFAULT_EXPIRY_MARGIN):
+        """
+        authorize_func(): runs the interactive authorization workflow; returns a token dict.
+        refresh_func(refresh_token): runs the refresh token workflow; returns a token dict.
+        to_file_func(token) / from_file_func(obj): convert between token dicts and the
+            JSON object stored in token_file.
+        """
+        self._service_name = service_name
+        self._token_file = token_file
+        self._authorize_func = authorize_func
+        self._refresh_func = refresh_func
+        self._to_file_func = to_file_func
+        self._from_file_func = from_file_func
+        self._refresh_ahead = refresh_ahead
+        self._expiry_margin = expiry_margin
+
+        self._token = None
+
+        # held by whoever is currently refreshing or authorizing
+        self._refresh_lock = threading.Lock()
+        self._timer = None
+        self._timer_lock = threading.Lock()
+
+        self.num_refreshes = 0
+        return
+
+    def _is_valid(self, token, margin):
+        return token is not None and time.time() < token['expires_at'] - margin
+
+    def get_access_token(self):
+        token = self._token
+
+        if self._is_valid(token, self._expiry_margin):
+            if not self._is_valid(token, self._refresh_ahead):
+                # close to expiry and the timer hasn't run yet (e.g. the machine slept)
+                self._refresh_in_background()
+            return token['access_token']
+
+        # nothing valid to hand out; this is the only case where a request waits
+        return self._refresh(blocking=True)['access_token']
+
+    def _refresh(self, blocking):
+        if not self._refresh_lock.acquire(blocking=blocking):
+            # somebody else is refreshing
+            return self._token
+
+        try:
+            stale_token = self._token
+
+            if stale_token is None:
+                stale_token = self._read_token_file()
+
+            # another thread may have finished a refresh while we were waiting for the lock
+            margin = self._expiry_margin if blocking else self._refresh_ahead
+            if self._is_valid(stale_token, margin):
+                self._set_token(stale_token, write=False)
+                return stale_token
+
+            new_token = None
+            if stale_token is not None and stale_token.get('refresh_token') is not None:
+                try:
+                    new_token = self._refresh_func(stale_token['refresh_token'])
+                    if new_token.get('refresh_token') is None:
+                        new_token['refresh_token'] = stale_token['refresh_token']
+                except Exception as e:
+                    logger.debug('Refreshing %s access token failed: %s', self._service_name, str(e))
+                    if not blocking:
+                        # the interactive workflow can't run in the background;
+                        # the next request that needs a token will do it
+                        return self._token
+
+            if new_token is None:
+                if not blocking:
+                    return self._token
+                new_token = self._authorize_func()
+
+            self.num_refreshes += 1
+            self._set_token(new_token, write=True)
+            return new_token
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh_in_background(self):
+        thread = threading.Thread(
+            target=self._refresh,
+            kwargs={'blocking': False},
+            name=f'{self._service_name}-token-refresh',
+            daemon=True)
+        thread.start()
+        return
+
+    def _set_token(self, token, write):
+        self._token = token
+
+        if write:
+            write_json_atomically(self._token_file, self._to_file_func(token))
+
+        self._schedule_refresh(token)
+        return
+
+    def _schedule_refresh(self, token):
+        delay = token['expires_at'] - self._refresh_ahead - time.time()
+
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+
+            if delay > 0:
+                self._timer = threading.Timer(delay, self._refresh, kwargs={'blocking': False})
+                self._timer.daemon = True
+                self._timer.start()
+
+        return
+
+    def _read_token_file(self):
+        if not os.path.exists(self._token_file):
+            return None
+
+        try:
+            with open(self._token_file) as token_fh:
+                return self._from_file_func(json.load(token_fh))
+        except Exception as e:
+            logger.debug('Reading %s access token file failed: %s', self._service_name, str(e))
+            return None